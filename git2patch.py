@@ -1,24 +1,45 @@
 import configparser
 import os
 import shutil
-import subprocess
 import filecmp
 import re
 import tempfile
-import zipfile
 import struct
 import fnmatch
+import ntpath
 import sys
 import time
 import datetime
 import threading
 import concurrent.futures
+import collections
+import json
+import contextlib
+import contextvars
+import functools
+import queue
+import atexit
+import hashlib
+import lzma
+import zlib
+import codecs
+import mmap
+import array
+
+# GitPython, asyncio, zipfile и http.server импортируются только там, где нужны: команды, не работающие
+# с Git и компилятором (version, cache, plan --show), запускаются быстро
+Repo = Actor = GitCommandError = None
+
+
+def import_git():
+    global Repo, Actor, GitCommandError
+    if Repo is None:
+        try:
+            from git import Repo, Actor, GitCommandError
+        except ModuleNotFoundError:
+            print('Error: GitPython library required (install with "pip install gitpython")')
+            quit(-1)
 
-try:
-    from git import Repo, Actor
-except ModuleNotFoundError as e:
-    print('Error: GitPython library required (install with "pip install gitpython")')
-    quit(-1)
 
 # -------------------------------------------------------------------------------------------------
 python_version = sys.version.split(' ', 1)[0]
@@ -27,45 +48,121 @@ if python_version < '3.10':
     quit(-1)
 
 THREAD_NAME_PREFIX='th'
-EXECUTOR = concurrent.futures.ThreadPoolExecutor(thread_name_prefix=THREAD_NAME_PREFIX) #max_workers=4, 
-LOG_LOCK = threading.RLock()
-COMPILED_LOCK = threading.RLock()
-COMPILING_NOW_CONDITION = threading.Condition()
+
+
+# пул потоков, задачи которого выполняются в копии контекста отправившего их потока
+# (в том числе с каталогами текущего задания пакетного режима, см. JobState)
+class ContextThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+# пул потоков, который считает суммарное время занятости своих потоков (для отчета о загрузке)
+class MeasuredThreadPoolExecutor(ContextThreadPoolExecutor):
+    def __init__(self, max_workers=None, **kwargs):
+        # число потоков по умолчанию то же, что у ThreadPoolExecutor
+        self.workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        super().__init__(max_workers=self.workers, **kwargs)
+        self.busy_seconds = 0.0
+        self.__busy_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        def measured(*fn_args, **fn_kwargs):
+            begin = time.perf_counter()
+            try:
+                return fn(*fn_args, **fn_kwargs)
+            finally:
+                with self.__busy_lock:
+                    self.busy_seconds += time.perf_counter() - begin
+        return super().submit(measured, *args, **kwargs)
+
+
+EXECUTOR = MeasuredThreadPoolExecutor(thread_name_prefix=THREAD_NAME_PREFIX)
+
+
+# счетчик файлов, реально записанных в рабочие каталоги и патч (для отчета о ресурсах)
+class FileCounter:
+    def __init__(self):
+        self.value = 0
+        self.__lock = threading.Lock()
+
+    def add(self, path=None):
+        with self.__lock:
+            self.value += 1
+        return path
+
+
+FILES_WRITTEN = FileCounter()
+LOG_DEBUG = 10  # сообщения о каждом файле (копирование, компиляция)
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_LEVELS = {'DEBUG': LOG_DEBUG, 'INFO': LOG_INFO, 'WARNING': LOG_WARNING, 'ERROR': LOG_ERROR}
+COMPILE_OUTPUT_TAIL = 50  # сколько последних строк вывода компилятора показывать в логе при ошибке
+COMPILER_COMMAND = None  # команда вместо bscc.exe из билда, например заглушка компилятора в git2patch_bench.py
+CANCEL_EVENT = threading.Event()  # отмена текущей сборки (задание службы)
 
 INSTANCE_BANK = "BANK"
 INSTANCE_IC = "IC"
 INSTANCE_CLIENT = "CLIENT"
 INSTANCE_CLIENT_MBA = "CLIENT_MBA"
-DIR_TEMP = os.path.join(os.path.abspath(''), '_TEMP')
-DIR_BUILD_BK = os.path.join(DIR_TEMP, '_BUILD', 'BK')
-DIR_BUILD_IC = os.path.join(DIR_TEMP, '_BUILD', 'IC')
-DIR_BEFORE = os.path.join(DIR_TEMP, '_BEFORE')
-DIR_AFTER = os.path.join(DIR_TEMP, '_AFTER')
-DIR_AFTER_BLS = os.path.join(DIR_AFTER, 'BLS')
-DIR_COMPARED = os.path.join(DIR_TEMP, '_COMPARE_RESULT')
-DIR_COMPARED_BLS = os.path.join(DIR_COMPARED, 'BLS')
-DIR_COMPARED_BLS_SOURCE = os.path.join(DIR_COMPARED_BLS, 'SOURCE')
-DIR_COMPARED_BLS_SOURCE_RCK = os.path.join(DIR_COMPARED_BLS_SOURCE, 'RCK')
-DIR_COMPARED_CommonLibraries = os.path.join(DIR_COMPARED, 'SETUP', 'CommonLibraries')
-DIR_COMPARED_WWW = os.path.join(DIR_COMPARED, 'WWW')
-DIR_COMPARED_WWW_react = os.path.join(DIR_COMPARED, 'WWW_react')
-DIR_COMPARED_WWW_BSI_SITES = os.path.join(DIR_COMPARED_WWW, 'BSI_SITES')
-DIR_COMPARED_WWW_RT_IC = os.path.join(DIR_COMPARED_WWW_BSI_SITES, 'RT_IC')
-DIR_COMPARED_RT_TPL = os.path.join(DIR_COMPARED, 'RT_TPL')
-DIR_COMPARED_RTF = os.path.join(DIR_COMPARED, 'RTF')
-DIR_COMPARED_RTF_BANK = os.path.join(DIR_COMPARED_RTF, 'Bank')
-DIR_COMPARED_RTF_CLIENT = os.path.join(DIR_COMPARED_RTF, 'Client')
-DIR_COMPARED_RTF_REPJET = os.path.join(DIR_COMPARED_RTF, 'RepJet')
-DIR_COMPARED_XSD = os.path.join(DIR_COMPARED, 'XSD')
-DIR_PATCH = os.path.join(DIR_TEMP, 'PATCH')
+DIR_CACHE = os.path.join(os.path.abspath(''), '_CACHE')  # общие для заданий пакетного режима кэши
+DIR_BATCH = os.path.join(os.path.abspath(''), '_BATCH')  # рабочие каталоги заданий пакетного режима
+DIR_TRASH = os.path.join(os.path.abspath(''), '_TRASH')  # каталоги, которые clean() удаляет в фоне
+
+
+# Рабочие каталоги вычисляются от DIR_TEMP. В пакетном режиме задания собираются параллельно, у каждого
+# свой DIR_TEMP, поэтому каталоги - атрибуты состояния задания JobState, которое хранится в контекстной
+# переменной: ее наследуют задачи asyncio и задачи пулов ContextThreadPoolExecutor. Код обращается
+# к каталогам текущего задания через JOB (JOB.DIR_TEMP, JOB.DIR_PATCH и т.д.)
+class JobState:
+    def __init__(self, temp_dir):
+        self.DIR_TEMP = temp_dir
+        self.DIR_BUILD_BK = os.path.join(self.DIR_TEMP, '_BUILD', 'BK')
+        self.DIR_BUILD_IC = os.path.join(self.DIR_TEMP, '_BUILD', 'IC')
+        self.DIR_BUILD_REFERENCE = os.path.join(self.DIR_TEMP, '_BUILD', 'REFERENCE')
+        self.DIR_BEFORE = os.path.join(self.DIR_TEMP, '_BEFORE')
+        self.DIR_AFTER = os.path.join(self.DIR_TEMP, '_AFTER')
+        self.DIR_AFTER_BLS = os.path.join(self.DIR_AFTER, 'BLS')
+        self.DIR_COMPARED = os.path.join(self.DIR_TEMP, '_COMPARE_RESULT')
+        self.DIR_COMPARED_BLS = os.path.join(self.DIR_COMPARED, 'BLS')
+        self.DIR_COMPARED_BLS_SOURCE = os.path.join(self.DIR_COMPARED_BLS, 'SOURCE')
+        self.DIR_COMPARED_BLS_SOURCE_RCK = os.path.join(self.DIR_COMPARED_BLS_SOURCE, 'RCK')
+        self.DIR_COMPARED_CommonLibraries = os.path.join(self.DIR_COMPARED, 'SETUP', 'CommonLibraries')
+        self.DIR_COMPARED_WWW = os.path.join(self.DIR_COMPARED, 'WWW')
+        self.DIR_COMPARED_WWW_react = os.path.join(self.DIR_COMPARED, 'WWW_react')
+        self.DIR_COMPARED_WWW_BSI_SITES = os.path.join(self.DIR_COMPARED_WWW, 'BSI_SITES')
+        self.DIR_COMPARED_WWW_RT_IC = os.path.join(self.DIR_COMPARED_WWW_BSI_SITES, 'RT_IC')
+        self.DIR_COMPARED_RT_TPL = os.path.join(self.DIR_COMPARED, 'RT_TPL')
+        self.DIR_COMPARED_RTF = os.path.join(self.DIR_COMPARED, 'RTF')
+        self.DIR_COMPARED_RTF_BANK = os.path.join(self.DIR_COMPARED_RTF, 'Bank')
+        self.DIR_COMPARED_RTF_CLIENT = os.path.join(self.DIR_COMPARED_RTF, 'Client')
+        self.DIR_COMPARED_RTF_REPJET = os.path.join(self.DIR_COMPARED_RTF, 'RepJet')
+        self.DIR_COMPARED_XSD = os.path.join(self.DIR_COMPARED, 'XSD')
+        self.DIR_PATCH = os.path.join(self.DIR_TEMP, 'PATCH')
+
+
+JOB_STATE = contextvars.ContextVar('job_state', default=JobState(os.path.join(os.path.abspath(''), '_TEMP')))
+
+
+class CurrentJob:
+    def __getattr__(self, name):
+        return getattr(JOB_STATE.get(), name)
+
+
+JOB = CurrentJob()
+
+
+def set_temp_dir(path):
+    JOB_STATE.set(JobState(path))
 
 
 def dir_after_base(instance): 
-    return os.path.join(DIR_AFTER, 'BASE', instance)
+    return os.path.join(JOB.DIR_AFTER, 'BASE', instance)
 
 
 def dir_compared_base(instance): 
-    return os.path.join(DIR_COMPARED, 'BASE', instance)
+    return os.path.join(JOB.DIR_COMPARED, 'BASE', instance)
 
 def dir_after_base_tables(instance): 
     return os.path.join(dir_after_base(instance), 'TABLES')
@@ -74,10 +171,10 @@ def dir_after_base_tabledata_config(instance):
     return os.path.join(dir_after_base(instance), 'Table data', 'Config')
 
 def dir_compared_bls(): 
-    return os.path.join(DIR_COMPARED, 'BLS')
+    return os.path.join(JOB.DIR_COMPARED, 'BLS')
 
 def dir_patch(instance=''): 
-    return os.path.join(DIR_PATCH, instance)
+    return os.path.join(JOB.DIR_PATCH, instance)
 
 
 def dir_patch_data(instance): 
@@ -356,7 +453,7 @@ def get_filename_upgrade10_eif(instance): return os.path.join(dir_patch(instance
 
 
 def get_filename_jira_tickets():
-    return os.path.join(DIR_PATCH, 'jira_tickets.txt')
+    return os.path.join(JOB.DIR_PATCH, 'jira_tickets.txt')
 
 
 def dir_patch_libfilesreact():
@@ -364,17 +461,322 @@ def dir_patch_libfilesreact():
 
 
 # -------------------------------------------------------------------------------------------------
-def current_time_as_string(): return datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
+def current_time_as_string(timestamp=None):
+    return datetime.datetime.fromtimestamp(timestamp or time.time()).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# -------------------------------------------------------------------------------------------------
+# Логирование через очередь: вызывающий поток только кладет сообщение в очередь,
+# а один поток-писатель пачками выводит их на консоль и в файл лога, который держит открытым.
+class AsyncLogger:
+    BATCH_SIZE = 1000  # сколько сообщений записывать за один раз
+
+    def __init__(self):
+        self.level = LOG_DEBUG
+        self.__queue = queue.SimpleQueue()
+        self.__thread = None
+        self.__start_lock = threading.Lock()
+
+    def put(self, message_text, level):
+        if level < self.level:
+            return
+        if not self.__thread:
+            self.__start()
+        self.__queue.put((time.time(), threading.get_ident(), threading.current_thread().name, str(message_text)))
+
+    def flush(self):
+        # дожидаемся, пока все ранее поставленные сообщения будут записаны (если поток-писатель еще жив)
+        if self.__thread and self.__thread.is_alive():
+            written = threading.Event()
+            self.__queue.put(written)
+            while not written.wait(1.0):
+                if not self.__thread.is_alive():
+                    break
+
+    def __start(self):
+        with self.__start_lock:
+            if not self.__thread:
+                self.__thread = threading.Thread(target=self.__write, name='log', daemon=True)
+                self.__thread.start()
+                atexit.register(self.flush)
+
+    def __write(self):
+        try:
+            f = open(get_filename_log(), mode='a')
+        except OSError as exc:
+            f = None
+            print(f'ERROR: can not open log file {get_filename_log()} ({exc})', file=sys.stderr, flush=True)
+        while True:
+            batch = [self.__queue.get()]
+            while len(batch) < self.BATCH_SIZE and not self.__queue.empty():
+                batch.append(self.__queue.get())
+            lines = []
+            written_events = []
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    written_events.append(item)
+                else:
+                    timestamp, ident, thread_name, message_text = item
+                    lines.append(f'[{current_time_as_string(timestamp)}][{ident}_{thread_name}] {message_text}')
+            # ошибка записи одной пачки не должна останавливать поток: иначе flush() ждал бы вечно
+            if lines:
+                try:
+                    print('\n'.join(lines), flush=True)
+                except BaseException as exc:
+                    self.__write_fallback(lines, f'console ({exc})')
+                if f:
+                    try:
+                        f.writelines(['\n' + line for line in lines])
+                        f.flush()
+                    except BaseException as exc:
+                        self.__write_fallback(lines, f'log file {get_filename_log()} ({exc})')
+            for written in written_events:
+                written.set()
+
+    @staticmethod
+    def __write_fallback(lines, reason):
+        try:
+            sys.stderr.write(f'ERROR: can not write log to {reason}\n')
+            sys.stderr.write('\n'.join(lines).encode('ascii', errors='backslashreplace').decode('ascii') + '\n')
+            sys.stderr.flush()
+        except BaseException:
+            pass
+
+
+LOGGER = AsyncLogger()
+
+
+def log(message_text, level=LOG_INFO):
+    LOGGER.put(message_text, level)
+
+
+def log_debug(message_text):
+    log(message_text, LOG_DEBUG)
+
+
+def flush_log():
+    LOGGER.flush()
+
+
+# -------------------------------------------------------------------------------------------------
+# Запись интервалов выполнения этапов в формате Chrome trace (открывается в chrome://tracing или ui.perfetto.dev).
+# Интервалы привязываются к "дорожкам": по умолчанию это поток, для компиляции - номер слота компилятора.
+class Tracer:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__events = []
+        self.__lanes = {}
+        self.__busy_slots = {}
+        self.__begin = time.perf_counter()
+
+    def __lane_id(self, lane_name):
+        if lane_name not in self.__lanes:
+            self.__lanes[lane_name] = len(self.__lanes) + 1
+        return self.__lanes[lane_name]
+
+    def add_span(self, name, begin, end, lane_name=None, args=None):
+        if lane_name is None:
+            lane_name = threading.current_thread().name
+        with self.__lock:
+            self.__events.append({'name': name, 'cat': 'git2patch', 'ph': 'X',
+                                'ts': round((begin - self.__begin) * 1000000),
+                                'dur': round((end - begin) * 1000000),
+                                'pid': 1, 'tid': self.__lane_id(lane_name), 'args': args or {}})
+
+    def acquire_slot(self, prefix):
+        # выдает наименьший свободный номер слота, чтобы параллельные компиляции легли на разные дорожки
+        with self.__lock:
+            busy = self.__busy_slots.setdefault(prefix, set())
+            slot = next(number for number in range(len(busy) + 1) if number not in busy)
+            busy.add(slot)
+        return f'{prefix} {slot}'
+
+    def release_slot(self, lane_name):
+        prefix, slot = lane_name.rsplit(' ', 1)
+        with self.__lock:
+            self.__busy_slots[prefix].discard(int(slot))
+
+    # clear - начать новую трассу после сохранения (служба сохраняет трассу каждого задания отдельно)
+    def save(self, file_name, clear=False):
+        with self.__lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane_id, 'args': {'name': lane_name}}
+                        for lane_name, lane_id in self.__lanes.items()]
+            metadata.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'git2patch'}})
+            trace = {'traceEvents': metadata + self.__events, 'displayTimeUnit': 'ms'}
+            if clear:
+                self.__events = []
+        with open(file_name, mode='w', encoding='utf-8') as f:
+            json.dump(trace, f, ensure_ascii=False)
+        log(f'TRACE saved to {file_name} (open it in chrome://tracing or https://ui.perfetto.dev)')
+
+
+TRACER = Tracer()
+
+
+# -------------------------------------------------------------------------------------------------
+@contextlib.contextmanager
+def trace_span(name, lane_name=None, **args):
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        TRACER.add_span(name, begin, time.perf_counter(), lane_name, args)
+
+
+# -------------------------------------------------------------------------------------------------
+# Счетчики процесса: процессорное время (свое и дочерних процессов, т.е. компилятора),
+# операции и байты чтения/записи, пиковый объем памяти. Недоступные на платформе значения равны None.
+def get_process_counters():
+    times = os.times()
+    counters = {'cpu_seconds': times.user + times.system,
+                'children_cpu_seconds': times.children_user + times.children_system,
+                'read_ops': None, 'read_bytes': None, 'write_ops': None, 'write_bytes': None,
+                'peak_rss_bytes': None, 'files_written': FILES_WRITTEN.value}
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            from ctypes import wintypes
+
+            class IO_COUNTERS(ctypes.Structure):
+                _fields_ = [(name, ctypes.c_ulonglong) for name in
+                            ['ReadOperationCount', 'WriteOperationCount', 'OtherOperationCount',
+                            'ReadTransferCount', 'WriteTransferCount', 'OtherTransferCount']]
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                        [(name, ctypes.c_size_t) for name in
+                            ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                            'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            io = IO_COUNTERS()
+            if ctypes.windll.kernel32.GetProcessIoCounters(process, ctypes.byref(io)):
+                counters.update({'read_ops': io.ReadOperationCount, 'read_bytes': io.ReadTransferCount,
+                                'write_ops': io.WriteOperationCount, 'write_bytes': io.WriteTransferCount})
+            memory = PROCESS_MEMORY_COUNTERS()
+            memory.cb = ctypes.sizeof(memory)
+            if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(memory), memory.cb):
+                counters['peak_rss_bytes'] = memory.PeakWorkingSetSize
+        else:
+            import resource
+            counters['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            if os.path.exists('/proc/self/io'):
+                with open('/proc/self/io') as f:
+                    io = dict(line.split(': ') for line in f.read().splitlines())
+                counters.update({'read_ops': int(io['syscr']), 'read_bytes': int(io['rchar']),
+                                'write_ops': int(io['syscw']), 'write_bytes': int(io['wchar'])})
+    except BaseException as exc:
+        log(f'\tERROR: can not read process counters ({exc})', LOG_ERROR)
+    return counters
+
+
+# -------------------------------------------------------------------------------------------------
+def get_pools_busy_seconds():
+    return {'io_pool': (EXECUTOR.busy_seconds, EXECUTOR.workers),
+            'compiler': (COMPILER_LIMITER.busy_seconds(), COMPILER_LIMITER.max_limit),
+            'license_server': (LICENSE_LIMITER.busy_seconds(), LICENSE_LIMITER.max_limit)}
+
+
+# -------------------------------------------------------------------------------------------------
+# Отчет о ресурсах по этапам. Этапы, перечисленные в настройках [PROFILE],
+# дополнительно выполняются под cProfile и/или tracemalloc, результаты кладутся рядом с логом.
+class StageReport:
+    TRACEMALLOC_TOP = 30  # сколько мест выделения памяти выводить в отчет tracemalloc
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.stages = []
+        self.cprofile_stages = set()
+        self.tracemalloc_stages = set()
+
+    def add(self, stage):
+        with self.__lock:
+            self.stages.append(stage)
+
+    def save(self, file_name, clear=False):
+        with self.__lock:
+            report = {'version': 1, 'python': python_version, 'platform': sys.platform, 'stages': self.stages}
+            if clear:
+                self.stages = []
+        with open(file_name, mode='w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        log(f'RESOURCE REPORT saved to {file_name}')
+
+
+REPORT = StageReport()
+
+
+# -------------------------------------------------------------------------------------------------
+def setup_logging(settings):
+    LOGGER.level = LOG_LEVELS[settings.LogLevel]
+
+
+# -------------------------------------------------------------------------------------------------
+def setup_profiling(settings):
+    REPORT.cprofile_stages = set(settings.CProfileStages)
+    REPORT.tracemalloc_stages = set(settings.TracemallocStages)
+
+
+# -------------------------------------------------------------------------------------------------
+@contextlib.contextmanager
+def measure_stage(name, arguments=None):
+    profiler = tracemalloc_started = None
+    if name in REPORT.cprofile_stages:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if name in REPORT.tracemalloc_stages:
+        import tracemalloc
+        tracemalloc_started = not tracemalloc.is_tracing()
+        if tracemalloc_started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    counters_before = get_process_counters()
+    pools_before = get_pools_busy_seconds()
+    begin = time.perf_counter()
+    try:
+        with trace_span(name, arguments=arguments or []):
+            yield
+    finally:
+        wall_seconds = time.perf_counter() - begin
+        counters_after = get_process_counters()
+        pools_after = get_pools_busy_seconds()
+        stage = {'stage': name, 'arguments': arguments or [], 'thread': threading.current_thread().name,
+                'wall_seconds': round(wall_seconds, 3)}
+        for counter, value in counters_after.items():
+            if counter == 'peak_rss_bytes' or value is None or counters_before[counter] is None:
+                stage[counter] = value
+            else:
+                stage[counter] = round(value - counters_before[counter], 3)
+        for pool, (busy_seconds, workers) in pools_after.items():
+            capacity = wall_seconds * workers
+            stage[f'{pool}_utilisation'] = round((busy_seconds - pools_before[pool][0]) / capacity, 3) if capacity else None
+        if profiler:
+            profiler.disable()
+        if tracemalloc_started is not None:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            stage['tracemalloc'] = filename(f'{name}.tracemalloc.txt')
+            with open(stage['tracemalloc'], mode='w', encoding='utf-8') as f:
+                f.write(f'peak traced memory: {tracemalloc.get_traced_memory()[1]} bytes\n')
+                for statistic in snapshot.statistics('lineno')[:StageReport.TRACEMALLOC_TOP]:
+                    f.write(f'{statistic}\n')
+            if tracemalloc_started:
+                tracemalloc.stop()
+        if profiler:
+            stage['cprofile'] = filename(f'{name}.prof')
+            profiler.dump_stats(stage['cprofile'])
+        REPORT.add(stage)
 
 
 # -------------------------------------------------------------------------------------------------
-def log(message_text):
-    with LOG_LOCK:
-        log_file_name = os.path.join(os.path.abspath(''), filename('log'))
-        with open(log_file_name, mode='a') as f:
-            message_text = f'[{current_time_as_string()}][{threading.get_ident()}_{threading.current_thread().name}] {str(message_text)}'
-            print(message_text)
-            f.writelines('\n' + message_text)
+def traced(function):
+    # декоратор этапа: интервал называется по имени функции, строковые аргументы попадают в args
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with measure_stage(function.__name__, [arg for arg in args if isinstance(arg, (str, int))]):
+            return function(*args, **kwargs)
+    return wrapper
 
 
 def get_last_element_of_path(path):
@@ -729,9 +1131,15 @@ def filename(ext):
     return f'{os.path.splitext(__file__)[0]}.{ext}'
 
 
+def get_filename_log():
+    return os.path.join(os.path.abspath(''), filename('log'))
+
+
 # -------------------------------------------------------------------------------------------------
 class GlobalSettings:
-    def __init__(self):
+    # overrides - значения параметров, заменяющие значения из ini (задание пакетного режима)
+    def __init__(self, overrides=None):
+        self.overrides = overrides or {}
         self.git_url = ''
         self.TagBefore = ''
         self.TagAfter = ''
@@ -739,6 +1147,8 @@ class GlobalSettings:
         self.BuildBK = ''
         self.BuildIC = ''
         self.BuildCrypto = ''
+        self.ReferenceBuild = ''
+        self.BuildDeltas = False
         self.PlaceBuildIntoPatchBK = False
         self.PlaceBuildIntoPatchIC = False
         self.ClientEverythingInEXE = False
@@ -747,6 +1157,22 @@ class GlobalSettings:
         self.LicenseProfile = ''
         self.Is20Version = None
         self.BLLVersion = ''
+        self.CompilerProcesses = 0
+        self.LicenseSessions = 0
+        self.IOWorkers = 0
+        self.AdaptiveConcurrency = False
+        self.CompileTimeout = 0
+        self.CompileRetries = 0
+        self.CProfileStages = []
+        self.TracemallocStages = []
+        self.ServicePort = 8765
+        self.CompareBLSTokens = False
+        self.NormalizeText = False
+        self.EifDeltas = False
+        self.PackageZip = False
+        self.PackageLevel = 6
+        self.PackageWorkers = 0
+        self.LogLevel = 'DEBUG'
         self.__success = False
         self.read_config()
 
@@ -758,6 +1184,12 @@ class GlobalSettings:
         section_special = 'SPECIAL'
         section_tags = 'TAGS'
         section_build = 'BUILD'
+        section_concurrency = 'CONCURRENCY'
+        section_compile = 'COMPILE'
+        section_profile = 'PROFILE'
+        section_service = 'SERVICE'
+        section_compare = 'COMPARE'
+        section_package = 'PACKAGE'
         try:
             if not os.path.exists(ini_filename):
                 raise FileNotFoundError(f'NOT FOUND {ini_filename}')
@@ -765,6 +1197,11 @@ class GlobalSettings:
             res = parser.read(ini_filename, encoding="UTF-8")
             if res.count == 0:  # если файл настроек не найден
                 raise FileNotFoundError(f'NOT FOUND {ini_filename}')
+            for key, value in self.overrides.items():
+                sections = [section for section in parser.sections() if parser.has_option(section, key)]
+                if not sections:
+                    raise ValueError(f'UNKNOWN parameter "{key}"')
+                parser.set(sections[0], key, value)
 
             self.git_url = parser.get(section_special, 'Git').strip()
             if not self.git_url:
@@ -780,11 +1217,36 @@ class GlobalSettings:
             self.BuildBK = parser.get(section_build, 'BK').strip()
             self.BuildIC = parser.get(section_build, 'IC').strip()
             self.BuildCrypto = parser.get(section_build, 'Crypto').strip()
+            self.ReferenceBuild = parser.get(section_build, 'ReferenceBuild', fallback='').strip()
+            self.BuildDeltas = parser.get(section_build, 'BuildDeltas', fallback='False').lower() == 'true'
             self.PlaceBuildIntoPatchBK = parser.get(section_build, 'PlaceBuildIntoPatchBK').lower() == 'true'
             self.PlaceBuildIntoPatchIC = parser.get(section_build, 'PlaceBuildIntoPatchIC').lower() == 'true'
             self.ClientEverythingInEXE = parser.get(section_special, 'ClientEverythingInEXE').lower() == 'true'
             self.BuildRTSZIP = parser.get(section_special, 'BuildRTSZIP').lower() == 'true'
             self.BLLVersion = parser.get(section_build, 'BLLVersion').strip()
+            self.LogLevel = parser.get(section_special, 'LogLevel', fallback='DEBUG').strip().upper()
+            if self.LogLevel not in LOG_LEVELS:
+                raise ValueError(f'WRONG LogLevel "{self.LogLevel}", allowed {list(LOG_LEVELS)}')
+
+            # необязательная секция, значение 0 означает "по умолчанию"
+            self.CompilerProcesses = int(parser.get(section_concurrency, 'CompilerProcesses', fallback='0'))
+            self.LicenseSessions = int(parser.get(section_concurrency, 'LicenseSessions', fallback='0'))
+            self.IOWorkers = int(parser.get(section_concurrency, 'IOWorkers', fallback='0'))
+            self.AdaptiveConcurrency = parser.get(section_concurrency, 'Adaptive', fallback='False').lower() == 'true'
+            self.BatchJobs = int(parser.get(section_concurrency, 'BatchJobs', fallback='0'))
+            self.CompileTimeout = int(parser.get(section_compile, 'Timeout', fallback='0'))
+            self.CompileRetries = int(parser.get(section_compile, 'Retries', fallback='0'))
+            self.CProfileStages = \
+                [stage.strip() for stage in parser.get(section_profile, 'CProfile', fallback='').split(',') if stage.strip()]
+            self.TracemallocStages = \
+                [stage.strip() for stage in parser.get(section_profile, 'Tracemalloc', fallback='').split(',') if stage.strip()]
+            self.ServicePort = int(parser.get(section_service, 'Port', fallback='8765'))
+            self.CompareBLSTokens = parser.get(section_compare, 'BLSTokens', fallback='False').lower() == 'true'
+            self.NormalizeText = parser.get(section_compare, 'NormalizeText', fallback='False').lower() == 'true'
+            self.EifDeltas = parser.get(section_compare, 'EifDeltas', fallback='False').lower() == 'true'
+            self.PackageZip = parser.get(section_package, 'Zip', fallback='False').lower() == 'true'
+            self.PackageLevel = int(parser.get(section_package, 'Level', fallback='6'))
+            self.PackageWorkers = int(parser.get(section_package, 'Workers', fallback='0'))
 
             # проверка Labels -----------------------------------
 
@@ -793,9 +1255,11 @@ class GlobalSettings:
                 raise FileNotFoundError(f'NOT FOUND "{self.BuildBK}"')
             if self.BuildIC and not os.path.exists(self.BuildIC):
                 raise FileNotFoundError(f'NOT FOUND "{self.BuildIC}"')
+            if self.ReferenceBuild and not os.path.exists(self.ReferenceBuild):
+                raise FileNotFoundError(f'NOT FOUND "{self.ReferenceBuild}"')
 
         except BaseException as exc:
-            log(f'ERROR when reading settings from file "{ini_filename}":\n\t\t{exc}')
+            log(f'ERROR when reading settings from file "{ini_filename}":\n\t\t{exc}', LOG_ERROR)
 
         else:
             self.__success = True
@@ -812,7 +1276,152 @@ class GlobalSettings:
                 f'Path to additional build files = {self.BuildAdditionalFolders}\n\t'
                 f'Path to build files = {self.BuildBK}\n\t'
                 f'Path to IC build files = {self.BuildIC}\n\t'
-                f'BLL version = {self.BLLVersion}')
+                f'Path to reference build files = {self.ReferenceBuild}\n\t'
+                f'Place build deltas in patch = {self.BuildDeltas}\n\t'
+                f'BLL version = {self.BLLVersion}\n\t'
+                f'Log level = {self.LogLevel}\n\t'
+                f'Compiler processes = {self.CompilerProcesses or "default"}\n\t'
+                f'License server sessions = {self.LicenseSessions or "default"}\n\t'
+                f'I/O workers = {self.IOWorkers or "default"}\n\t'
+                f'Adaptive concurrency = {self.AdaptiveConcurrency}\n\t'
+                f'Batch jobs at once = {self.BatchJobs or "all"}\n\t'
+                f'Compile timeout = {self.CompileTimeout or "none"}\n\t'
+                f'Compile retries = {self.CompileRetries}\n\t'
+                f'cProfile stages = {self.CProfileStages}\n\t'
+                f'tracemalloc stages = {self.TracemallocStages}\n\t'
+                f'Service port = {self.ServicePort}\n\t'
+                f'Compare BLS by tokens = {self.CompareBLSTokens}\n\t'
+                f'Compare normalized text files = {self.NormalizeText}\n\t'
+                f'Place EIF data deltas in patch = {self.EifDeltas}\n\t'
+                f'Package into zip = {self.PackageZip} (level {self.PackageLevel}, '
+                f'workers {self.PackageWorkers or "default"})')
+
+
+# -------------------------------------------------------------------------------------------------
+# Ограничитель числа одновременно используемых ресурсов (процессы компилятора, сессии сервера защиты).
+# В адаптивном режиме лимит уменьшается при росте времени компиляции или числа ошибок
+# и постепенно восстанавливается до максимального, когда ситуация нормализуется.
+class ResourceLimiter:
+    LATENCY_FACTOR = 2.0  # во сколько раз текущее время может превысить базовое до снижения лимита
+    LATENCY_WINDOW = 5  # по скольким последним запускам считается медиана времени (и базовое время после разогрева)
+    ERRORS_WINDOW = 10  # по скольким последним запускам считается доля ошибок
+    ERRORS_RATE = 0.5  # доля ошибок, при которой лимит снижается
+
+    def __init__(self, name, limit, adaptive=False):
+        self.name = name
+        self.max_limit = max(1, limit)
+        self.limit = self.max_limit
+        self.adaptive = adaptive
+        self.in_use = 0
+        self.__condition = threading.Condition()
+        self.__baseline_latency = None
+        self.__latencies = []
+        self.__results = []
+        self.__async_waiters = []  # ожидающие из циклов asyncio: [(loop, future)]
+        self.__busy_seconds = 0.0  # интеграл занятых слотов по времени (для отчета о загрузке)
+        self.__busy_changed = time.perf_counter()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    async def __aenter__(self):
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def acquire(self):
+        with self.__condition:
+            while self.in_use >= self.limit:
+                self.__condition.wait()
+            self.__count_busy()
+            self.in_use += 1
+
+    async def acquire_async(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.__condition:
+                if self.in_use < self.limit:
+                    self.__count_busy()
+                    self.in_use += 1
+                    return
+                waiter = loop.create_future()
+                self.__async_waiters.append((loop, waiter))
+            await waiter
+
+    def release(self):
+        with self.__condition:
+            self.__count_busy()
+            self.in_use -= 1
+            self.__wake_up()
+
+    def __count_busy(self):
+        now = time.perf_counter()
+        self.__busy_seconds += self.in_use * (now - self.__busy_changed)
+        self.__busy_changed = now
+
+    def busy_seconds(self):
+        with self.__condition:
+            self.__count_busy()
+            return self.__busy_seconds
+
+    def __wake_up(self):
+        self.__condition.notify_all()
+        for loop, waiter in self.__async_waiters:
+            loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+        self.__async_waiters = []
+
+    def report(self, latency, success):
+        if not self.adaptive:
+            return
+        with self.__condition:
+            # медиана по скользящему окну: один быстрый или медленный запуск не сдвигает базовое время
+            self.__latencies = (self.__latencies + [latency])[-self.LATENCY_WINDOW:]
+            median_latency = sorted(self.__latencies)[len(self.__latencies) // 2]
+            if len(self.__latencies) == self.LATENCY_WINDOW:
+                # базовое время - медиана первого полного окна (разогрев), затем лучшая из медиан
+                self.__baseline_latency = median_latency if self.__baseline_latency is None \
+                    else min(self.__baseline_latency, median_latency)
+            self.__results = (self.__results + [success])[-self.ERRORS_WINDOW:]
+            errors_rate = self.__results.count(False) / len(self.__results)
+            overloaded = (self.__baseline_latency is not None and
+                          median_latency > self.__baseline_latency * self.LATENCY_FACTOR) or \
+                (len(self.__results) == self.ERRORS_WINDOW and errors_rate >= self.ERRORS_RATE)
+            if overloaded and self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                log(f'\tBACKING OFF {self.name}: limit decreased to {self.limit} '
+                    f'(median {median_latency:.1f}s, baseline {self.__baseline_latency or 0:.1f}s, errors {errors_rate:.0%})',
+                    LOG_WARNING)
+                # начинаем окна заново, чтобы не снижать лимит повторно по старым замерам
+                self.__results = []
+                self.__latencies = []
+            elif success and not overloaded and self.limit < self.max_limit:
+                self.limit += 1
+                self.__wake_up()
+
+
+COMPILER_LIMITER = ResourceLimiter('compiler processes', os.cpu_count() or 1)
+LICENSE_LIMITER = ResourceLimiter('license server sessions', os.cpu_count() or 1)
+
+
+# -------------------------------------------------------------------------------------------------
+def setup_concurrency(settings):
+    global EXECUTOR, COMPILER_LIMITER, LICENSE_LIMITER
+    compiler_processes = settings.CompilerProcesses or os.cpu_count() or 1
+    license_sessions = settings.LicenseSessions or compiler_processes
+    io_workers = settings.IOWorkers or None
+    EXECUTOR.shutdown(wait=True)
+    EXECUTOR = MeasuredThreadPoolExecutor(max_workers=io_workers, thread_name_prefix=THREAD_NAME_PREFIX)
+    COMPILER_LIMITER = ResourceLimiter('compiler processes', compiler_processes, settings.AdaptiveConcurrency)
+    LICENSE_LIMITER = ResourceLimiter('license server sessions', license_sessions, settings.AdaptiveConcurrency)
+    log(f'CONCURRENCY: compiler processes = {compiler_processes}, license server sessions = {license_sessions}, '
+        f'I/O workers = {io_workers or "default"}, adaptive = {settings.AdaptiveConcurrency}')
 
 
 # -------------------------------------------------------------------------------------------------
@@ -841,31 +1450,41 @@ def copy_tree(src, destination, ignore=None):
                         os.path.join(destination, f),
                         ignore)
     else:
-        shutil.copyfile(src, destination)
+        FILES_WRITTEN.add(shutil.copyfile(src, destination))
 
 
 # -------------------------------------------------------------------------------------------------
 def copy_file_or_dir(dir_name, file_name, destination, dirs_allowed=False):
     path = os.path.join(dir_name, file_name)
     if os.path.isfile(path):
-        log(f'\tcopying {path}')
+        log_debug(f'\tcopying {path}')
         make_dirs(destination)
-        shutil.copy2(path, destination)
+        FILES_WRITTEN.add(shutil.copy2(path, destination))
     else:
         if dirs_allowed:  
-            log(f'\tcopying DIR with contents {path}')
+            log_debug(f'\tcopying DIR with contents {path}')
             clean(os.path.join(destination, file_name))
             copy_tree(path, os.path.join(destination, file_name))
         else:
             log(f'\tsomething wrong {path} -> {destination}')
 
+# -------------------------------------------------------------------------------------------------
+# Удаление файла вместе с опустевшими каталогами над ним (до root, не включая его)
+def remove_file_and_empty_dirs(path, root):
+    os.remove(path)
+    path = os.path.dirname(path)
+    while os.path.normcase(path) != os.path.normcase(root) and os.path.isdir(path) and not os.listdir(path):
+        os.rmdir(path)
+        path = os.path.dirname(path)
+
+
 # -------------------------------------------------------------------------------------------------
 def make_dirs(path):
     try:
         if not os.path.exists(path):
-            os.makedirs(path)
+            os.makedirs(path, exist_ok=True)  # каталог может одновременно создавать другой поток
     except BaseException as exc:
-        log(f'\tERROR: can''t create directory "{path}" ({exc})')
+        log(f'\tERROR: can''t create directory "{path}" ({exc})', LOG_ERROR)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -927,31 +1546,37 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=2, bar_lengt
 
 
 # -------------------------------------------------------------------------------------------------
-def copy_files_ex(src_dir, destination_dir, function_to_list_files, wildcards=None, excluded_files=None):
+def copy_files_ex(src_dir, destination_dir, function_to_list_files, wildcards=None, excluded_files=None, only=None):
+    # only - функция (исходный файл) -> bool, отбирающая копируемые файлы
     if wildcards is None:
         wildcards = ['*.*']
     if excluded_files is None:
         excluded_files = []
+    copied = []  # (исходный файл, скопированный файл)
     for wildcard in wildcards:
         files = function_to_list_files(src_dir, wildcard)
         for filename_with_path in files:
             file_name = split_filename(filename_with_path)
             if file_name.lower() not in excluded_files and file_name != '.' and file_name != '..':
+                if only is not None and not only(filename_with_path):
+                    continue
                 make_dirs(destination_dir)
                 try:
-                    shutil.copy2(filename_with_path, destination_dir)
+                    FILES_WRITTEN.add(shutil.copy2(filename_with_path, destination_dir))
+                    copied.append((filename_with_path, os.path.join(destination_dir, file_name)))
                 except BaseException as exc:
-                    log(f'\tERROR: can\'t copy file "{filename_with_path}" to "{destination_dir}" ({exc})')
+                    log(f'\tERROR: can\'t copy file "{filename_with_path}" to "{destination_dir}" ({exc})', LOG_ERROR)
+    return copied
 
 
 # -------------------------------------------------------------------------------------------------
-def copy_files_from_all_subdirectories(src_dir, destination_dir, wildcards=None, excluded_files=None):
-    copy_files_ex(src_dir, destination_dir, list_files_of_all_subdirectories, wildcards, excluded_files)
+def copy_files_from_all_subdirectories(src_dir, destination_dir, wildcards=None, excluded_files=None, only=None):
+    return copy_files_ex(src_dir, destination_dir, list_files_of_all_subdirectories, wildcards, excluded_files, only)
 
 
 # -------------------------------------------------------------------------------------------------
 def copy_files_from_dir(src_dir, destination_dir, wildcards=None, excluded_files=None):
-    copy_files_ex(src_dir, destination_dir, list_files_of_directory, wildcards, excluded_files)
+    return copy_files_ex(src_dir, destination_dir, list_files_of_directory, wildcards, excluded_files)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -968,9 +1593,9 @@ def copy_files_of_version(src_dir, destination_dir, exe_version, wildcards=None,
                 make_dirs(destination_dir)
                 try:
                     if get_binary_platform(filename_with_path) == exe_version:
-                        shutil.copy2(filename_with_path, destination_dir)
+                        FILES_WRITTEN.add(shutil.copy2(filename_with_path, destination_dir))
                 except BaseException as exc:
-                    log(f'\tERROR: can\'t copy file "{filename_with_path}" to "{destination_dir}" ({exc})')
+                    log(f'\tERROR: can\'t copy file "{filename_with_path}" to "{destination_dir}" ({exc})', LOG_ERROR)
 
 
 # -------------------------------------------------------------------------------------------------
@@ -1001,26 +1626,118 @@ def __onerror_handler__(func, path):
     #   raise BaseException(exc_info)
 
 
+# -------------------------------------------------------------------------------------------------
+# Фоновое удаление каталогов: clean() переносит каталог в DIR_TRASH (имя + CLEAN_ASIDE_SUFFIX + номер),
+# после чего каталог с прежним именем сразу свободен, а старое содержимое удаляется в фоновом потоке.
+# DIR_TRASH лежит вне рабочих каталогов, поэтому удаляемое содержимое не попадает в их обход
+# (сравнение, хэши, упаковка), и на том же томе, поэтому перенос - это переименование
+CLEAN_ASIDE_SUFFIX = '.~clean'
+CLEAN_WORKERS = min(8, (os.cpu_count() or 1) * 2)  # потоков удаления файлов одного каталога
+CLEAN_LOCK = threading.Lock()
+CLEAN_COUNTER = [0]
+CLEAN_LEFTOVERS = set()  # остатки прошлых запусков, удаление которых уже запущено
+
+
+def __remove_tree__(path):
+    # Сначала чистим все файлы (параллельно),
+    files = [os.path.join(d, file_name) for d, _, file_names in os.walk(path) for file_name in file_names]
+
+    def remove_files(chunk):
+        for file_path in chunk:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                with contextlib.suppress(OSError):
+                    __onerror_handler__(os.remove, file_path)  # что не удалилось, покажет rmtree
+
+    workers = max(1, min(CLEAN_WORKERS, len(files) // 64))
+    threads = [threading.Thread(target=remove_files, args=(files[i::workers],), name=f'clean_{i}')
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # потом чистим все
+    shutil.rmtree(path, onerror=__onerror_handler__)
+
+
+def __remove_tree_in_background__(path):
+    def run():
+        begin = time.perf_counter()
+        try:
+            __remove_tree__(path)
+            log_debug(f'\tCLEANED {path} in {time.perf_counter() - begin:.1f}s')
+        except BaseException as exc:
+            log(f'\tERROR when cleaning {path} in background ({exc})', LOG_ERROR)
+
+    # поток не daemon: процесс не завершится, пока каталог не удален
+    threading.Thread(target=run, name='clean').start()
+
+
+def __move_aside__(path):
+    if not os.path.relpath(os.path.abspath(path), DIR_TRASH).startswith(os.pardir):
+        return None  # сама корзина и ее содержимое удаляются на месте
+    with CLEAN_LOCK:
+        CLEAN_COUNTER[0] += 1
+        aside = os.path.join(DIR_TRASH,
+                             f'{get_last_element_of_path(path)}{CLEAN_ASIDE_SUFFIX}{os.getpid()}_{CLEAN_COUNTER[0]}')
+    try:
+        os.makedirs(DIR_TRASH, exist_ok=True)
+        os.rename(path, aside)
+    except OSError:
+        return None  # например, открыт файл в каталоге или каталог на другом томе - удаляем на месте
+    return aside
+
+
+# -------------------------------------------------------------------------------------------------
+def clean_leftovers():
+    # остатки фонового удаления, прерванного вместе с процессом (каталоги текущего процесса еще удаляются)
+    own = f'*{CLEAN_ASIDE_SUFFIX}{os.getpid()}_*'
+    try:
+        names = fnmatch.filter(os.listdir(DIR_TRASH), '*' + CLEAN_ASIDE_SUFFIX + '*')
+    except OSError:
+        return
+    for name in names:
+        aside = os.path.join(DIR_TRASH, name)
+        with CLEAN_LOCK:
+            if fnmatch.fnmatch(name, own) or aside in CLEAN_LEFTOVERS or not os.path.isdir(aside):
+                continue
+            CLEAN_LEFTOVERS.add(aside)
+        log(f'CLEANING {aside} left from previous run (in background)')
+        __remove_tree_in_background__(aside)
+
+
 # -------------------------------------------------------------------------------------------------
 def clean(path, masks=None):
+    path = os.path.normpath(path)
+    if not masks:
+        clean_leftovers()
     if os.path.exists(path):
         try:
             if masks:
                 log(f'CLEANING {path} for {masks} files')
-                for mask in masks:
-                    # чистим все файлы по маске mask
-                    [os.remove(os.path.join(d, file_name)) for d, _, files in os.walk(path) for file_name in
-                    fnmatch.filter(files, mask)]
+                # чистим все файлы по всем маскам за один обход
+                for d, _, files in os.walk(path):
+                    matched = set()
+                    for mask in masks:
+                        matched.update(fnmatch.filter(files, mask))
+                    for file_name in matched:
+                        os.remove(os.path.join(d, file_name))
+            elif os.path.isdir(path) and (aside := __move_aside__(path)):
+                log(f'CLEANING {path} (in background)')
+                __remove_tree_in_background__(aside)
+            elif os.path.isdir(path):
+                log(f'CLEANING {path}')
+                __remove_tree__(path)
             else:
                 log(f'CLEANING {path}')
-                # Сначала чистим все файлы,
-                [os.remove(os.path.join(d, file_name)) for d, _, files in os.walk(path) for file_name in files]
-                # потом чистим все
-                shutil.rmtree(path, onerror=__onerror_handler__)
+                os.remove(path)
         except FileNotFoundError:
             pass  # если папка отсутствует, то продолжаем молча
         except BaseException as exc:
-            log(f'\tERROR when cleaning ({exc})')
+            log(f'\tERROR when cleaning ({exc})', LOG_ERROR)
             return False
     return True
 
@@ -1028,6 +1745,12 @@ def clean(path, masks=None):
 # -------------------------------------------------------------------------------------------------
 def download_repo_from_git(git_url, repo_path, tag):
     git_repo = Repo.init(repo_path)
+    mirror_path = GIT_MIRRORS.get(git_url)
+    if mirror_path:
+        # объекты берутся из общего зеркала, а не копируются в каждый репозиторий
+        with open(os.path.join(git_repo.git_dir, 'objects', 'info', 'alternates'), mode='w') as f:
+            f.write(os.path.join(mirror_path, 'objects') + '\n')
+        git_url = mirror_path
     origin = git_repo.create_remote('origin', git_url)
     exists = origin.exists()
     if exists:
@@ -1042,24 +1765,67 @@ def download_repo_from_git(git_url, repo_path, tag):
         return False
 
 
+# -------------------------------------------------------------------------------------------------
+# Переход уже загруженного репозитория на другой тег: загружаются только новые объекты,
+# а при извлечении переписываются только изменившиеся файлы
+def update_repo_from_git(repo_path, tag):
+    git_repo = Repo(repo_path)
+    try:
+        git_repo.remotes.origin.fetch(tags=True, force=True)
+    except BaseException as exc:
+        log(f'\tERROR when fetching into "{repo_path}" ({exc})', LOG_ERROR)
+        return False
+    if tag not in git_repo.tags:
+        log(f'Not found tag "{tag}" in remote tags: {git_repo.tags}')
+        return False
+    git_repo.git.checkout(git_repo.tags[tag])
+    return True
+
+
+# -------------------------------------------------------------------------------------------------
+# Общее зеркало репозитория для заданий пакетного режима: загружается из удаленного репозитория
+# один раз, а задания получают из него только ссылки
+GIT_MIRRORS = {}
+
+
+def update_git_mirror(git_url):
+    mirror_path = os.path.join(DIR_CACHE, 'git', hash_values(git_url)[:16])
+    with trace_span(f'git mirror {git_url}'):
+        if os.path.exists(mirror_path):
+            log(f'UPDATING git mirror "{mirror_path}" from {git_url}')
+            Repo(mirror_path).git.remote('update', '--prune')
+        else:
+            log(f'CLONING git mirror "{mirror_path}" from {git_url}')
+            Repo.clone_from(git_url, mirror_path, mirror=True)
+        try:
+            JIRA_INDEX.update(Repo(mirror_path).git, '--tags')  # тикеты новых коммитов
+        except GitCommandError as exc:
+            log(f'\tWARNING: JIRA INDEX not updated ({exc})', LOG_WARNING)
+    GIT_MIRRORS[git_url] = mirror_path
+    return mirror_path
+
+
 # -------------------------------------------------------------------------------------------------
 def download_git_thread(git_tag_info):
     log(f'Downloading from remote {git_tag_info}')
-    if download_repo_from_git(git_tag_info['git_url'], git_tag_info['local_path'], git_tag_info['git_tag']):
+    with trace_span(f'git download {git_tag_info["git_tag"]}'):
+        downloaded = download_repo_from_git(git_tag_info['git_url'], git_tag_info['local_path'], git_tag_info['git_tag'])
+    if downloaded:
         git_tag = git_tag_info['git_tag']
         log(f'Successfully downloaded tag "{git_tag}"')
         return True
     else:
         git_tag = git_tag_info['git_tag']
-        log(f'Error when tried to download tag "{git_tag}"')
+        log(f'Error when tried to download tag "{git_tag}"', LOG_ERROR)
         return False
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def download_from_git(settings):
     log('GIT DOWNLOAD BEGIN')
-    git_tags_info = [{'git_tag': settings.TagBefore, 'git_url': settings.git_url, 'local_path': DIR_BEFORE},
-                    {'git_tag': settings.TagAfter, 'git_url': settings.git_url, 'local_path': DIR_AFTER}]
+    git_tags_info = [{'git_tag': settings.TagBefore, 'git_url': settings.git_url, 'local_path': JOB.DIR_BEFORE},
+                    {'git_tag': settings.TagAfter, 'git_url': settings.git_url, 'local_path': JOB.DIR_AFTER}]
     futures = []
     for git_tag_info in git_tags_info:
         futures.append(EXECUTOR.submit(download_git_thread, git_tag_info))
@@ -1101,21 +1867,23 @@ def __compare_and_copy_dirs_recursively__(before, after, where_to_copy):
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def compare_directories_before_and_after():
-    if os.path.exists(DIR_BEFORE):
+    if os.path.exists(JOB.DIR_BEFORE):
         log('BEGIN compare directories:')
-        log(f'\tBEFORE: {DIR_BEFORE}')
-        log(f'\tAFTER:  {DIR_AFTER}')
+        log(f'\tBEFORE: {JOB.DIR_BEFORE}')
+        log(f'\tAFTER:  {JOB.DIR_AFTER}')
         begin_time = time.time()
-        __compare_and_copy_dirs_recursively__(DIR_BEFORE, DIR_AFTER, DIR_COMPARED)
+        __compare_and_copy_dirs_recursively__(JOB.DIR_BEFORE, JOB.DIR_AFTER, JOB.DIR_COMPARED)
         log(f'COMPARED for {datetime.timedelta(seconds = time.time()-begin_time)} minutes')
     else:
-        os.rename(DIR_AFTER, DIR_COMPARED)
+        # копируем, а не переносим: из DIR_AFTER затем компилируются BLS
+        copy_tree(JOB.DIR_AFTER, JOB.DIR_COMPARED, shutil.ignore_patterns('.git'))
         log('\tUSING folder "AFTER" as compare result, because "BEFORE" not exists:')
-        log(f'\tBEFORE (not exists): {DIR_BEFORE}')
-        log(f'\tAFTER              : {DIR_AFTER}')
-    if os.path.exists(DIR_COMPARED):
-        log(f'\tFINISHED compare directories. LOOK at {DIR_COMPARED}')
+        log(f'\tBEFORE (not exists): {JOB.DIR_BEFORE}')
+        log(f'\tAFTER              : {JOB.DIR_AFTER}')
+    if os.path.exists(JOB.DIR_COMPARED):
+        log(f'\tFINISHED compare directories. LOOK at {JOB.DIR_COMPARED}')
         return True
     else:
         log('\tFINISHED compare directories. NO CHANGES!!!')
@@ -1123,7 +1891,83 @@ def compare_directories_before_and_after():
 
 
 # -------------------------------------------------------------------------------------------------
-def make_upgrade10_eif_string_for_tables(file_name):
+# Правила нормализации текстовых файлов по расширению (настройка [COMPARE] NormalizeText):
+# encoding - сравнивать текст, а не байты (utf-8 с BOM или без, иначе windows-1251), в XML без атрибута encoding;
+# eol - не различать CRLF, LF и CR; trailing - не различать пробелы и табуляции в конце строк.
+# В RTF переводы строк не значимы, а пробел в конце строки - значим; в YAML и шаблонах значимы концевые пробелы
+TEXT_NORMALIZATION_RULES = {
+    '.rtf': ['eol'],
+    '.xsd': ['encoding', 'eol', 'trailing'],
+    '.xml': ['encoding', 'eol', 'trailing'],
+    '.yaml': ['encoding', 'eol'],
+    '.tpl': ['encoding', 'eol'],
+}
+
+
+def normalize_text(data, rules):
+    if 'encoding' in rules:
+        if data.startswith(codecs.BOM_UTF8):
+            data = data[len(codecs.BOM_UTF8):]
+        # utf-8 проверяется первым: в windows-1251 декодируется почти любая последовательность байт
+        try:
+            text = data.decode('utf-8')
+        except ValueError:
+            text = data.decode('windows-1251', errors='replace')
+        text = re.sub(r'''(<\?xml[^>]*?)\s+encoding\s*=\s*["'][^"']*["']''', r'\1', text, count=1)
+    else:
+        text = data.decode('latin-1')  # байты без изменений
+    if 'eol' in rules:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if 'trailing' in rules:
+        text = re.sub(r'[ \t]+$', '', text, flags=re.MULTILINE)
+    return text
+
+
+# -------------------------------------------------------------------------------------------------
+# Сравнение файла с его версией TagBefore по смыслу, а не по байтам: функция (before, after) -> bool
+# или None, если для файла сравнения по смыслу нет. path - путь от корня репозитория
+def get_file_equivalence(settings, path):
+    path_lower = path.lower()
+    extension = os.path.splitext(path_lower)[1]
+    if settings.CompareBLSTokens and extension == '.bls' and path_lower.startswith('bls' + os.sep):
+        return bls_same_tokens
+    if settings.NormalizeText and extension in TEXT_NORMALIZATION_RULES:
+        rules = TEXT_NORMALIZATION_RULES[extension]
+        return lambda before, after: before == after or normalize_text(before, rules) == normalize_text(after, rules)
+    return None
+
+
+# -------------------------------------------------------------------------------------------------
+# Удаление из DIR_COMPARED файлов, равных по смыслу своей версии TagBefore (get_file_equivalence): BLS, измененных
+# только в комментариях и пробелах, и текстовых файлов, отличающихся только переводами строк или кодировкой.
+# Они не выкладываются в патч, а BLL таких BLS не выкладываются и не перекомпилируются.
+# paths - пути от DIR_COMPARED (по умолчанию все). Возвращает пути удаленных файлов
+@traced
+def drop_equivalent_files(settings, paths=None):
+    if paths is None:
+        paths = [os.path.relpath(path, JOB.DIR_COMPARED) for path in list_files_of_all_subdirectories(JOB.DIR_COMPARED, '*')]
+    dropped = []
+    for path in paths:
+        compared_file, before_file = os.path.join(JOB.DIR_COMPARED, path), os.path.join(JOB.DIR_BEFORE, path)
+        equivalence = get_file_equivalence(settings, path)
+        if not equivalence or not os.path.isfile(compared_file) or not os.path.isfile(before_file):
+            continue
+        with open(before_file, mode='rb') as f:
+            before = f.read()
+        with open(compared_file, mode='rb') as f:
+            after = f.read()
+        if equivalence(before, after):
+            log_debug(f'\tFILE {path} is equivalent to TagBefore, skipped')
+            remove_file_and_empty_dirs(compared_file, JOB.DIR_COMPARED)
+            dropped.append(path)
+    if dropped:
+        log(f'\tSKIPPED {len(dropped)} files equivalent to TagBefore (comments, spaces, line endings, encoding)')
+    return dropped
+
+
+# -------------------------------------------------------------------------------------------------
+# key_fields - ключевые поля таблицы, если в data-файле только новые и измененные записи (eif_make_delta)
+def make_upgrade10_eif_string_for_tables(file_name, key_fields=None):
     file_name_lower = file_name.lower()
 
     # Для дефолтных таблиц и таблиц в памяти
@@ -1199,17 +2043,23 @@ def make_upgrade10_eif_string_for_tables(file_name):
         result = "<{}|{}|'{}'|  ДОЛЖЕН БЫТЬ ВЫЗОВ ua-шки  >"
     elif file_name_lower == 'freedoctype':
         result = "<{}|{}|'{}'|  ДОЛЖЕН БЫТЬ ВЫЗОВ ua-шки  >"
+    elif key_fields:  # дельта: обновление совпадающих по ключу записей и добавление новых
+        result = "<{}|{}|'{}'|TRUE|TRUE|TRUE|TRUE|TRUE|TRUE|'" + ','.join(key_fields) + "'|NULL|NULL|NULL|NULL|'Таблицы'>"
     else:  # Если заливается структура полностью
-        result = "<{}|{}|'{}'|TRUE|TRUE|TRUE|TRUE|FALSE|FALSE|NULL|NULL|NULL|NULL|NULL|'Таблицы'> " \
+        result = UPGRADE10_TABLE_FULL
+    return result
+
+
+UPGRADE10_TABLE_FULL = "<{}|{}|'{}'|TRUE|TRUE|TRUE|TRUE|FALSE|FALSE|NULL|NULL|NULL|NULL|NULL|'Таблицы'> " \
                 "#TODO проверьте способ обновления таблицы, сейчас - заливается полностью. " \
                 "Для дельты и обновления строк: |TRUE|TRUE|TRUE|TRUE|TRUE|TRUE|'название_полей'. " \
                 "Только заменить структуру десятки: |TRUE|FALSE|FALSE|FALSE|TRUE|FALSE|NULL. " \
                 "Заменить структуру и пересоздать: |TRUE|TRUE|FALSE|TRUE|TRUE|FALSE|NULL."
-    return result
 
 
 # -------------------------------------------------------------------------------------------------
-def upgrade10_eif_by_file_name(counter, file_name):
+# delta_tables - {имя таблицы в нижнем регистре: ключевые поля} таблиц, выложенных дельтой
+def upgrade10_eif_by_file_name(counter, file_name, delta_tables=None):
     if file_name.lower() == 'version(14).eif':  # идите на хуй https://jira.bssys.com/browse/GPBDBOPE-18
         return f"  <{counter}|14|'Version'|TRUE|TRUE|FALSE|FALSE|TRUE|TRUE|NULL|NULL|NULL|NULL|NULL|'Конфигурации'> #TODO проверьте настройку\n"
 
@@ -1222,7 +2072,7 @@ def upgrade10_eif_by_file_name(counter, file_name):
             return ''  # пропускаем data-файлы, за них ответят 10-файлы
         file_name = file_name.replace(structure_type_raw, '')
         if structure_type == '10':
-            result = make_upgrade10_eif_string_for_tables(file_name)
+            result = make_upgrade10_eif_string_for_tables(file_name, (delta_tables or {}).get(file_name.lower()))
         elif structure_type == '12':
             result = "<{}|{}|'{}'|TRUE|TRUE|FALSE|TRUE|FALSE|TRUE|NULL|NULL|NULL|NULL|NULL|'Визуальные формы'>"
         elif structure_type == '14':  # идите на хуй https://jira.bssys.com/browse/GPBDBOPE-18
@@ -1263,97 +2113,436 @@ def upgrade10_eif_by_file_name(counter, file_name):
         elif structure_type == '84':
             result = "<{}|{}|'{}'|TRUE|FALSE|FALSE|TRUE|TRUE|TRUE|NULL|NULL|NULL|NULL|NULL|'Статусы'>"
         else:
-            log(f'\tERROR unknown structure type {structure_type} for filename {file_name}')
+            log(f'\tERROR unknown structure type {structure_type} for filename {file_name}', LOG_ERROR)
 
         return '  ' + result.format(counter, structure_type, file_name) + '\n'
     else:
-        log(f'\tERROR can not detect structure type by filename ({file_name})')
+        log(f'\tERROR can not detect structure type by filename ({file_name})', LOG_ERROR)
+
+
+# -------------------------------------------------------------------------------------------------
+# Опись EIF-файлов экземпляра: файлы по типу структуры ('10', '12', 'data' и т.д.) и имени таблицы.
+# Строится одним обходом результата сравнения (или по плану) и пополняется по ходу сборки,
+# поэтому шаги формирования Upgrade(10).eif не обходят каталоги заново
+EIF_FILE_NAME_PATTERN = re.compile(r'(.*)\((\d+|data)\)\.eif$', flags=re.IGNORECASE)
+
+
+class EifInventory:
+    def __init__(self, eif_files=()):
+        self.files = set()
+        self.by_type = {}  # {тип структуры в нижнем регистре: {имя таблицы в нижнем регистре: [пути]}}
+        for path in eif_files:
+            self.add(path)
+
+    def add(self, path):
+        if path in self.files:
+            return
+        self.files.add(path)
+        match = EIF_FILE_NAME_PATTERN.match(os.path.basename(path))
+        if match:
+            tables = self.by_type.setdefault(match.group(2).lower(), {})
+            tables.setdefault(match.group(1).lower(), []).append(path)
+
+    def remove(self, path):
+        self.files.discard(path)
+        match = EIF_FILE_NAME_PATTERN.match(os.path.basename(path))
+        if match:
+            paths = self.by_type.get(match.group(2).lower(), {}).get(match.group(1).lower(), [])
+            if path in paths:
+                paths.remove(path)
+
+    def get(self, structure_type, table_name):
+        return self.by_type.get(structure_type, {}).get(table_name.lower(), [])
+
+    def of_type(self, structure_type):
+        return sorted((path for paths in self.by_type.get(structure_type, {}).values() for path in paths),
+                      key=eif_sort_key)
+
+    # имена файлов, как в каталоге патча после upgrade10_eif (файлы всех подкаталогов складываются в один)
+    def file_names(self):
+        return sorted({os.path.basename(path) for path in self.files}, key=eif_sort_key)
+
+
+# Порядок без учета регистра, как в каталоге Windows: от регистра имен в Git порядок таблиц в Upgrade(10).eif
+# не зависит (при равенстве без учета регистра - по имени, чтобы порядок был однозначным)
+def eif_sort_key(path):
+    return path.casefold(), path
+
+
+def get_eif_inventory(instance):
+    return EifInventory(list_files_of_all_subdirectories(dir_compared_base(instance), '*.eif'))
+
+
+def get_eif_inventories():
+    return {instance: get_eif_inventory(instance) for instance in [INSTANCE_BANK, INSTANCE_CLIENT, INSTANCE_CLIENT_MBA]}
+
+
+# -------------------------------------------------------------------------------------------------
+@traced
+def copy_table_10_files_for_data_files(instance, inventory):
+    for source_path, eif10_file in get_table_10_files_for_data_files(instance, inventory):
+        log_debug(f'COPYING {source_path} to {eif10_file}')
+        for _, copied_file in copy_files_from_dir(os.path.dirname(source_path), os.path.dirname(eif10_file),
+                                                  [os.path.basename(source_path)]):
+            inventory.add(copied_file)
+
+
+# (10).eif для data-файлов, структура которых не менялась: [(путь в TagAfter, путь в результате сравнения)].
+# Общее для сборки (copy_table_10_files_for_data_files) и планирования (plan_upgrade10_eif)
+def get_table_10_files_for_data_files(instance, inventory):
+    source_dir = dir_after_base_tables(instance)
+    dest_dir = os.path.join(dir_compared_base(instance), 'TABLES')
+    result = []
+    for eif_file in inventory.of_type('data'):
+        # для data-файла нужна структура таблицы, даже если она не менялась
+        table_name = eif_table_name(eif_file)
+        if not inventory.get('10', table_name):
+            eif10_file = f'{table_name}(10).eif'
+            result.append((os.path.join(source_dir, eif10_file), os.path.join(dest_dir, eif10_file)))
+    return result
 
 
 # -------------------------------------------------------------------------------------------------
-def copy_table_10_files_for_data_files(instance):
-    eif_list = list_files_of_all_subdirectories(dir_compared_base(instance), "*.eif")
-    for eif_file in eif_list:
-        # проверим соответствует ли название файла формату "*(data).eif"
-        file_type_match = re.findall(r'\(data\)\.eif', eif_file, flags=re.IGNORECASE)
-        if len(file_type_match):
-            eif10_file = str(eif_file).replace(file_type_match[0], '(10).eif')
-            # отрежем путь (splitfilename не пашет, если файла нет)
-            eif10_file = get_last_element_of_path(eif10_file)
-            # и проверим есть ли файл eif10_file в списке файлов eif_list
-            exists = [file1 for file1 in eif_list if re.search(re.escape(eif10_file), file1)]
-            if not exists:
-                source_dir = os.path.join(dir_after_base(instance), 'TABLES')
-                dest_dir = os.path.join(dir_compared_base(instance), 'TABLES')
-                log(f'COPYING {eif10_file} from {source_dir} to {dest_dir}')
-                copy_files_from_dir(source_dir, dest_dir, [eif10_file])
+# Разбор EIF: [SECTION] заголовок [DATA] [FIELDS] поля [RECORDS] <значение|'строка'|...> [END].
+# Работает с байтами или с отображенным в память файлом (eif_open): в памяти держатся только смещения
+# секций и записей, а сами записи читаются из файла по мере надобности. Кодировка файла не важна
+@contextlib.contextmanager
+def eif_open(path):
+    with open(path, mode='rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''  # пустой файл не отображается
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+
+def eif_lines(data):
+    position = 0
+    while position < len(data):
+        end = data.find(b'\n', position)
+        end = len(data) if end < 0 else end + 1
+        yield position, end, data[position:end].rstrip(b'\r\n')
+        position = end
 
 
 # -------------------------------------------------------------------------------------------------
-def upgrade10_ua_bls_files(instance, counter, lines):
-    mask = ''
-    if instance==INSTANCE_BANK:
-        mask = 'u[ab]*.bls'
-    elif instance in [INSTANCE_CLIENT, INSTANCE_CLIENT_MBA]:
-        mask = 'u[ac]*.bls'
-    else: 
-        raise(f'Unknown instance {instance}')
+# Индекс секций за один проход: [{'begin', 'end', 'header': {ключ: значение}, 'fields': [поля],
+# 'records_begin', 'records_end', 'records': array смещений начала записей}]. Запись продолжается до начала
+# следующей (или до records_end) и может занимать несколько строк, если в строковом значении есть перевод строки
+def eif_index(data):
+    sections = []
+    section = None
+    block = b''
+    in_record = in_quotes = False
+    for start, end, line in eif_lines(data):
+        stripped = line.strip()
+        if section is not None:
+            section['end'] = end
+        if not in_record:
+            if stripped.startswith(b'['):
+                block = stripped
+                if block == b'[SECTION]':
+                    section = {'begin': start, 'end': end, 'header': {}, 'fields': [],
+                            'records_begin': None, 'records_end': None, 'records': array.array('Q')}
+                    sections.append(section)
+                elif block == b'[RECORDS]' and section is not None:
+                    section['records_begin'] = section['records_end'] = end
+                continue
+            if section is None or not stripped:
+                continue
+            if block == b'[SECTION]':
+                key, _, value = stripped.decode('windows-1251', errors='replace').partition('=')
+                section['header'][key.strip()] = value.strip()
+                continue
+            if block == b'[FIELDS]':
+                section['fields'].append(stripped.decode('windows-1251', errors='replace'))
+                continue
+            if block != b'[RECORDS]' or not stripped.startswith(b'<'):
+                continue
+            section['records'].append(start)
+        in_quotes ^= line.count(b"'") % 2 == 1
+        in_record = in_quotes or not stripped.endswith(b'>')
+        section['records_end'] = end
+    return sections
+
+
+# Границы записей секции: (начало, конец)
+def eif_record_spans(section):
+    records = section['records']
+    for number, start in enumerate(records):
+        yield start, records[number + 1] if number + 1 < len(records) else section['records_end']
+
+
+# Секция data-файла с записями. None, если в файле не одна секция или в ней нет [RECORDS]
+def eif_parse_table(data):
+    sections = eif_index(data)
+    if len(sections) != 1 or sections[0]['records_begin'] is None:
+        return None
+    return sections[0]
+
+
+# -------------------------------------------------------------------------------------------------
+# Значения записи <a|'b'|c>; кавычка внутри строки удваивается, поэтому '|' внутри строки - там,
+# где перед ним нечетное число кавычек
+def eif_split_record(record):
+    body = record.strip()[1:-1]
+    if b"'" not in body:
+        return body.split(b'|')
+    values = []
+    for part in body.split(b'|'):
+        if values and values[-1].count(b"'") % 2:
+            values[-1] += b'|' + part
+        else:
+            values.append(part)
+    return values
+
+
+# Поиск записей по ключу: {(значения ключевых полей): (начало, конец)}. None при повторе ключа
+# или записи с другим числом полей
+def eif_record_index(data, section, key_fields):
+    fields = [field.lower() for field in section['fields']]
+    if not all(key_field.lower() in fields for key_field in key_fields):
+        return None
+    key_indexes = [fields.index(key_field.lower()) for key_field in key_fields]
+    records = {}
+    for start, end in eif_record_spans(section):
+        values = eif_split_record(data[start:end])
+        if len(values) != len(fields):
+            return None
+        key = tuple(values[index] for index in key_indexes)
+        if key in records:
+            return None
+        records[key] = (start, end)
+    return records
+
+
+# -------------------------------------------------------------------------------------------------
+# Ключевые поля таблицы из [TREE] структуры (10): первичный индекс, иначе первый уникальный
+def eif_get_key_fields(data):
+    indexes = []
+    in_tree = in_indexes = in_fields = False
+    for _, _, line in eif_lines(data):
+        stripped = line.strip()
+        indent = len(line) - len(line.lstrip())
+        if stripped.startswith(b'['):
+            in_tree = stripped == b'[TREE]'
+            continue
+        if not in_tree or not stripped:
+            continue
+        if indent <= 2:
+            in_indexes = stripped == b'Indexes'
+        elif in_indexes and indent == 4:
+            indexes.append({'fields': [], 'primary': False, 'unique': False})
+            in_fields = False
+        elif in_indexes and indexes and indent == 6:
+            in_fields = stripped == b'Fields'
+            name, _, value = stripped.partition(b'=')
+            flag = name.split(b':')[0].strip().lower().decode('latin-1')
+            if flag in ['primary', 'unique']:
+                indexes[-1][flag] = value.strip().upper() == b'TRUE'
+        elif in_indexes and indexes and in_fields and indent == 8:
+            name, _, order = stripped.partition(b'=')
+            try:
+                indexes[-1]['fields'].append((int(order), name.split(b':')[0].strip().decode('latin-1')))
+            except ValueError:
+                return []
+    for kind in ['primary', 'unique']:
+        for index in indexes:
+            if index[kind] and index['fields']:
+                return [name for _, name in sorted(index['fields'])]
+    return []
+
+
+# -------------------------------------------------------------------------------------------------
+# Дельта data-файла: заголовок и окончание файла after и только новые и измененные (по ключевым полям)
+# записи в виде списка диапазонов after [(начало, конец)]. Записи сравниваются по смещениям без загрузки
+# файлов целиком. None, если дельта невозможна (другие поля, повтор ключа, удаленные записи) или не меньше файла
+def eif_make_delta(before, after, key_fields):
+    before_table, after_table = eif_parse_table(before), eif_parse_table(after)
+    if not before_table or not after_table or before_table['fields'] != after_table['fields']:
+        return None
+    before_records = eif_record_index(before, before_table, key_fields)
+    after_records = eif_record_index(after, after_table, key_fields)
+    # удалить запись дельтой нельзя, такая таблица заливается полностью
+    if before_records is None or after_records is None or before_records.keys() - after_records.keys():
+        return None
+    ranges = [(0, after_table['records_begin'])]
+    for key, (start, end) in after_records.items():
+        if key not in before_records or before[slice(*before_records[key])].strip() != after[start:end].strip():
+            ranges.append((start, end))
+    if len(ranges) - 1 == len(after_records):
+        return None
+    ranges.append((after_table['records_end'], len(after)))
+    return ranges
+
+
+def eif_ranges_size(ranges):
+    return sum(end - start for start, end in ranges)
+
+
+# -------------------------------------------------------------------------------------------------
+# Ключевые поля таблицы, если ее data-файл можно выложить дельтой: таблица заливается по умолчанию
+# (UPGRADE10_TABLE_FULL), а в структуре (10) есть первичный или уникальный индекс
+def eif_delta_key_fields(table_name, structure_file):
+    if not eif_delta_allowed(table_name) or not os.path.isfile(structure_file):
+        return []
+    with eif_open(structure_file) as data:
+        return eif_get_key_fields(data)
+
+
+# Таблицы CONTROL* всегда выкладываются целиком: uaControls.bll (BackUpControls/SetupControls/RestoreControls)
+# пересобирает настройки по полному содержимому таблиц
+EIF_DELTA_EXCLUDED_TABLES = ['controlgroups', 'controlsettings', 'controlconstants']
+
+
+def eif_delta_allowed(table_name):
+    return table_name.lower() not in EIF_DELTA_EXCLUDED_TABLES and eif_upgrade_is_default(table_name)
+
+
+def eif_upgrade_is_default(table_name):
+    return make_upgrade10_eif_string_for_tables(table_name) == UPGRADE10_TABLE_FULL
+
+
+def eif_table_name(file_name):
+    return re.sub(r'\((?:\d+|data)\)\.eif$', '', get_last_element_of_path(file_name), flags=re.IGNORECASE)
 
-    ua_bls_list = list_files_of_all_subdirectories(dir_compared_bls(), mask)
+
+# -------------------------------------------------------------------------------------------------
+# Замена измененных data-файлов в DIR_COMPARED их дельтами (настройка [COMPARE] EifDeltas).
+# paths - пути от DIR_COMPARED (по умолчанию все)
+@traced
+def make_eif_deltas(paths=None):
+    if paths is None:
+        paths = [os.path.relpath(path, JOB.DIR_COMPARED) for path in
+                list_files_of_all_subdirectories(os.path.join(JOB.DIR_COMPARED, 'BASE'), '*(data).eif')]
+    for path in paths:
+        parts = path.split(os.sep)
+        compared_file, before_file = os.path.join(JOB.DIR_COMPARED, path), os.path.join(JOB.DIR_BEFORE, path)
+        if len(parts) < 3 or parts[0] != 'BASE' or not fnmatch.fnmatch(parts[-1], '*(data).eif') or \
+                not os.path.isfile(compared_file) or not os.path.isfile(before_file):
+            continue
+        table_name = eif_table_name(path)
+        key_fields = eif_delta_key_fields(table_name, os.path.join(dir_after_base_tables(parts[1]), f'{table_name}(10).eif'))
+        if not key_fields:
+            continue
+        # дельта пишется рядом и заменяет файл после того, как он перестанет быть отображен в память
+        delta_file = compared_file + '.delta'
+        with eif_open(before_file) as before, eif_open(compared_file) as after:
+            ranges = eif_make_delta(before, after, key_fields)
+            if ranges is not None:
+                log(f'\tEIF DELTA {path} by {key_fields}: {eif_ranges_size(ranges)} of {len(after)} bytes')
+                with open(delta_file, mode='wb') as f:
+                    for start, end in ranges:
+                        f.write(after[start:end])
+                FILES_WRITTEN.add(delta_file)
+        if ranges is not None:
+            os.replace(delta_file, compared_file)
+
+
+# -------------------------------------------------------------------------------------------------
+# Таблицы экземпляра, data-файлы которых выложены дельтой: {имя в нижнем регистре: ключевые поля}.
+# Дельта отличается от файла TagAfter, полный data-файл совпадает с ним
+def eif_delta_tables(instance, inventory):
+    delta_tables = {}
+    for compared_file in inventory.of_type('data'):
+        after_file = os.path.join(JOB.DIR_AFTER, os.path.relpath(compared_file, JOB.DIR_COMPARED))
+        if os.path.isfile(after_file) and not filecmp.cmp(compared_file, after_file, shallow=False):
+            table_name = eif_table_name(compared_file)
+            key_fields = eif_delta_key_fields(table_name, os.path.join(dir_after_base_tables(instance),
+                                                                    f'{table_name}(10).eif'))
+            if key_fields:
+                delta_tables[table_name.lower()] = key_fields
+    return delta_tables
+
+
+# -------------------------------------------------------------------------------------------------
+# Удаление (10).eif, добавленных copy_table_10_files_for_data_files: в отличие от настоящих результатов
+# сравнения они совпадают с файлами TagBefore
+def remove_table_10_files_for_data_files(instance, inventory):
+    tables_dir = os.path.join(dir_compared_base(instance), 'TABLES')
+    for eif10_file in inventory.of_type('10'):
+        if os.path.relpath(eif10_file, tables_dir).startswith(os.pardir):
+            continue
+        before_file = os.path.join(JOB.DIR_BEFORE, os.path.relpath(eif10_file, JOB.DIR_COMPARED))
+        if os.path.isfile(before_file) and filecmp.cmp(before_file, eif10_file, shallow=False):
+            remove_file_and_empty_dirs(eif10_file, JOB.DIR_COMPARED)
+            inventory.remove(eif10_file)
+
+
+# -------------------------------------------------------------------------------------------------
+def upgrade10_ua_bls_files(instance, counter, lines, ua_bls_list, read_exports):
     for file_path in ua_bls_list:
         file_name = split_filename(file_path).lower()
         if file_name not in ['ualib.bls', 'uacontrols.bls', 'uacustjb.bls']:
-            exports = bls_get_exports(file_path)
+            exports = read_exports(file_path)
             for function_name in exports:
                 bll_file_name = replace_ext(file_name, '.bll')
-                log(f'ADDING to {instance} launch {bll_file_name}.{function_name} launch in upgrade(10).eif')
-                lines.append(f"  <{counter}|200|NULL|TRUE|FALSE|TRUE|NULL|NULL|NULL|NULL|'{function_name}'|NULL|'{bll_file_name}'|NULL|'Запуск {function_name}({bll_file_name})'>\n")
+                log_debug(f'ADDING to {instance} launch {bll_file_name}.{function_name} launch in upgrade(10).eif')
+                lines.append(upgrade10_launch_line(counter, function_name, bll_file_name))
                 counter += 1
     return counter
 
 
+def upgrade10_ua_bls_mask(instance):
+    if instance == INSTANCE_BANK:
+        return 'u[ab]*.bls'
+    elif instance in [INSTANCE_CLIENT, INSTANCE_CLIENT_MBA]:
+        return 'u[ac]*.bls'
+    raise ValueError(f'Unknown instance {instance}')
+
+
+def upgrade10_launch_line(counter, function_name, bll_file_name):
+    return f"  <{counter}|200|NULL|TRUE|FALSE|TRUE|NULL|NULL|NULL|NULL|'{function_name}'|NULL|'{bll_file_name}'|NULL|'Запуск {function_name}({bll_file_name})'>\n"
+
+
+def upgrade10_controls_lines(counter, lines):
+    lines.append(f"  <{counter}|200|NULL|TRUE|FALSE|TRUE|NULL|NULL|NULL|NULL|'BackUpControls'|NULL|'uaControls.BLL'|NULL|'Запуск BackUpControls(uaControls)'>\n")
+    counter += 1
+    lines.append(f"  <{counter}|200|NULL|TRUE|FALSE|TRUE|NULL|NULL|NULL|NULL|'SetupControls'|NULL|'uaControls.bll'|NULL|'Запуск SetupControls(uaControls)'>\n")
+    counter += 1
+    lines.append(f"  <{counter}|200|NULL|FALSE|TRUE|TRUE|NULL|NULL|NULL|NULL|'RestoreControls'|NULL|'uaControls.bll'|NULL|'Запуск RestoreControls(uaControls)'>\n")
+    return counter
+
+
 # -------------------------------------------------------------------------------------------------
-def upgrade10_controls(instance, counter, lines):
+# Файлы CONTROL*, которые надо доложить в каталог DATA патча: [(каталог TagAfter, [маски])].
+# Общее для сборки (upgrade10_eif) и планирования (plan_upgrade10_eif)
+def get_upgrade10_controls_copies(instance, inventory):
     dir_tables = dir_after_base_tables(instance)
     dir_data = dir_after_base_tabledata_config(instance)
-    patch_data_dir = dir_patch_data(instance)
-    control_groups = list_files_of_all_subdirectories(dir_compared_base(instance), 'CONTROLGROUPS(data).eif')
-    control_constants = list_files_of_all_subdirectories(dir_compared_base(instance), 'CONTROLCONSTANTS(data).eif')
-    control_settings = list_files_of_all_subdirectories(dir_compared_base(instance), 'CONTROLSETTINGS(data).eif')
+    control_groups = inventory.get('data', 'CONTROLGROUPS')
+    control_constants = inventory.get('data', 'CONTROLCONSTANTS')
+    control_settings = inventory.get('data', 'CONTROLSETTINGS')
+    copies = []
 
     if len(control_settings) or len(control_constants):
-        copy_files_from_dir(dir_tables, patch_data_dir, ['CONTROLGROUPS(10).eif'])
+        copies.append((dir_tables, ['CONTROLGROUPS(10).eif']))
         if not len(control_groups):
-            copy_files_from_dir(dir_data, patch_data_dir, ['CONTROLGROUPS(data).eif'])
+            copies.append((dir_data, ['CONTROLGROUPS(data).eif']))
 
     if len(control_settings):
-        copy_files_from_dir(dir_tables, patch_data_dir, ['CONTROLSETTINGS(10).eif', 'CONTROLCONSTANTS(10).eif'])
+        copies.append((dir_tables, ['CONTROLSETTINGS(10).eif', 'CONTROLCONSTANTS(10).eif']))
         if not(control_constants):
-            copy_files_from_dir(dir_data, patch_data_dir, ['CONTROLCONSTANTS(data).eif'])
+            copies.append((dir_data, ['CONTROLCONSTANTS(data).eif']))
     elif len(control_constants):
-        copy_files_from_dir(dir_tables, patch_data_dir, ['CONTROLSETTINGS(10).eif', 'CONTROLCONSTANTS(10).eif'])
-        if not len(control_settings):
-            copy_files_from_dir(dir_data, patch_data_dir, ['CONTROLSETTINGS(data).eif'])
+        copies.append((dir_tables, ['CONTROLSETTINGS(10).eif', 'CONTROLCONSTANTS(10).eif']))
+        copies.append((dir_data, ['CONTROLSETTINGS(data).eif']))
+
+    return copies
 
-    if len(control_settings) or len(control_constants):
-        lines.append(f"  <{counter}|200|NULL|TRUE|FALSE|TRUE|NULL|NULL|NULL|NULL|'BackUpControls'|NULL|'uaControls.BLL'|NULL|'Запуск BackUpControls(uaControls)'>\n")
-        counter += 1
-        lines.append(f"  <{counter}|200|NULL|TRUE|FALSE|TRUE|NULL|NULL|NULL|NULL|'SetupControls'|NULL|'uaControls.bll'|NULL|'Запуск SetupControls(uaControls)'>\n")
-        counter += 1
-        lines.append(f"  <{counter}|200|NULL|FALSE|TRUE|TRUE|NULL|NULL|NULL|NULL|'RestoreControls'|NULL|'uaControls.bll'|NULL|'Запуск RestoreControls(uaControls)'>\n")
 
+def upgrade10_controls(counter, lines, inventory):
+    if len(inventory.get('data', 'CONTROLSETTINGS')) or len(inventory.get('data', 'CONTROLCONSTANTS')):
+        counter = upgrade10_controls_lines(counter, lines)
     return counter
 
 
 # -------------------------------------------------------------------------------------------------
-def upgrade10_db_structures(instance, counter, lines):
+def upgrade10_db_structures(counter, lines, inventory, delta_tables):
     lines.append(upgrade10_eif_by_file_name(counter, 'Version(14).eif'))
     counter += 1
-    patch_data_dir = dir_patch_data(instance)
-    eif_list = list_files_of_all_subdirectories(patch_data_dir, '*.eif')
-    for eif_file in eif_list:
-        eif_file_name = split_filename(eif_file)
-        line = upgrade10_eif_by_file_name(counter, eif_file_name)
+    for eif_file_name in inventory.file_names():
+        line = upgrade10_eif_by_file_name(counter, eif_file_name, delta_tables)
         if line:
             lines.append(line)
             counter += 1
@@ -1361,31 +2550,43 @@ def upgrade10_db_structures(instance, counter, lines):
 
 
 # -------------------------------------------------------------------------------------------------
-def upgrade10_react_build(instance, counter, lines):
+def upgrade10_react_build(instance, counter, lines, react_exists):
     if instance==INSTANCE_BANK:
-        if os.path.exists(DIR_COMPARED_WWW_react):
+        if react_exists:
             lines.append('  TODO: НУЖНА СБОРКА РЕДИЗАЙНА!!!\n')
             counter +=1
     return counter
 
 
 # -------------------------------------------------------------------------------------------------
-def upgrade10_eif(instance):
+@traced
+def upgrade10_eif(instance, inventory, read_exports):
     patch_data_dir = dir_patch_data(instance)
     make_dirs(patch_data_dir)
     copy_files_from_all_subdirectories(dir_compared_base(instance), patch_data_dir, ['*.eif'])
-    
+    for source_dir, masks in get_upgrade10_controls_copies(instance, inventory):
+        copy_files_from_dir(source_dir, patch_data_dir, masks)
+
+    ua_bls_list = list_files_of_all_subdirectories(dir_compared_bls(), upgrade10_ua_bls_mask(instance))
+    text = get_upgrade10_eif_text(instance, inventory, ua_bls_list, read_exports,
+                                  eif_delta_tables(instance, inventory), os.path.exists(JOB.DIR_COMPARED_WWW_react))
+    with open(get_filename_upgrade10_eif(instance), mode='w') as f:
+        f.write(text)
+    FILES_WRITTEN.add()
+
+
+# Текст Upgrade(10).eif. Общее для сборки (upgrade10_eif) и планирования (plan_upgrade10_eif):
+# inventory - опись EIF результата сравнения, ua_bls_list - ua*.bls экземпляра,
+# delta_tables - таблицы, выложенные дельтой (eif_delta_tables), react_exists - есть ли изменения редизайна
+def get_upgrade10_eif_text(instance, inventory, ua_bls_list, read_exports, delta_tables, react_exists):
     lines = []
     lines.append(UPGRADE10_HEADER)
     counter = 1
-    counter = upgrade10_db_structures(instance, counter, lines)
-    counter = upgrade10_ua_bls_files(instance, counter, lines)
-    counter = upgrade10_controls(instance, counter, lines)
-    counter = upgrade10_react_build(instance, counter, lines)
-
-    with open(get_filename_upgrade10_eif(instance), mode='w') as f:
-        f.writelines(lines)
-        f.writelines(UPGRADE10_FOOTER)
+    counter = upgrade10_db_structures(counter, lines, inventory, delta_tables)
+    counter = upgrade10_ua_bls_files(instance, counter, lines, ua_bls_list, read_exports)
+    counter = upgrade10_controls(counter, lines, inventory)
+    counter = upgrade10_react_build(instance, counter, lines, react_exists)
+    return ''.join(lines) + UPGRADE10_FOOTER
 
 
 # -------------------------------------------------------------------------------------------------
@@ -1448,8 +2649,17 @@ def get_binary_platform(full_file_path):
 
 # -------------------------------------------------------------------------------------------------
 def __get_exe_file_info__(full_file_path):
+    # версия читается из всего файла, поэтому запоминаем ее для файла с тем же размером и датой
+    try:
+        stat = os.stat(full_file_path)
+    except OSError:
+        return None
+    return __read_exe_file_info__(full_file_path, stat.st_size, stat.st_mtime)
+
+
+@functools.lru_cache(maxsize=None)
+def __read_exe_file_info__(full_file_path, size, mtime):
     # http://windowssdk.msdn.microsoft.com/en-us/library/ms646997.aspx
-    sig = struct.pack("32s", u"VS_VERSION_INFO".encode("utf-16-le"))
     # This pulls the whole file into memory, so not very feasible for
     # large binaries.
     try:
@@ -1457,6 +2667,11 @@ def __get_exe_file_info__(full_file_path):
             file_data = f.read()
     except IOError or FileNotFoundError:
         return None
+    return __get_version_from_pe_data__(file_data)
+
+
+def __get_version_from_pe_data__(file_data):
+    sig = struct.pack("32s", u"VS_VERSION_INFO".encode("utf-16-le"))
     offset = file_data.find(sig)
     if offset == -1:
         return None
@@ -1469,15 +2684,16 @@ def __get_exe_file_info__(full_file_path):
 
 
 # -------------------------------------------------------------------------------------------------
+BUILD_VERSION_FILES = ['cbank.exe', 'BRHelper.exe', 'cryptlib2x.dll', 'npBSSPlugin.dll', 'CryptLib.dll']  # по порядку
+
+
 def extract_build_version(build_path):
     result = 'unknown'
     try:
         if os.path.exists(build_path):
-            files = list_files_of_all_subdirectories(build_path, 'cbank.exe')
-            files += list_files_of_all_subdirectories(build_path, 'BRHelper.exe')
-            files += list_files_of_all_subdirectories(build_path, 'cryptlib2x.dll')
-            files += list_files_of_all_subdirectories(build_path, 'npBSSPlugin.dll')
-            files += list_files_of_all_subdirectories(build_path, 'CryptLib.dll')
+            files = []
+            for version_file in BUILD_VERSION_FILES:
+                files += list_files_of_all_subdirectories(build_path, version_file)
             for f in files:
                 ver = None
                 try:
@@ -1490,7 +2706,7 @@ def extract_build_version(build_path):
                     break
 
     except BaseException as exc:
-        log(f'\tERROR: can not detect version of build ({exc})')
+        log(f'\tERROR: can not detect version of build ({exc})', LOG_ERROR)
         raise e
     return result
 
@@ -1510,7 +2726,7 @@ def open_encoding_aware(path):
                 return fh
         return None
     except BaseException as exc:
-        log(f'ERROR WHEN OPENING FILE {path} -> {exc}')
+        log(f'ERROR WHEN OPENING FILE {path} -> {exc}', LOG_ERROR)
         return None
 
 
@@ -1533,221 +2749,403 @@ def replace_unwanted_symbols(text):
     
 
 # -------------------------------------------------------------------------------------------------
-def bls_get_exports(file_name):
-    with open_encoding_aware(file_name) as f:
-        if f:
-            text = replace_unwanted_symbols(f.read())
-            # находим текст между словом "exports" и ближайшей точкой с запятой
-            return [fn.strip() for fn in re.findall(r'(?s)(?<=\bexports\s)(.*?)(?=;)', text, flags=re.IGNORECASE)]
+# Лексемы BLS без комментариев и пробелов: правка только в них не меняет смысла исходника.
+# В отличие от replace_unwanted_symbols, скобки внутри строк комментарием не считаются, а директивы
+# компилятора {$...} и (*$...*) остаются лексемами. Разбираются байты, поэтому кодировка файла не важна
+BLS_TOKEN_PATTERN = re.compile(rb"""(?P<skip>\s+|\{(?!\$)[\s\S]*?\}|\(\*(?!\$)[\s\S]*?\*\)|//[^\r\n]*)|"""
+                               rb"""(?:'[^'\r\n]*')+|\{\$[\s\S]*?\}|\(\*\$[\s\S]*?\*\)|"""
+                               rb"""[\w\x80-\xff]+|:=|<=|>=|<>|\.\.|\S""")
 
 
-# -------------------------------------------------------------------------------------------------
-def bls_get_uses_graph(file_dir, file_name, compiling_now_list, compiled_list, bls_uses_graph):
-    path = os.path.join(file_dir, file_name)
-    with COMPILING_NOW_CONDITION:
-        while file_compiling_now(file_name, compiling_now_list):
-            COMPILING_NOW_CONDITION.wait()
-    if file_compiled(file_name, compiled_list):
-            return # если файл уже откомпилирован 
-    
-    with open_encoding_aware(path) as f:
-        if f:
-            text = replace_unwanted_symbols(f.read())
-            # находим текст между словом "uses" и ближайшей точкой с запятой
-            list_of_uses = re.findall(r'(?s)(?<=\buses\s)(.*?)(?=;)', text, flags=re.IGNORECASE)
-            
-            # добавляем пустой элемент для файла "file_name", на случай, если файл не имеет uses
-            bls_uses_graph.update({file_name: [path, []]})
-
-            if len(list_of_uses):
-                for text_of_uses in list_of_uses:
-                    # разбиваем найденный текст на части между запятыми
-                    uses_list = [line.strip().lower() + '.bls' for line in text_of_uses.split(',') if line.strip()]
-                    if uses_list:
-                        # проверим, что такой файл еще не был обработан
-
-                        item_already_in_list = bls_uses_graph.get(file_name)
-                        # если элемент с названием "file_name" уже есть в списке bls_uses_graph
-                        if item_already_in_list:
-                            # то дополним его [список_зависимостей] списком "uses_list"
-                            item_already_in_list[1].extend(uses_list)
-                        else:
-                            # TODO: ЭТА ВЕТКА НЕ НУЖНА, НАДО УДАЛИТЬ (ВЫШЕ УЖЕ ДОБАВЛЯЮ ПУСТОЙ ЭЛЕМЕНТ)
-                            # если файла нет в списке зависимостей,
-                            # то добавим "{название_файла: [полное_название_с_путем, [список_зависимостей]]}"
-                            # bls_uses_graph.update({file_name: [file_name, uses_list]})
-                            pass
-                        
-                        for uses_item in uses_list:
-                            item_already_in_list = bls_uses_graph.get(uses_item)
-                            item_already_compiled = uses_item in compiled_list
-                            if not item_already_in_list and not item_already_compiled:
-                                bls_get_uses_graph(file_dir, uses_item, compiling_now_list, compiled_list, bls_uses_graph)
+def bls_tokens(data):
+    return [match.group() for match in BLS_TOKEN_PATTERN.finditer(data) if match.lastgroup != 'skip']
+
+
+def bls_same_tokens(before, after):
+    return before == after or bls_tokens(before) == bls_tokens(after)
+
+
+# -------------------------------------------------------------------------------------------------
+def bls_get_exports(file_name):
+    with open_encoding_aware(file_name) as f:
+        if f:
+            return bls_get_exports_from_text(f.read())
+
+
+def bls_get_exports_from_text(text):
+    text = replace_unwanted_symbols(text)
+    # находим текст между словом "exports" и ближайшей точкой с запятой
+    return [fn.strip() for fn in re.findall(r'(?s)(?<=\bexports\s)(.*?)(?=;)', text, flags=re.IGNORECASE)]
+
+
+# -------------------------------------------------------------------------------------------------
+BLS_USES_CACHE = {}  # sha1 содержимого BLS: uses
+
+
+def bls_get_uses(file_name):
+    # uses запоминаются по содержимому файла: служба и пакетный режим разбирают те же исходники в разных каталогах
+    try:
+        with open(file_name, mode='rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return []
+    if digest not in BLS_USES_CACHE:
+        BLS_USES_CACHE[digest] = __read_bls_uses__(file_name)
+    return list(BLS_USES_CACHE[digest])
+
+
+def __read_bls_uses__(file_name):
+    f = open_encoding_aware(file_name)
+    if not f:
+        return []
+    with f:
+        text = replace_unwanted_symbols(f.read())
+    uses_list = []
+    # находим текст между словом "uses" и ближайшей точкой с запятой
+    for text_of_uses in re.findall(r'(?s)(?<=\buses\s)(.*?)(?=;)', text, flags=re.IGNORECASE):
+        # разбиваем найденный текст на части между запятыми
+        uses_list.extend([line.strip().lower() + '.bls' for line in text_of_uses.split(',') if line.strip()])
+    return tuple(dict.fromkeys(uses_list))
+
+
+# -------------------------------------------------------------------------------------------------
+def bls_get_uses_graph(files):
+    # граф зависимостей по строкам uses: {название_файла: [полное_название_с_путем, [список_зависимостей]]}
+    bls_uses_graph = {}
+    for path in files:
+        file_dir, file_name = split_path_to_dir_and_filename(path)
+        bls_uses_graph[file_name] = [path, bls_get_uses(path)]
     return bls_uses_graph
 
 
 # -------------------------------------------------------------------------------------------------
-def compile_one_file(build_path, bls_file_name, bls_path, uses_list, lic_server, lic_profile, version, failed_files, percents_to_log):
+def dir_compile_log():
+    return os.path.join(JOB.DIR_TEMP, '_COMPILE_LOG')
+
+
+def get_filename_compile_report():
+    return os.path.join(dir_compile_log(), 'compile_report.json')
+
+
+# -------------------------------------------------------------------------------------------------
+# Разбор строки вывода компилятора в диагностику {file, line, column, severity, message}.
+# Понимает строки вида "file.bls(12,5): Error: text", "file.bls(12) Warning text"
+# и "Error in line 12: text"; прочие строки с ошибками учитываются без привязки к строке.
+# Путь к файлу в выводе bscc.exe - путь Windows, от него берется имя (ntpath, на любой платформе)
+DIAGNOSTIC_WITH_LOCATION = re.compile(r'^\s*(?P<file>[^()]+?)\s*\((?P<line>\d+)(?:[,:]\s*(?P<column>\d+))?\)\s*:?\s*'
+                                    r'(?P<severity>fatal|error|warning|hint)\b\s*:?\s*(?P<message>.*)$', flags=re.IGNORECASE)
+DIAGNOSTIC_WITH_LINE = re.compile(r'^\s*(?P<severity>fatal|error|warning|hint)\b.*?\bline\s+(?P<line>\d+)\s*:?\s*(?P<message>.*)$',
+                                flags=re.IGNORECASE)
+DIAGNOSTIC_WITHOUT_LOCATION = re.compile(r'^\s*(?P<severity>fatal|error|warning)\b\s*:?\s*(?P<message>.*)$', flags=re.IGNORECASE)
+
+
+def parse_compiler_diagnostic(line, bls_file_name):
+    for pattern in [DIAGNOSTIC_WITH_LOCATION, DIAGNOSTIC_WITH_LINE, DIAGNOSTIC_WITHOUT_LOCATION]:
+        found = pattern.match(line)
+        if found:
+            groups = found.groupdict()
+            severity = groups['severity'].lower()
+            return {'file': ntpath.basename(groups.get('file') or bls_file_name).lower(),
+                    'line': int(groups['line']) if groups.get('line') else None,
+                    'column': int(groups['column']) if groups.get('column') else None,
+                    'severity': 'error' if severity == 'fatal' else severity,
+                    'message': groups['message'].strip() or line.strip()}
+    return None
+
+
+# -------------------------------------------------------------------------------------------------
+async def __run_compiler__(args, bls_file_name, unit_log_path):
+    # вывод компилятора пишется в лог единицы компиляции по мере поступления,
+    # в памяти остается только признак успеха, диагностики и хвост вывода для сообщения об ошибке
+    import asyncio
+    tail = collections.deque(maxlen=COMPILE_OUTPUT_TAIL)
+    diagnostics = []
+    success = False
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.STDOUT)
+    try:
+        with open(unit_log_path, mode='a', encoding='utf-8') as unit_log:
+            async for raw_line in process.stdout:
+                line = raw_line.decode('windows-1251').rstrip('\r\n')
+                unit_log.write(line + '\n')
+                tail.append(line)
+                diagnostic = parse_compiler_diagnostic(line, bls_file_name)
+                if diagnostic:
+                    diagnostics.append(diagnostic)
+                # !!! successfully с ошибкой. так и должно быть !!!
+                if 'Compiled succesfully' in line or 'Compiled with warnings' in line:
+                    success = True
+        await process.wait()
+    finally:
+        # при таймауте или отмене компилятор не должен остаться висеть
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    return success, list(tail), diagnostics
+
+
+# -------------------------------------------------------------------------------------------------
+async def compile_one_file(build_path, bls_file_name, bls_path, uses_list, lic_server, lic_profile, version,
+                        failed_files, percents_to_log, timeout=0, retries=0, compile_report=None, cache_path=None):
+    import asyncio
+    bll_path = replace_ext(bls_path, '.bll')
+    cached_bll_path = os.path.join(cache_path, replace_ext(bls_file_name, '.bll')) if cache_path else None
+    if cached_bll_path and os.path.exists(cached_bll_path):
+        # этот же исходник уже откомпилирован этим же билдом в другом задании
+        log_debug("\t{:>3}%".format(percents_to_log) + '\t' + bls_file_name + ' (from cache)')
+        FILES_WRITTEN.add(shutil.copyfile(cached_bll_path, bll_path))
+        if compile_report is not None:
+            compile_report[bls_file_name] = {'status': 'cached', 'uses': uses_list, 'diagnostics': []}
+        return True
     # проверим, есть ли компилятор
     bscc_path = os.path.join(build_path, 'bscc.exe')
-    if not os.path.exists(bscc_path):
+    if COMPILER_COMMAND:
+        compiler = list(COMPILER_COMMAND)
+    elif os.path.exists(bscc_path):
+        compiler = [bscc_path]
+    else:
         # компилятора нет, ошибка
         raise FileNotFoundError(f'Compiler {bscc_path} not found')
-    run_str = bscc_path + f' "{bls_path}" -M0 -O0 -S{lic_server} -A{lic_profile} -R1'
+    args = compiler + [bls_path, '-M0', '-O0', f'-S{lic_server}', f'-A{lic_profile}', '-R1']
     if version:
-        run_str = run_str + f' -V"{version}"'
-
-    log("\t{:>3}%".format(percents_to_log) + '\t' + bls_file_name)
-    process = subprocess.Popen(run_str, shell=False, stdout=subprocess.PIPE)  # , stderr=subprocess.PIPE
-    out, err = process.communicate()
-    process.stdout.close()
-    str_res = '\n\t\t\t' + out.decode('windows-1251').replace('\n', '\n\t\t\t')
-    # !!! successfully с ошибкой. так и должно быть !!!
-    if 'Compiled succesfully' not in str_res and 'Compiled with warnings' not in str_res:
+        args.append(f'-V{version}')
+
+    unit_log_path = os.path.join(dir_compile_log(), replace_ext(bls_file_name, '.log'))
+    make_dirs(dir_compile_log())
+    open(unit_log_path, mode='w').close()
+    success = False
+    output = []
+    diagnostics = []
+    for attempt in range(retries + 1):
+        # каждый запуск компилятора занимает процесс и сессию на сервере защиты
+        async with COMPILER_LIMITER, LICENSE_LIMITER:
+            log_debug("\t{:>3}%".format(percents_to_log) + '\t' + bls_file_name + (f' (attempt {attempt + 1})' if attempt else ''))
+            begin_time = time.time()
+            timed_out = False
+            lane_name = TRACER.acquire_slot('compiler')
+            try:
+                with trace_span(f'compile_one_file {bls_file_name}', lane_name, attempt=attempt + 1):
+                    success, output, diagnostics = await asyncio.wait_for(
+                        __run_compiler__(args, bls_file_name, unit_log_path), timeout or None)
+            except asyncio.TimeoutError:
+                timed_out = True
+                success, output = False, [f'TIMEOUT: compiler was killed after {timeout} seconds']
+                diagnostics = [{'file': bls_file_name, 'line': None, 'column': None,
+                                'severity': 'error', 'message': output[0]}]
+                log(f'\tTIMEOUT: File "{bls_file_name}" was not compiled in {timeout} seconds, compiler killed', LOG_WARNING)
+            finally:
+                TRACER.release_slot(lane_name)
+        COMPILER_LIMITER.report(time.time() - begin_time, success)
+        LICENSE_LIMITER.report(time.time() - begin_time, success)
+        # повторяем только зависшие компиляции, ошибка в исходнике не исправится повторным запуском
+        if not timed_out:
+            break
+
+    if compile_report is not None:
+        compile_report[bls_file_name] = {'status': 'compiled' if success else 'failed',
+                                        'uses': uses_list, 'log': unit_log_path, 'diagnostics': diagnostics}
+    if not success:
         if bls_file_name not in failed_files:
             failed_files.append(bls_file_name)
-        log(f'\tERROR: File "{bls_file_name}", Uses list "{uses_list}"{str_res}')
+        str_res = ''.join(['\n\t\t\t' + line for line in output])
+        log(f'\tERROR: File "{bls_file_name}", Uses list "{uses_list}" (full output in {unit_log_path}){str_res}', LOG_ERROR)
         log('\tCOMPILATION continues. Please wait...')
         return False
     else:
+        if cached_bll_path and os.path.exists(bll_path):
+            make_dirs(cache_path)
+            # параллельное задание может в это же время читать или писать этот же файл кэша
+            temp_file = f'{cached_bll_path}.{os.getpid()}.{threading.get_ident()}'
+            shutil.copyfile(bll_path, temp_file)
+            os.replace(temp_file, FILES_WRITTEN.add(cached_bll_path))
         return True
 
 
 # -------------------------------------------------------------------------------------------------
-def file_compiled(bls_file_name, compiled_list):
-    with COMPILED_LOCK:
-        return bls_file_name in compiled_list
+async def compile_graph(lic_server, lic_profile, build_path, bls_uses_graph, bll_version, timeout, retries,
+                        compiled_list, failed_files, blocked_files, compile_report, cache_path=None, kept=()):
+    import asyncio
+    # для каждого файла создается одна задача, которая дожидается компиляции своих зависимостей
+    tasks = {}
+    files_count = len(bls_uses_graph)
+
+    async def compile_unit(bls_file_name, dependencies):
+        results = await asyncio.gather(*dependencies.values())
+        bls_file_path, uses_list = bls_uses_graph[bls_file_name]
+        # если зависимость не откомпилировалась, то и этот файл не откомпилируется - не тратим на него компилятор
+        blocked_by = [uses_file_name for uses_file_name, result in zip(dependencies, results) if not result]
+        if blocked_by:
+            log(f'\tBLOCKED: File "{bls_file_name}" is not compiled because of failed {blocked_by}')
+            blocked_files.append(bls_file_name)
+            compile_report[bls_file_name] = {'status': 'blocked', 'uses': uses_list, 'blocked_by': blocked_by,
+                                            'diagnostics': []}
+            return False
+        if bls_file_name in kept:
+            # BLL осталась от прошлой компиляции
+            compile_report[bls_file_name] = {'status': 'kept', 'uses': uses_list, 'diagnostics': []}
+            compiled_list.append(bls_file_name)
+            return True
+        percents = int(100.00 * (len(compiled_list) + len(failed_files) + len(blocked_files)) / files_count)
+        if await compile_one_file(build_path, bls_file_name, bls_file_path, uses_list, lic_server, lic_profile,
+                                bll_version, failed_files, percents, timeout, retries, compile_report, cache_path):
+            compiled_list.append(bls_file_name)  # добавляем в список учтенных файлов
+            return True
+        return False
+
+    def get_task(bls_file_name, stack):
+        if bls_file_name not in tasks:
+            dependencies = {}
+            for uses_file_name in bls_uses_graph[bls_file_name][1]:
+                # файлы, которых нет среди исходников, уже есть в билде в виде bll
+                if uses_file_name not in bls_uses_graph:
+                    continue
+                if uses_file_name in stack:
+                    log(f'\tWARNING: cyclic uses "{bls_file_name}" -> "{uses_file_name}" ignored', LOG_WARNING)
+                    continue
+                dependencies[uses_file_name] = get_task(uses_file_name, stack + [bls_file_name])
+            tasks[bls_file_name] = asyncio.ensure_future(compile_unit(bls_file_name, dependencies))
+        return tasks[bls_file_name]
+
+    async def watch_cancel():
+        while not CANCEL_EVENT.is_set():
+            await asyncio.sleep(0.2)
+        log('\tCOMPILATION CANCELLED')
+        for task in tasks.values():
+            task.cancel()
+
+    for bls_file_name in bls_uses_graph:
+        get_task(bls_file_name, [])
+    watcher = asyncio.ensure_future(watch_cancel())
+    try:
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    finally:
+        watcher.cancel()
+        # при отмене (Ctrl+C) снимаем все еще не завершенные компиляции
+        for task in tasks.values():
+            task.cancel()
+    for result in results:
+        if isinstance(result, BaseException):
+            log(f'\tERROR: {result}', LOG_ERROR)
 
 
 # -------------------------------------------------------------------------------------------------
-def file_compiling_now(bls_file_name, compiling_now_list):
-    return bls_file_name in compiling_now_list
+# BLS, которые не нужно перекомпилировать: не изменились, не зависят (через uses) от измененных
+# и были успешно откомпилированы в прошлый раз
+def bls_get_kept_units(bls_uses_graph, previous_report, changed):
+    dirty = {bls_file_name.lower() for bls_file_name in changed}
+    for bls_file_name, (bls_file_path, _) in bls_uses_graph.items():
+        if previous_report.get(bls_file_name, {}).get('status') not in ['compiled', 'cached', 'kept'] or \
+                not os.path.exists(replace_ext(bls_file_path, '.bll')):
+            dirty.add(bls_file_name.lower())
+    grown = True
+    while grown:
+        grown = False
+        for bls_file_name, (_, uses_list) in bls_uses_graph.items():
+            if bls_file_name.lower() not in dirty and any(uses_file_name in dirty for uses_file_name in uses_list):
+                dirty.add(bls_file_name.lower())
+                grown = True
+    return {bls_file_name for bls_file_name in bls_uses_graph if bls_file_name.lower() not in dirty}
 
 
 # -------------------------------------------------------------------------------------------------
-def compile_recursive(lic_server, lic_profile, build_path, bls_uses_graph, bls_file_name, 
-                            compiling_now_list, compiled_list, files_count, bll_version, failed_files):
-    bls_file_name = bls_file_name.lower()
+def load_compile_report():
     try:
-        with COMPILING_NOW_CONDITION:
-            while file_compiling_now(bls_file_name, compiling_now_list):
-                COMPILING_NOW_CONDITION.wait()
-            compiling_now_list.append(bls_file_name)
-
-        if file_compiled(bls_file_name, compiled_list):
-            return # если файл уже откомпилирован
-
-        bls_item_info = bls_uses_graph.get(bls_file_name)
-        if not bls_item_info:
-            log(f'No information about file to compile "{bls_file_name}". Probably not all SOURCE were downloaded.')
-            return
-
-        bls_file_path = bls_item_info[0]
-        uses_list = bls_item_info[1]
-        
-        if len(uses_list):  # если файл зависит от других файлов, то проведем
-            for uses_file_name in uses_list:  # компиляцию каждого файла
-                # рекурсия, компилируем список зависимостей:
-                compile_recursive(lic_server,
-                                lic_profile,
-                                build_path,
-                                bls_uses_graph,
-                                uses_file_name,
-                                compiling_now_list,
-                                compiled_list,
-                                files_count,
-                                bll_version,
-                                failed_files)
-            
-        percents = int(100.00 * len(compiled_list) / files_count)
-        if compile_one_file(build_path, bls_file_name, bls_file_path,
-                        uses_list, lic_server, lic_profile, bll_version,
-                        failed_files, percents):
-            with COMPILED_LOCK:
-                compiled_list.append(bls_file_name)  # добавляем в список учтенных файлов
-    
-    finally:
-        with COMPILING_NOW_CONDITION:
-            compiling_now_list.remove(bls_file_name)
-            COMPILING_NOW_CONDITION.notify_all()
+        with open(get_filename_compile_report(), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 
 # -------------------------------------------------------------------------------------------------
-def compile_thread_function(lic_server, lic_profile, build_path, path, compiling_now_list, compiled_list, files_count, bll_version, failed_files):
-    file_dir, file_name = split_path_to_dir_and_filename(path)
-    
-    if file_compiled(file_name, compiled_list):
-        return
-
-    bls_uses_graph = {} # строим граф зависимостей по строкам uses
-    bls_get_uses_graph(file_dir, file_name, compiling_now_list, compiled_list, bls_uses_graph)  
-
-    if file_compiled(file_name, compiled_list):
-        return
-
-    try:
-        for bls_file_name in bls_uses_graph:  # компилируем все bls
-            compile_recursive(lic_server, lic_profile, build_path, bls_uses_graph,
-                bls_file_name, compiling_now_list, compiled_list, files_count, bll_version, failed_files)
-    except FileNotFoundError as exc:
-        log(f'\tERROR: {exc}')
+def save_compile_report(compile_report):
+    file_name = get_filename_compile_report()
+    make_dirs(os.path.dirname(file_name))
+    with open(file_name, mode='w', encoding='utf-8') as f:
+        json.dump(compile_report, f, ensure_ascii=False, indent=2)
+    log(f'\tCOMPILE REPORT saved to {file_name}')
 
 
 # -------------------------------------------------------------------------------------------------
-def compile_all(lic_server, lic_profile, build_path, source_path, bll_version):
-    clean(build_path, ['*.bls', '*.bll', '*.ClassInfo'])  # очищаем каталог билда от bls и bll
+@traced
+# changed - имена измененных BLS: тогда BLL остальных, успешно откомпилированных в прошлый раз, остаются в билде.
+# not_compiled - список, в который добавляются имена неоткомпилированных BLS (ошибка, таймаут, блокировка)
+def compile_all(lic_server, lic_profile, build_path, source_path, bll_version, timeout=0, retries=0, cache_path=None,
+                changed=None, not_compiled=None):
+    import asyncio
+    previous_report = load_compile_report() if changed is not None else {}
+    # очищаем каталог билда от bls и bll
+    clean(build_path, ['*.bls', '*.bll', '*.ClassInfo'] if changed is None else ['*.bls'])
     begin_time = time.time()
     log('BEGIN BLS COMPILATION. Please wait...')
     copy_files_from_all_subdirectories(source_path, build_path, ['*.bls'])  # копируем в каталог билда все bls
 
-    compiling_now_list = []
     compiled_list = []
     failed_files = []
-    futures = []
+    blocked_files = []
+    compile_report = {}
     files = list_files_of_all_subdirectories(build_path, '*.bls')
-    files_count = len(files)
-    for file_name in files:
-        futures.append(EXECUTOR.submit(compile_thread_function, lic_server, lic_profile, build_path, 
-            file_name, compiling_now_list, compiled_list, files_count, bll_version, failed_files))
-            
-    done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
-    for future in concurrent.futures.as_completed(done):
-        try:
-            future.result()
-        except Exception as exc:
-            log(f'Thread generated an exception: {exc}')
-
-    log(f"\tCOMPILED {len(compiled_list)} of {len(files)} (for {datetime.timedelta(seconds = time.time()-begin_time)} minutes)")
+    bls_uses_graph = bls_get_uses_graph(files)
+    kept = set()
+    if changed is not None:
+        kept = bls_get_kept_units(bls_uses_graph, previous_report, changed)
+        kept_names = {os.path.splitext(bls_file_name)[0].lower() for bls_file_name in kept}
+        for mask in ['*.bll', '*.ClassInfo']:
+            for file_path in list_files_of_directory(build_path, mask):
+                if os.path.splitext(split_filename(file_path))[0].lower() not in kept_names:
+                    os.remove(file_path)
+        log(f'\tKEEPING {len(kept)} BLL from previous compilation, {len(changed)} BLS changed')
+    asyncio.run(compile_graph(lic_server, lic_profile, build_path, bls_uses_graph, bll_version, timeout, retries,
+                            compiled_list, failed_files, blocked_files, compile_report, cache_path, kept))
+    check_cancelled()
+
+    log(f"\tCOMPILED {len(compiled_list) - len(kept)} of {len(files) - len(kept)} (for {datetime.timedelta(seconds = time.time()-begin_time)} minutes)")
     if len(failed_files):
         log(f"\tFAILED FILES({len(failed_files)}): {failed_files}")
-    return True
+    if len(blocked_files):
+        log(f"\tBLOCKED FILES({len(blocked_files)}): {blocked_files}")
+    save_compile_report(compile_report)
+    compiled = set(compiled_list)
+    not_compiled_files = sorted(bls_file_name for bls_file_name in bls_uses_graph if bls_file_name not in compiled)
+    if not_compiled is not None:
+        not_compiled.extend(not_compiled_files)
+    return not not_compiled_files
 
 
 # -------------------------------------------------------------------------------------------------
+# Архив распаковывается в свой временный каталог: билды БК и ИК, эталонный билд и задания пакетного режима
+# распаковываются одновременно, в том числе архивы с одинаковыми именами. Каталог удаляет remove_extracted_builds
 def __extract_build__(build_path):
+    import zipfile
     build_zip_file = split_filename(build_path)
-    if '.zip' in build_zip_file.lower():
-        build_tmp_dir = os.path.join(tempfile.gettempdir(), build_zip_file)
-        clean(build_tmp_dir)
+    if '.zip' in build_zip_file.lower() and os.path.isfile(build_path):
+        build_tmp_dir = tempfile.mkdtemp(prefix=f'{build_zip_file}.')
         log(f'EXTRACTING BUILD "{build_path}" in "{build_tmp_dir}"')
         try:
             with zipfile.ZipFile(build_path) as z:
-                z.extractall(os.path.join(tempfile.gettempdir(), build_zip_file))
+                z.extractall(build_tmp_dir)
                 # запомним путь во временный каталог в качестве
                 # нового пути к билду для последующего применения
                 build_path = build_tmp_dir
         except BaseException as exc:
-            log(f'\tERROR EXTRACTING BUILD "{exc}"')
+            log(f'\tERROR EXTRACTING BUILD "{exc}"', LOG_ERROR)
+            __remove_tree_in_background__(build_tmp_dir)
         # конец разархивации
     return build_path
 
 
+def remove_extracted_builds(build_paths, extracted_paths):
+    for build_path, extracted_path in zip(build_paths, extracted_paths):
+        if extracted_path != build_path:
+            __remove_tree_in_background__(extracted_path)
+
+
 # -------------------------------------------------------------------------------------------------
 def is_20_version(version):
     return ('20.1' in version) or ('20.2' in version) or ('20.3' in version)
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def __copy_build_ex__(build_path, build_path_crypto, destination_path, only_get_version):
     # проверка наличия пути build_path
     if not build_path:
@@ -1757,31 +3155,37 @@ def __copy_build_ex__(build_path, build_path_crypto, destination_path, only_get_
         return
     # если ссылка на билд указывает не на каталог, а на файл архива
     # попробуем провести разархивацию во временный каталог
+    archives = [build_path, build_path_crypto]
     build_path = __extract_build__(build_path)
     if build_path_crypto:
         build_path_crypto = __extract_build__(build_path_crypto)
-    # определяем версию билда
-    version = extract_build_version(build_path)
-    if not only_get_version:
-        if is_20_version(version):
-            for release in ['32', '64']:
-                win_rel = f'Win{release}\\Release'
-                src = os.path.join(build_path, win_rel)
-                dst = os.path.join(destination_path, win_rel)
-                clean(dst)
-                log(f'COPYING BUILD {version} from "{src}" to "{dst}"')
-                copy_files_from_all_subdirectories(src, dst, ['*.exe', '*.ex', '*.bpl', '*.dll'])
+    try:
+        # определяем версию билда
+        version = extract_build_version(build_path)
+        if not only_get_version:
+            if is_20_version(version):
+                def copy_release(release):
+                    win_rel = f'Win{release}\\Release'
+                    src = os.path.join(build_path, win_rel)
+                    dst = os.path.join(destination_path, win_rel)
+                    clean(dst)
+                    log(f'COPYING BUILD {version} from "{src}" to "{dst}"')
+                    copy_files_from_all_subdirectories(src, dst, ['*.exe', '*.ex', '*.bpl', '*.dll'])
+                    if build_path_crypto:
+                        src = os.path.join(build_path_crypto, win_rel)
+                        log(f'COPYING CRYPTO BUILD {version} from "{src}" to "{dst}"')
+                        copy_files_from_all_subdirectories(src, dst, ['CryptLib.dll', 'cr_*.dll'])
+
+                run_for_instances(copy_release, ['32', '64'])  # релизы копируются параллельно
+            else:
+                clean(destination_path)
+                log(f'COPYING BUILD {version} from "{build_path}" to "{destination_path}"')
+                copy_files_from_all_subdirectories(build_path, destination_path, ['*.exe', '*.ex', '*.bpl', '*.dll'])
                 if build_path_crypto:
-                    src = os.path.join(build_path_crypto, win_rel)
-                    log(f'COPYING CRYPTO BUILD {version} from "{src}" to "{dst}"')
-                    copy_files_from_all_subdirectories(src, dst, ['CryptLib.dll', 'cr_*.dll'])
-        else:
-            clean(destination_path)
-            log(f'COPYING BUILD {version} from "{build_path}" to "{destination_path}"')
-            copy_files_from_all_subdirectories(build_path, destination_path, ['*.exe', '*.ex', '*.bpl', '*.dll'])
-            if build_path_crypto:
-                log(f'COPYING CRYPTO BUILD {version} from "{build_path}" to "{destination_path}"')
-                copy_files_from_all_subdirectories(build_path_crypto, destination_path, ['CryptLib.dll', 'cr_*.dll'])
+                    log(f'COPYING CRYPTO BUILD {version} from "{build_path}" to "{destination_path}"')
+                    copy_files_from_all_subdirectories(build_path_crypto, destination_path, ['CryptLib.dll', 'cr_*.dll'])
+    finally:
+        remove_extracted_builds(archives, [build_path, build_path_crypto])
     return version
 
 
@@ -1791,6 +3195,7 @@ def __copy_build__(build_path, build_path_crypto, destination_path):
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def get_build_version(settings):
     log('Detecting BUILD VERSION')
     version = __copy_build_ex__(settings.BuildBK, None, None, True)
@@ -1799,39 +3204,64 @@ def get_build_version(settings):
 
 
 # -------------------------------------------------------------------------------------------------
-def download_build(settings):
+# Загрузка билда в рабочие каталоги _BUILD (для компиляции BLS и последующей выкладки в патч)
+@traced
+def fetch_build(settings):
     build = settings.BuildBK
     build_ic = settings.BuildIC
-    build_crypto = settings.BuildCrypto
+    # архив криптографии распаковывается один раз для обоих билдов
+    build_crypto = __extract_build__(settings.BuildCrypto) if settings.BuildCrypto else settings.BuildCrypto
     build_version = build_ic_version = ''
     instances = []
+    copies = []  # билды БК и ИК загружаются параллельно
     if build:
         instances.append(INSTANCE_BANK)
         instances.append(INSTANCE_CLIENT)
         instances.append(INSTANCE_CLIENT_MBA)
-        build_version = __copy_build__(build, build_crypto, DIR_BUILD_BK)
+        copies.append((build, JOB.DIR_BUILD_BK))
     if build_ic and settings.PlaceBuildIntoPatchIC:
         instances.append(INSTANCE_IC)
-        build_ic_version = __copy_build__(build_ic, build_crypto, DIR_BUILD_IC)
+        copies.append((build_ic, JOB.DIR_BUILD_IC))
+    try:
+        versions = dict(zip([destination_path for _, destination_path in copies],
+                            run_for_instances(lambda item: __copy_build__(item[0], build_crypto, item[1]), copies)))
+    finally:
+        remove_extracted_builds([settings.BuildCrypto], [build_crypto])
+    build_version = versions.get(JOB.DIR_BUILD_BK, build_version)
+    build_ic_version = versions.get(JOB.DIR_BUILD_IC, build_ic_version)
+
+    if INSTANCE_BANK in instances:
+        # это копируются все файлы, которые будут участвовать в компиляции BLS на следующем шаге
+        # т.к. в результате __copy_build__ весь билд оказывается разделен на Win32 и Win64
+        if is_20_version(build_version):
+            build_path = os.path.join(JOB.DIR_BUILD_BK, 'Win32\\Release')
+            copy_files_from_all_subdirectories(build_path, JOB.DIR_BUILD_BK, ['*.*'])
+        for filepath in settings.BuildAdditionalFolders:
+            log(f'COPYING ADDITIONAL from "{filepath}" to "{JOB.DIR_BUILD_BK}"')
+            copy_files_from_all_subdirectories(filepath, JOB.DIR_BUILD_BK, ['*.*'])
+    if instances:
+        # версия определяется по последнему экземпляру, как и при выкладке билда в патч
+        settings.Is20Version = is_20_version(build_ic_version if INSTANCE_IC in instances else build_version)
+    return build_version, build_ic_version, instances
 
-    if not len(instances):
-        return False
 
-    for instance in instances:
+# -------------------------------------------------------------------------------------------------
+# Выкладка загруженного билда из каталогов _BUILD в патч. Возвращает [(файл билда, файл в патче)]
+@traced
+def place_build_into_patch(settings, build_version, build_ic_version, instances):
+    changed, skipped = get_build_changed_filter(settings)
+
+    # settings.Is20Version уже определена в fetch_build по последнему экземпляру
+    def place(instance):
+        copied = []
+
+        def copy(*args):
+            copied.extend(copy_files_from_all_subdirectories(*args, only=changed))
+
         if instance in [INSTANCE_BANK, INSTANCE_CLIENT, INSTANCE_CLIENT_MBA]:
             is20 = is_20_version(build_version)
-            # это копируются все файлы, которые будут участвовать в компиляции BLS на следующем шаге
-            # т.к. в результате __copy_build__ весь билд оказывается разделен на Win32 и Win64
-            if is20 and instance == INSTANCE_BANK:
-                build_path = os.path.join(DIR_BUILD_BK, 'Win32\\Release')
-                copy_files_from_all_subdirectories(build_path, DIR_BUILD_BK, ['*.*'])
-            if instance == INSTANCE_BANK:
-                for filepath in settings.BuildAdditionalFolders:
-                    log(f'COPYING ADDITIONAL from "{filepath}" to "{DIR_BUILD_BK}"')
-                    copy_files_from_all_subdirectories(filepath, DIR_BUILD_BK, ['*.*'])
         else:
             is20 = is_20_version(build_ic_version)
-        settings.Is20Version = is20
 
         #  Если в настройках включено копирование билда в патч
         if settings.PlaceBuildIntoPatchBK:  # or settings.PlaceBuildIntoPatchIC
@@ -1854,95 +3284,336 @@ def download_build(settings):
                             'BssPluginWebKitSetup.exe', 'BssPluginSetup64.exe', 'BssPluginSetupGPB.exe',
                             'BssPluginSetupGPBNoHost.exe']
                     for release in ['32', '64']:  # выкладываем билд в LIBFILES32(64).BNK
-                        build_path = os.path.join(DIR_BUILD_IC, 'Win{}\\Release'.format('32'))
+                        build_path = os.path.join(JOB.DIR_BUILD_IC, 'Win{}\\Release'.format('32'))
                         for www_path in [dir_patch_libfiles_bnk_www_bsisites_rtic_code_buildversion(build_ic_version,release),
                                         dir_patch_libfiles_bnk_www_bsisites_rtwa_code_buildversion(build_ic_version,release)]:
-                            copy_files_from_all_subdirectories(build_path, www_path, mask)
+                            copy(build_path, www_path, mask)
 
                 elif instance != INSTANCE_IC and settings.PlaceBuildIntoPatchBK:
                     if instance == INSTANCE_BANK:
-                        build_path = os.path.join(DIR_BUILD_BK, 'Win32\\Release')
-                        # это копируются все файлы, которые будут участвовать в компиляции BLS на следующем шаге
-                        # т.к. в результате __copy_build__ весь билд оказывается разделен на Win32 и Win64
-                        copy_files_from_all_subdirectories(build_path, DIR_BUILD_BK, ['*.*'])
+                        build_path = os.path.join(JOB.DIR_BUILD_BK, 'Win32\\Release')
+                        # файлы для компиляции BLS уже скопированы в DIR_BUILD_BK в fetch_build
                         # copy_files_from_all_subdirectories(build_path, dir_patch(), ['CBStart.exe'])  # один файл CBStart.exe в корень патча
                         mask = ['bssetup.msi', 'CalcCRC.exe']
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_inettemp(), mask)
+                        copy(build_path, dir_patch_libfiles_inettemp(), mask)
                         mask = ['BssPluginSetup.exe', 'BssPluginWebKitSetup.exe']
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_inettemp(), mask)
+                        copy(build_path, dir_patch_libfiles_inettemp(), mask)
                     for release in ['32', '64']:  # выкладываем остальной билд для Б и БК для версий 32 и 64
-                        build_path = os.path.join(DIR_BUILD_BK, f'Win{release}\\Release')
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_exe(instance, release), mask_for_exe_dir, excluded_files)
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_system(instance, release), ['*.dll'], excluded_for_system_dir)
-                        copy_files_from_all_subdirectories(build_path, dir_patch_cbstart(instance, release), ['CBStart.exe'])
+                        build_path = os.path.join(JOB.DIR_BUILD_BK, f'Win{release}\\Release')
+                        copy(build_path, dir_patch_libfiles_exe(instance, release), mask_for_exe_dir, excluded_files)
+                        copy(build_path, dir_patch_libfiles_system(instance, release), ['*.dll'], excluded_for_system_dir)
+                        copy(build_path, dir_patch_cbstart(instance, release), ['CBStart.exe'])
                         if instance == INSTANCE_BANK:
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk(release), ['UpdateIc.exe'])
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_www_exe(release), ['bsiset.exe'])
+                            copy(build_path, dir_patch_libfiles_bnk(release), ['UpdateIc.exe'])
+                            copy(build_path, dir_patch_libfiles_bnk_www_exe(release), ['bsiset.exe'])
                             mask = ['bsi.dll', 'bsi.jar']
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_www_bsiscripts_rtic(release), mask)
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_www_bsiscripts_rtwa(release), mask)
+                            copy(build_path, dir_patch_libfiles_bnk_www_bsiscripts_rtic(release), mask)
+                            copy(build_path, dir_patch_libfiles_bnk_www_bsiscripts_rtwa(release), mask)
                             # заполняем TEMPLATE шаблон клиента в банковском патче
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_distribx_client_exe(release), mask_for_exe_dir, const_excluded_build_for_CLIENT)
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_distribx_client_system( release), ['*.dll'], excluded_for_system_client_dir)
+                            copy(build_path, dir_patch_libfiles_template_distribx_client_exe(release), mask_for_exe_dir, const_excluded_build_for_CLIENT)
+                            copy(build_path, dir_patch_libfiles_template_distribx_client_system( release), ['*.dll'], excluded_for_system_client_dir)
                             mask = ['CalcCRC.exe', 'Setup.exe', 'Install.exe', 'eif2base.exe', 'ilKern.dll', 'GetIName.dll']
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_distribx(release), mask)
+                            copy(build_path, dir_patch_libfiles_template_distribx(release), mask)
                             mask = ['ilGroup.dll', 'iliGroup.dll', 'ilProt.dll', 'ilCpyDoc.dll']
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_languagex_en(release), mask)
-                            copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_languagex_ru(release), mask)
+                            copy(build_path, dir_patch_libfiles_template_languagex_en(release), mask)
+                            copy(build_path, dir_patch_libfiles_template_languagex_ru(release), mask)
 
             else:  # для билдов 15 и 17
-                build_path = DIR_BUILD_BK
+                build_path = JOB.DIR_BUILD_BK
                 if instance in [INSTANCE_BANK, INSTANCE_CLIENT, INSTANCE_CLIENT_MBA] \
                         and settings.PlaceBuildIntoPatchBK:
                     # выкладываем билд для Б и БК
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_exe(instance), mask_for_exe_dir, excluded_files)
+                    copy(build_path, dir_patch_libfiles_exe(instance), mask_for_exe_dir, excluded_files)
                     if settings.ClientEverythingInEXE and instance == INSTANCE_CLIENT:
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_exe(instance), ['*.dll'], excluded_for_system_dir)
+                        copy(build_path, dir_patch_libfiles_exe(instance), ['*.dll'], excluded_for_system_dir)
                     else:
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_system(instance), ['*.dll'], excluded_for_system_dir)
+                        copy(build_path, dir_patch_libfiles_system(instance), ['*.dll'], excluded_for_system_dir)
 
                 if instance == INSTANCE_BANK and settings.PlaceBuildIntoPatchBK:
-                    copy_files_from_all_subdirectories(build_path, dir_patch(), ['CBStart.exe'])  # один файл в корень
+                    copy(build_path, dir_patch(), ['CBStart.exe'])  # один файл в корень
                     # заполняем билдом TEMPLATE шаблон клиента в банковском патче
                     mask = ['*.exe', '*.ex', '*.bpl']
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_distrib_client_exe(), mask, const_excluded_build_for_CLIENT)
+                    copy(build_path, dir_patch_libfiles_template_distrib_client_exe(), mask, const_excluded_build_for_CLIENT)
                     if settings.ClientEverythingInEXE:
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_distrib_client_exe(), ['*.dll'], excluded_for_system_client_dir)
+                        copy(build_path, dir_patch_libfiles_template_distrib_client_exe(), ['*.dll'], excluded_for_system_client_dir)
                     else:
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_distrib_client_system(), ['*.dll'], excluded_for_system_client_dir)
+                        copy(build_path, dir_patch_libfiles_template_distrib_client_system(), ['*.dll'], excluded_for_system_client_dir)
                     mask = ['CalcCRC.exe', 'Setup.exe', 'Install.exe', 'eif2base.exe', 'ilKern.dll', 'GetIName.dll']
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_distrib(), mask)
+                    copy(build_path, dir_patch_libfiles_template_distrib(), mask)
                     mask = ['ilGroup.dll', 'iliGroup.dll', 'ilProt.dll', 'ilCpyDoc.dll']
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_language_en(), mask)
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_language_ru(), mask)
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_language_en_client_system(), mask)
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_template_language_ru_client_system(), mask)
+                    copy(build_path, dir_patch_libfiles_template_language_en(), mask)
+                    copy(build_path, dir_patch_libfiles_template_language_ru(), mask)
+                    copy(build_path, dir_patch_libfiles_template_language_en_client_system(), mask)
+                    copy(build_path, dir_patch_libfiles_template_language_ru_client_system(), mask)
                     # заполняем LIBFILES.BNK в банковском патче билдом для БК
                     mask = ['autoupgr.exe', 'bscc.exe', 'compiler.exe', 'operedit.exe', 'testconn.exe', 'treeedit.exe']
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_add(), mask)
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_bsiset_exe(), ['bsiset.exe'])
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_license_exe(), ['protcore.exe'])
+                    copy(build_path, dir_patch_libfiles_bnk_add(), mask)
+                    copy(build_path, dir_patch_libfiles_bnk_bsiset_exe(), ['bsiset.exe'])
+                    copy(build_path, dir_patch_libfiles_bnk_license_exe(), ['protcore.exe'])
 
                 if instance == INSTANCE_IC and settings.PlaceBuildIntoPatchIC:
                     # заполняем LIBFILES.BNK в банковском патче билдом для ИК
-                    build_path = DIR_BUILD_IC
+                    build_path = JOB.DIR_BUILD_IC
                     mask = ['bssaxset.exe', 'inetcfg.exe', 'rts.exe', 'rtsconst.exe', 'rtsinfo.exe']
                     if settings.BuildRTSZIP:
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_rts_exe(), mask)
+                        copy(build_path, dir_patch_libfiles_bnk_rts_exe(), mask)
                     else:
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_exe(INSTANCE_BANK), mask)
+                        copy(build_path, dir_patch_libfiles_exe(INSTANCE_BANK), mask)
                     mask = ['llComDat.dll', 'llrtscfg.dll', 'llxmlman.dll', 'msxml2.bpl']
                     if settings.BuildRTSZIP:
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_rts_system(), mask)
+                        copy(build_path, dir_patch_libfiles_bnk_rts_system(), mask)
                     else:
-                        copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_system(INSTANCE_BANK), mask)
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_www_bsiscripts_rtic(), ['bsi.dll'])
-                    copy_files_from_all_subdirectories(build_path, dir_patch_libfiles_bnk_www_bsiscripts_rtadmin(), ['bsi.dll'])
+                        copy(build_path, dir_patch_libfiles_system(INSTANCE_BANK), mask)
+                    copy(build_path, dir_patch_libfiles_bnk_www_bsiscripts_rtic(), ['bsi.dll'])
+                    copy(build_path, dir_patch_libfiles_bnk_www_bsiscripts_rtadmin(), ['bsi.dll'])
                     # todo INETTEMP
+        return copied
+
+    # экземпляры раскладываются параллельно, ИК - после них, потому что выкладывается в каталоги банка
+    copied = [item for instance_copied in
+              run_for_instances(place, [instance for instance in instances if instance != INSTANCE_IC]) +
+              [place(instance) for instance in instances if instance == INSTANCE_IC]
+              for item in instance_copied]
+    if changed is not None:
+        log(f'BUILD FILES UNCHANGED since reference build: {len(skipped)} skipped, '
+            f'{len(set(build_file for build_file, _ in copied))} placed into patch')
+    return copied
+
+
+# -------------------------------------------------------------------------------------------------
+# Эталонный файл для файла билда: файл с тем же путем в DIR_BUILD_REFERENCE (None - эталона нет)
+def get_build_reference_file(build_file):
+    relative_path = os.path.relpath(build_file, JOB.DIR_BUILD_BK)
+    reference_file = os.path.join(JOB.DIR_BUILD_REFERENCE, relative_path)
+    if relative_path.startswith(os.pardir) or not os.path.isfile(reference_file):
+        return None
+    return reference_file
+
+
+# -------------------------------------------------------------------------------------------------
+# Файл билда изменился относительно эталонного билда ReferenceBuild: нет эталона, другой размер или содержимое
+def is_build_file_changed(build_file):
+    reference_file = get_build_reference_file(build_file)
+    if reference_file is None:
+        return True
+    if os.path.getsize(build_file) == os.path.getsize(reference_file) and \
+            hash_file(build_file) == hash_file(reference_file):
+        return False
+    if build_file.lower().endswith(('.exe', '.dll', '.bpl')):
+        log_debug(f'\tBUILD FILE CHANGED {os.path.relpath(build_file, JOB.DIR_BUILD_BK)}: '
+                  f'{__get_exe_file_info__(reference_file)} -> {__get_exe_file_info__(build_file)}')
     return True
 
 
 # -------------------------------------------------------------------------------------------------
+# Отбор файлов билда для place_build_into_patch: при заданном ReferenceBuild в патч выкладываются только файлы,
+# изменившиеся относительно эталона (маски и списки исключений применяются как обычно).
+# Возвращает функцию для copy_files_ex (None - выкладываются все файлы) и множество пропущенных файлов билда
+def get_build_changed_filter(settings):
+    if not settings.ReferenceBuild or not os.path.isdir(JOB.DIR_BUILD_REFERENCE):
+        return None, set()
+    results = {}  # файл билда: изменился, проверяется один раз для всех каталогов патча и экземпляров
+    skipped = set()
+    lock = threading.Lock()
+
+    def changed(build_file):
+        with lock:
+            if build_file not in results:
+                results[build_file] = is_build_file_changed(build_file)
+                if not results[build_file]:
+                    skipped.add(build_file)
+            return results[build_file]
+
+    return changed, skipped
+
+
+# -------------------------------------------------------------------------------------------------
+# Бинарные дельты файлов билда относительно эталонного билда ReferenceBuild (настройка [BUILD] BuildDeltas).
+# Вместо файла билда в патч кладется <файл>.g2pdelta, если он заметно меньше файла; восстанавливается
+# он на стороне клиента ключом -apply-deltas по установленному эталонному файлу (apply_build_deltas).
+# Формат: BUILD_DELTA_MAGIC, размеры и sha256 эталона и результата, затем сжатые lzma команды
+# C <смещение в эталоне> <длина> (копировать из эталона) и A <длина> <байты> (добавить)
+BUILD_DELTA_EXTENSION = '.g2pdelta'
+BUILD_DELTA_MAGIC = b'G2PDELTA1\0'
+BUILD_DELTA_HEADER = struct.Struct('<QQ32s32s')
+BUILD_DELTA_MAX_RATIO = 0.5  # дельта больше половины файла не выкладывается
+
+
+# Длина совпадающего начала a[i:] и b[j:]: сравниваются блоки, уменьшающиеся вдвое
+def common_prefix_length(a, i, b, j):
+    limit = min(len(a) - i, len(b) - j)
+    length, step = 0, 1 << 16
+    while step:
+        while length + step <= limit and a[i + length:i + length + step] == b[j + length:j + length + step]:
+            length += step
+        step //= 2
+    return length
+
+
+# Команды дельты target относительно reference: [(True, смещение, длина) - копия, (False, начало, конец) - вставка
+# из target]. Эталон индексируется блоками, в target блок ищется с каждой позиции и совпадение расширяется
+# в обе стороны. None, если вставок больше max_literal байт
+def make_binary_delta(reference, target, max_literal):
+    block = max(32, len(reference) // 262144)  # не больше ~256К блоков в индексе
+    reference, target = memoryview(reference), memoryview(target)
+    index = {}
+    for offset in range(0, len(reference) - block + 1, block):
+        index.setdefault(reference[offset:offset + block].tobytes(), offset)
+    ops = []
+    literal_start = position = literal = 0
+    while position + block <= len(target):
+        offset = index.get(target[position:position + block].tobytes())
+        if offset is None:
+            position += 1
+            if position - literal_start + literal > max_literal:
+                return None
+            continue
+        back = 0
+        while back < position - literal_start and back < offset and \
+                target[position - back - 1] == reference[offset - back - 1]:
+            back += 1
+        length = block + back + common_prefix_length(reference, offset + block, target, position + block)
+        position, offset = position - back, offset - back
+        if position > literal_start:
+            ops.append((False, literal_start, position))
+            literal += position - literal_start
+        ops.append((True, offset, length))
+        position = literal_start = position + length
+    if len(target) > literal_start:
+        ops.append((False, literal_start, len(target)))
+        literal += len(target) - literal_start
+    return ops if literal <= max_literal else None
+
+
+def build_delta_bytes(reference, target, ops):
+    stream = bytearray()
+    for is_copy, first, second in ops:
+        if is_copy:
+            stream += b'C' + struct.pack('<QQ', first, second)
+        else:
+            stream += b'A' + struct.pack('<Q', second - first) + target[first:second]
+    return BUILD_DELTA_MAGIC + \
+        BUILD_DELTA_HEADER.pack(len(reference), len(target), hashlib.sha256(reference).digest(),
+                                hashlib.sha256(target).digest()) + lzma.compress(bytes(stream))
+
+
+def apply_binary_delta(reference, delta):
+    if not delta.startswith(BUILD_DELTA_MAGIC):
+        raise ValueError('NOT A DELTA FILE')
+    reference_size, target_size, reference_sha256, target_sha256 = \
+        BUILD_DELTA_HEADER.unpack_from(delta, len(BUILD_DELTA_MAGIC))
+    if len(reference) != reference_size or hashlib.sha256(reference).digest() != reference_sha256:
+        raise ValueError('REFERENCE FILE DIFFERS from the one the delta was made for')
+    stream = lzma.decompress(delta[len(BUILD_DELTA_MAGIC) + BUILD_DELTA_HEADER.size:])
+    target = bytearray()
+    position = 0
+    while position < len(stream):
+        command, first = stream[position:position + 1], struct.unpack_from('<Q', stream, position + 1)[0]
+        if command == b'C':
+            length = struct.unpack_from('<Q', stream, position + 9)[0]
+            target += reference[first:first + length]
+            position += 17
+        elif command == b'A':
+            target += stream[position + 9:position + 9 + first]
+            position += 9 + first
+        else:
+            raise ValueError(f'WRONG DELTA COMMAND {command}')
+    if len(target) != target_size or hashlib.sha256(target).digest() != target_sha256:
+        raise ValueError('RESTORED FILE DIFFERS from the original')
+    return bytes(target)
+
+
+# Заголовок дельты: (размер эталона, размер результата, sha256 эталона, sha256 результата)
+def read_build_delta_header(delta_file):
+    with open(delta_file, mode='rb') as f:
+        data = f.read(len(BUILD_DELTA_MAGIC) + BUILD_DELTA_HEADER.size)
+    if not data.startswith(BUILD_DELTA_MAGIC):
+        return None
+    return BUILD_DELTA_HEADER.unpack_from(data, len(BUILD_DELTA_MAGIC))
+
+
+# -------------------------------------------------------------------------------------------------
+# Замена выложенных файлов билда дельтами. copied - результат place_build_into_patch; эталон файла -
+# файл с тем же путем в DIR_BUILD_REFERENCE, куда ReferenceBuild загружается так же, как билд в DIR_BUILD_BK
+@traced
+def make_build_deltas(copied):
+    deltas = {}  # файл билда: дельта, считается один раз для всех каталогов патча
+    total_size = total_delta_size = 0
+    for build_file, patch_file in copied:
+        reference_file = get_build_reference_file(build_file)
+        if reference_file is None:
+            continue
+        relative_path = os.path.relpath(build_file, JOB.DIR_BUILD_BK)
+        if build_file not in deltas:
+            with open(reference_file, mode='rb') as f:
+                reference = f.read()
+            with open(build_file, mode='rb') as f:
+                target = f.read()
+            ops = make_binary_delta(reference, target, int(len(target) * BUILD_DELTA_MAX_RATIO))
+            delta = build_delta_bytes(reference, target, ops) if ops is not None else None
+            deltas[build_file] = delta if delta and len(delta) < len(target) * BUILD_DELTA_MAX_RATIO else None
+            log_debug(f'\tBUILD DELTA {relative_path}: '
+                      f'{len(deltas[build_file]) if deltas[build_file] else "none"} of {len(target)} bytes')
+        delta = deltas[build_file]
+        if delta and os.path.isfile(patch_file):
+            with open(patch_file + BUILD_DELTA_EXTENSION, mode='wb') as f:
+                f.write(delta)
+            FILES_WRITTEN.add()
+            total_size += os.path.getsize(patch_file)
+            total_delta_size += len(delta)
+            os.remove(patch_file)
+    log(f'BUILD DELTAS: {sum(1 for delta in deltas.values() if delta)} of {len(deltas)} build files, '
+        f'{total_delta_size} bytes instead of {total_size}')
+
+
+# -------------------------------------------------------------------------------------------------
+# Восстановление файлов билда из дельт патча patch_dir по установленным файлам installed_dir (на стороне клиента).
+# Эталон ищется по имени файла и sha256, результат проверяется по sha256 и заменяет дельту
+@traced
+def apply_build_deltas(patch_dir, installed_dir):
+    installed = collections.defaultdict(list)  # имя в нижнем регистре: пути
+    for d, dirs, files in os.walk(installed_dir):
+        for file_name in files:
+            installed[file_name.lower()].append(os.path.join(d, file_name))
+    installed_sha256 = {}
+    applied = failed = 0
+    for delta_file in list_files_of_all_subdirectories(patch_dir, '*' + BUILD_DELTA_EXTENSION):
+        target_file = delta_file[:-len(BUILD_DELTA_EXTENSION)]
+        try:
+            header = read_build_delta_header(delta_file)
+            if header is None:
+                raise ValueError('NOT A DELTA FILE')
+            reference_size, _, reference_sha256, _ = header
+            reference_file = None
+            for candidate in installed[get_last_element_of_path(target_file).lower()]:
+                if os.path.getsize(candidate) == reference_size:
+                    if candidate not in installed_sha256:
+                        with open(candidate, mode='rb') as f:
+                            installed_sha256[candidate] = hashlib.sha256(f.read()).digest()
+                    if installed_sha256[candidate] == reference_sha256:
+                        reference_file = candidate
+                        break
+            if not reference_file:
+                raise FileNotFoundError(f'NO REFERENCE FILE in "{installed_dir}"')
+            with open(reference_file, mode='rb') as f:
+                reference = f.read()
+            with open(delta_file, mode='rb') as f:
+                target = apply_binary_delta(reference, f.read())
+            with open(target_file + '.tmp', mode='wb') as f:
+                f.write(target)
+            os.replace(target_file + '.tmp', FILES_WRITTEN.add(target_file))
+            os.remove(delta_file)
+            log_debug(f'\tAPPLIED {delta_file} to {reference_file}')
+            applied += 1
+        except BaseException as exc:
+            log(f'\tERROR applying delta "{delta_file}" ({exc})', LOG_ERROR)
+            failed += 1
+    log(f'DELTAS APPLIED: {applied}, FAILED: {failed}')
+    return failed == 0
+
+
+# -------------------------------------------------------------------------------------------------
+@traced
 def copy_bls(clean_destination_dir, source_dir, destination_dir):
     bls_version = '15'
     if os.path.exists(source_dir):
@@ -1959,7 +3630,7 @@ def copy_bls(clean_destination_dir, source_dir, destination_dir):
         try:
             copy_tree(source_dir, destination_dir)
         except BaseException as exc:
-            log(f'\tERROR when copying ({exc})')
+            log(f'\tERROR when copying ({exc})', LOG_ERROR)
             return False
         return True
     else:
@@ -1968,54 +3639,34 @@ def copy_bls(clean_destination_dir, source_dir, destination_dir):
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def copy_bll(settings):
     log('COPYING BLL files to patch')
-    bll_files_only_bank = list_files_remove_paths_and_change_extension(DIR_COMPARED_BLS, '.bll', ['?b*.bls'])
-    bll_files_only_rts = list_files_remove_paths_and_change_extension(DIR_COMPARED_BLS, '.bll', ['RT_*.bls', 'sscommon.bls', 'ssxml.bls', 'sserrors.bls'])
-    bll_files_only_mba = list_files_remove_paths_and_change_extension(DIR_COMPARED_BLS_SOURCE_RCK, '.bll', ['*.bls'])
-    bll_files_all = list_files_remove_paths_and_change_extension(DIR_COMPARED_BLS, '.bll', ['*.bls'])
-    bll_files_tmp = list_files_by_list(DIR_BUILD_BK, bll_files_all)
+    bll_files_only_bank = list_files_remove_paths_and_change_extension(JOB.DIR_COMPARED_BLS, '.bll', BLL_MASKS_ONLY_BANK)
+    bll_files_only_rts = list_files_remove_paths_and_change_extension(JOB.DIR_COMPARED_BLS, '.bll', BLL_MASKS_ONLY_RTS)
+    bll_files_only_mba = list_files_remove_paths_and_change_extension(JOB.DIR_COMPARED_BLS_SOURCE_RCK, '.bll', ['*.bls'])
+    bll_files_all = list_files_remove_paths_and_change_extension(JOB.DIR_COMPARED_BLS, '.bll', ['*.bls'])
+    bll_files_tmp = list_files_by_list(JOB.DIR_BUILD_BK, bll_files_all)
     if len(bll_files_tmp) != len(bll_files_all):
-        log(f'\tERROR: Not all changed BLS files were compiled {list(set(bll_files_all) - set(bll_files_tmp))}')
+        log(f'\tERROR: Not all changed BLS files were compiled {list(set(bll_files_all) - set(bll_files_tmp))}', LOG_ERROR)
         return False
 
-    bll_files_client_mba = list(set(bll_files_all) - set(bll_files_only_bank) - set(bll_files_only_rts))
-    bll_files_client = list(set(bll_files_client_mba) - set(bll_files_only_mba))
-    bll_files_all = list(set(bll_files_all) - set(bll_files_only_rts))
-
-    # копируем bll для банка по списку bll_files_all
-    copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_user(INSTANCE_BANK), bll_files_all)
-    # копируем bll для RTS по списку bll_files_only_rts
-    if settings.BuildRTSZIP:
-        if settings.Is20Version:
-            for release in ['32', '64']:
-                copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_bnk_rts_user(release), bll_files_only_rts)
-        else:
-            copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_bnk_rts_user(), bll_files_only_rts)
-    else:
-        copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_user(INSTANCE_BANK), bll_files_only_rts)
-
-    # копируем bll для клиента по разнице списков  bll_files_all-bll_files_only_bank
-    if settings.ClientEverythingInEXE:
-        copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_exe(INSTANCE_CLIENT), bll_files_client)
-        copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_exe(INSTANCE_CLIENT_MBA), bll_files_client_mba)
-        copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_template_distrib_client_exe(), bll_files_client)
-    else:
-        copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_user(INSTANCE_CLIENT), bll_files_client)
-        copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_user(INSTANCE_CLIENT_MBA), bll_files_client_mba)
-        copy_files_from_all_subdirectories(DIR_BUILD_BK, dir_patch_libfiles_template_distrib_client_user(), bll_files_client)
+    for destination_dir, bll_files in get_bll_destinations(settings, bll_files_all, bll_files_only_bank,
+                                                        bll_files_only_rts, bll_files_only_mba):
+        copy_files_from_all_subdirectories(JOB.DIR_BUILD_BK, destination_dir, bll_files)
     return True
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def copy_yaml():
-    source_dir = DIR_COMPARED_WWW_RT_IC
+    source_dir = JOB.DIR_COMPARED_WWW_RT_IC
     if os.path.exists(source_dir):
         yaml_list = list_files_of_directory(source_dir, "*.yaml")
         if len(yaml_list):
             destination_dir = dir_patch_libfilesreact()
             log(f'COPYING YAML files to {destination_dir}')
-            copy_files_from_dir(source_dir, destination_dir, '*.yaml')
+            copy_files_from_dir(source_dir, destination_dir, ['*.yaml'])
         else:
             log(f'NOT COPYING YAML. No yaml files in {source_dir}')
     else:
@@ -2023,8 +3674,9 @@ def copy_yaml():
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def copy_xsd():
-    source_dir = DIR_COMPARED_XSD
+    source_dir = JOB.DIR_COMPARED_XSD
     if os.path.exists(source_dir):
         destination_dir = dir_patch_libfiles_subsys_xsd(INSTANCE_BANK)
         log(f'COPYING XSD files to {destination_dir}')
@@ -2034,54 +3686,120 @@ def copy_xsd():
 
 
 # -------------------------------------------------------------------------------------------------
+# Каталоги назначения copy_www, copy_rt_tpl, copy_rtf и copy_bll (используются также при планировании патча)
+def get_www_destinations(settings):
+    if settings.Is20Version:
+        return [dir_patch_libfiles_bnk_www(release) for release in ['32', '64']]
+    return [dir_patch_libfiles_bnk_www()]
+
+
+def get_rt_tpl_destinations(settings):
+    if settings.BuildRTSZIP:
+        if settings.Is20Version:
+            return [dir_patch_libfiles_bnk_rts_subsys_template(release) for release in ['32', '64']]
+        return [dir_patch_libfiles_bnk_rts_subsys_template()]
+    return [dir_patch_libfiles_subsys_template()]
+
+
+def get_rtf_destinations(settings, source_dir):
+    destination_dirs = []
+    # Общие и банковские
+    if source_dir in [JOB.DIR_COMPARED_RTF, JOB.DIR_COMPARED_RTF_BANK]:
+        destination_dirs.append(dir_patch_libfiles_subsys_print_rtf(INSTANCE_BANK))
+    # Общие и клиентские
+    if source_dir in [JOB.DIR_COMPARED_RTF, JOB.DIR_COMPARED_RTF_CLIENT]:
+        destination_dirs.append(dir_patch_libfiles_subsys_print_rtf(INSTANCE_CLIENT))
+        destination_dirs.append(dir_patch_libfiles_subsys_print_rtf(INSTANCE_CLIENT_MBA))
+        destination_dirs.append(dir_patch_libfiles_template_distrib_client_subsys_print_rtf())
+        if settings.BuildRTSZIP:
+            if settings.Is20Version:
+                destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_rtf('32'))
+                destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_rtf('64'))
+            else:
+                destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_rtf())
+    # RepJet для всех
+    if source_dir == JOB.DIR_COMPARED_RTF_REPJET:
+        destination_dirs.append(dir_patch_libfiles_subsys_print_repjet(INSTANCE_BANK))
+        destination_dirs.append(dir_patch_libfiles_subsys_print_repjet(INSTANCE_CLIENT))
+        destination_dirs.append(dir_patch_libfiles_subsys_print_repjet(INSTANCE_CLIENT_MBA))
+        destination_dirs.append(dir_patch_libfiles_template_distrib_client_subsys_print_repjet())
+        if settings.BuildRTSZIP:
+            if settings.Is20Version:
+                destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_repjet('32'))
+                destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_repjet('64'))
+            else:
+                destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_repjet())
+    return destination_dirs
+
+
+BLL_MASKS_ONLY_BANK = ['?b*.bls']
+BLL_MASKS_ONLY_RTS = ['RT_*.bls', 'sscommon.bls', 'ssxml.bls', 'sserrors.bls']
+
+
+# bll_files_* - имена BLL, как в copy_bll. Возвращает [(каталог назначения, [имена BLL])]
+def get_bll_destinations(settings, bll_files_all, bll_files_only_bank, bll_files_only_rts, bll_files_only_mba):
+    bll_files_client_mba = list(set(bll_files_all) - set(bll_files_only_bank) - set(bll_files_only_rts))
+    bll_files_client = list(set(bll_files_client_mba) - set(bll_files_only_mba))
+    bll_files_all = list(set(bll_files_all) - set(bll_files_only_rts))
+
+    # bll для банка по списку bll_files_all
+    destinations = [(dir_patch_libfiles_user(INSTANCE_BANK), bll_files_all)]
+    # bll для RTS по списку bll_files_only_rts
+    if settings.BuildRTSZIP:
+        if settings.Is20Version:
+            for release in ['32', '64']:
+                destinations.append((dir_patch_libfiles_bnk_rts_user(release), bll_files_only_rts))
+        else:
+            destinations.append((dir_patch_libfiles_bnk_rts_user(), bll_files_only_rts))
+    else:
+        destinations.append((dir_patch_libfiles_user(INSTANCE_BANK), bll_files_only_rts))
+
+    # bll для клиента по разнице списков  bll_files_all-bll_files_only_bank
+    if settings.ClientEverythingInEXE:
+        destinations.append((dir_patch_libfiles_exe(INSTANCE_CLIENT), bll_files_client))
+        destinations.append((dir_patch_libfiles_exe(INSTANCE_CLIENT_MBA), bll_files_client_mba))
+        destinations.append((dir_patch_libfiles_template_distrib_client_exe(), bll_files_client))
+    else:
+        destinations.append((dir_patch_libfiles_user(INSTANCE_CLIENT), bll_files_client))
+        destinations.append((dir_patch_libfiles_user(INSTANCE_CLIENT_MBA), bll_files_client_mba))
+        destinations.append((dir_patch_libfiles_template_distrib_client_user(), bll_files_client))
+    return destinations
+
+
+# -------------------------------------------------------------------------------------------------
+@traced
 def copy_www(settings):
-    source_dir = DIR_COMPARED_WWW
+    source_dir = JOB.DIR_COMPARED_WWW
     if os.path.exists(source_dir):
         try:
-            if settings.Is20Version:
-                for release in ['32', '64']:
-                    destination_dir = dir_patch_libfiles_bnk_www(release)
-                    log(f'COPYING WWW files to {destination_dir}')
-                    copy_tree(source_dir, destination_dir)
-            else:
-                destination_dir = dir_patch_libfiles_bnk_www()
+            for destination_dir in get_www_destinations(settings):
                 log(f'COPYING WWW files to {destination_dir}')
                 copy_tree(source_dir, destination_dir)
         except BaseException as exc:
-            log(f'\tERROR when copying ({exc})')
+            log(f'\tERROR when copying ({exc})', LOG_ERROR)
     else:
         log(f'NOT COPYING WWW. Path {source_dir} not exists')
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def copy_rt_tpl(settings):
-    source_dir = DIR_COMPARED_RT_TPL
+    source_dir = JOB.DIR_COMPARED_RT_TPL
     if os.path.exists(source_dir):
         try:
-            if settings.BuildRTSZIP:
-                if settings.Is20Version:
-                    for release in ['32', '64']:
-                        destination_dir = dir_patch_libfiles_bnk_rts_subsys_template(release)
-                        log(f'COPYING RT_TPL files to {destination_dir}')
-                        copy_tree(source_dir, destination_dir)
-                else:
-                    destination_dir = dir_patch_libfiles_bnk_rts_subsys_template()
-                    log(f'COPYING RT_TPL files to {destination_dir}')
-                    copy_tree(source_dir, destination_dir)
-            else:
-                destination_dir = dir_patch_libfiles_subsys_template()
+            for destination_dir in get_rt_tpl_destinations(settings):
                 log(f'COPYING RT_TPL files to {destination_dir}')
                 copy_tree(source_dir, destination_dir)
-
         except BaseException as exc:
-            log(f'\tERROR when copying ({exc})')
+            log(f'\tERROR when copying ({exc})', LOG_ERROR)
     else:
         log(f'NOT COPYING RT_TPL. Path {source_dir} not exists')
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def copy_CommonLibraries():
-    source_dir = DIR_COMPARED_CommonLibraries
+    source_dir = JOB.DIR_COMPARED_CommonLibraries
     if os.path.exists(source_dir):
         destination_dir = dir_patch_libfiles(INSTANCE_BANK)
         log(f'COPYING CommonLibraries files to {destination_dir}')
@@ -2091,40 +3809,14 @@ def copy_CommonLibraries():
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def copy_rtf(settings):
-    source_dirs = [DIR_COMPARED_RTF, DIR_COMPARED_RTF_BANK,
-                DIR_COMPARED_RTF_CLIENT, DIR_COMPARED_RTF_REPJET]
+    source_dirs = [JOB.DIR_COMPARED_RTF, JOB.DIR_COMPARED_RTF_BANK,
+                JOB.DIR_COMPARED_RTF_CLIENT, JOB.DIR_COMPARED_RTF_REPJET]
     for source_dir in source_dirs:
         if os.path.exists(source_dir):
-            destination_dirs = []
-            what = 'RTF'
-            # Общие и банковские
-            if source_dir in [DIR_COMPARED_RTF, DIR_COMPARED_RTF_BANK]:
-                destination_dirs.append(dir_patch_libfiles_subsys_print_rtf(INSTANCE_BANK))
-            # Общие и клиентские
-            if source_dir in [DIR_COMPARED_RTF, DIR_COMPARED_RTF_CLIENT]:
-                destination_dirs.append(dir_patch_libfiles_subsys_print_rtf(INSTANCE_CLIENT))
-                destination_dirs.append(dir_patch_libfiles_subsys_print_rtf(INSTANCE_CLIENT_MBA))
-                destination_dirs.append(dir_patch_libfiles_template_distrib_client_subsys_print_rtf())
-                if settings.BuildRTSZIP:
-                    if settings.Is20Version:
-                        destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_rtf('32'))
-                        destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_rtf('64'))
-                    else:
-                        destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_rtf())
-            # RepJet для всех
-            if source_dir == DIR_COMPARED_RTF_REPJET:
-                what = 'RepJet'
-                destination_dirs.append(dir_patch_libfiles_subsys_print_repjet(INSTANCE_BANK))
-                destination_dirs.append(dir_patch_libfiles_subsys_print_repjet(INSTANCE_CLIENT))
-                destination_dirs.append(dir_patch_libfiles_subsys_print_repjet(INSTANCE_CLIENT_MBA))
-                destination_dirs.append(dir_patch_libfiles_template_distrib_client_subsys_print_repjet())
-                if settings.BuildRTSZIP:
-                    if settings.Is20Version:
-                        destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_repjet('32'))
-                        destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_repjet('64'))
-                    else:
-                        destination_dirs.append(dir_patch_libfiles_bnk_rts_subsys_instclnt_template_distrib_client_subsys_print_repjet())
+            destination_dirs = get_rtf_destinations(settings, source_dir)
+            what = 'RepJet' if source_dir == JOB.DIR_COMPARED_RTF_REPJET else 'RTF'
             for destination_dir in destination_dirs:
                 log(f'COPYING {what} files from {source_dir} to {destination_dir}')
                 copy_files_from_dir(source_dir, destination_dir)
@@ -2133,144 +3825,1678 @@ def copy_rtf(settings):
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def copy_mba_dll():
-    copy_files_of_version(os.path.join(DIR_BUILD_BK, 'DLL'), DIR_BUILD_BK, 'Win32', ['*.dll'], [])
-
-
-# -------------------------------------------------------------------------------------------------
-def make_decision_compilation_or_restart():
-    continue_compilation = False
-    if os.path.exists(DIR_AFTER_BLS):
-        log(f'Folder {DIR_AFTER_BLS} EXISTS. So we could CONTINUE bls-compilation.\n\tAsking Maestro for decision.')
-        continue_compilation = input('Maestro, please, ENTER any letter to CONTINUE bls compilation (otherwise patch building will be RESTARTED):') != ''
-        if continue_compilation:
-            log('\tMaestro decided to CONTINUE with bls-compilation instead of restart patch building')
-        else:
-            log('\tMaestro decided to RESTART patch building instead of CONTINUE with bls-compilation')
-        if not continue_compilation:
-            response = input(
-                '\tREALLY?!\n\tMaestro, please, ENTER "Y" to CLEAR ALL and RESTART patch building:').upper()
-            if response and response != 'Y':
-                log(f'\tERROR: wrong answer {response}')
-                exit(1000)
-            continue_compilation = response != 'Y'
-    return continue_compilation
+    copy_files_of_version(os.path.join(JOB.DIR_BUILD_BK, 'DLL'), JOB.DIR_BUILD_BK, 'Win32', ['*.dll'], [])
 
 
 # -------------------------------------------------------------------------------------------------
+@traced
 def get_git_log(settings):
     from_tag = settings.TagBefore
     to_tag = settings.TagAfter
-    git_repo = Repo.init(DIR_AFTER)
-    git = git_repo.git
-    log_items = git.log('--format=%B', '--no-merges', '--abbrev-commit', f'{from_tag}..{to_tag}').split('\n')
-    jira_tickets = []
-    for log_item in log_items:
-        found = re.findall(r'/?\w+-\d+', log_item)
-        for jira_ticket in found:
-            jira_tickets.append(jira_ticket.replace('/',''))
+    jira_tickets = get_jira_tickets(Repo.init(JOB.DIR_AFTER).git, from_tag, to_tag)
     if jira_tickets:
         file_name = get_filename_jira_tickets()
         make_dirs(os.path.dirname(file_name))
         with open(file_name, mode='w') as f:
             log(f'JIRA TICKETS from "{from_tag}" to "{to_tag}" saved to {file_name}')
-            jira_tickets = list(dict.fromkeys(jira_tickets))  # removing duplicates
             f.writelines(','.join(jira_tickets))
 
 
+def get_jira_tickets(git, from_tag, to_tag):
+    return JIRA_INDEX.tickets(git, from_tag, to_tag)
+
+
+# -------------------------------------------------------------------------------------------------
+# Индекс тикетов Jira по коммитам в _CACHE: {коммит: [тикеты из сообщения]}. Коммит не меняется,
+# поэтому индекс общий для всех репозиториев и диапазонов тегов: сообщения читаются из Git только
+# для еще не проиндексированных коммитов, а тикеты диапазона собираются по списку его коммитов (rev-list)
+JIRA_TICKET_PATTERN = re.compile(r'/?\w+-\d+')
+JIRA_INDEX_CHUNK = 500  # больше новых коммитов - сообщения читаются одним git log по диапазону
+
+
+def get_filename_jira_index():
+    return os.path.join(DIR_CACHE, 'jira_index.json')
+
+
+class JiraIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commits = None  # загружается при первом обращении
+
+    def __load(self):
+        if self.commits is None:
+            try:
+                with open(get_filename_jira_index(), encoding='utf-8') as f:
+                    self.commits = json.load(f)['commits']
+            except (OSError, ValueError, KeyError):
+                self.commits = {}
+
+    def __save(self):
+        file_name = get_filename_jira_index()
+        make_dirs(os.path.dirname(file_name))
+        temp_file = f'{file_name}.{os.getpid()}.{threading.get_ident()}'
+        with open(temp_file, mode='w', encoding='utf-8') as f:
+            json.dump({'commits': self.commits}, f, separators=(',', ':'))
+        os.replace(temp_file, file_name)
+
+    @staticmethod
+    def __read_tickets(git, *revisions):
+        tickets = {}
+        for item in git.log('--no-merges', '--format=%x01%H%x00%B', *revisions).split('\x01')[1:]:
+            sha, _, message = item.partition('\x00')
+            tickets[sha.strip()] = list(dict.fromkeys(ticket.replace('/', '')
+                                                      for ticket in JIRA_TICKET_PATTERN.findall(message)))
+        return tickets
+
+    # Индексирует новые коммиты revisions (кроме merge). Возвращает коммиты в порядке git log
+    def update(self, git, *revisions):
+        commits = git.rev_list('--no-merges', *revisions).split()
+        with self.lock:
+            self.__load()
+            missing = [sha for sha in commits if sha not in self.commits]
+        if not missing:
+            return commits
+        if len(missing) > JIRA_INDEX_CHUNK:
+            tickets = self.__read_tickets(git, *revisions)
+        else:
+            tickets = self.__read_tickets(git, '--no-walk=unsorted', *missing)
+        with self.lock:
+            self.commits.update(tickets)
+            self.__save()
+        log_debug(f'\tJIRA INDEX: {len(missing)} new commits indexed')
+        return commits
+
+    # Тикеты диапазона from_tag..to_tag без повторов, в порядке git log
+    def tickets(self, git, from_tag, to_tag):
+        commits = self.update(git, f'{from_tag}..{to_tag}')
+        with self.lock:
+            return list(dict.fromkeys(ticket for sha in commits for ticket in self.commits.get(sha, [])))
+
+    # Самый ранний (по дате создания) тег, в который вошел коммит с тикетом ticket
+    def first_tag(self, git, ticket):
+        self.update(git, '--tags')
+        with self.lock:
+            commits = [sha for sha, tickets in self.commits.items() if ticket in tickets]
+        if not commits:
+            return None
+        tags = git.tag('--sort=creatordate', *[arg for sha in commits for arg in ['--contains', sha]]).split()
+        return tags[0] if tags else None
+
+
+JIRA_INDEX = JiraIndex()
+
+
+# -------------------------------------------------------------------------------------------------
+def get_filename_trace():
+    return filename('trace.json')
+
+
+def get_filename_report():
+    return filename('report.json')
+
+
+def get_filename_journal():
+    return os.path.join(JOB.DIR_TEMP, 'journal.json')
+
+
+# -------------------------------------------------------------------------------------------------
+def hash_values(values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, mode='rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# -------------------------------------------------------------------------------------------------
+# Отпечаток каталога: по содержимому файлов или (для больших билдов) только по именам, размерам и датам
+def hash_directory(path, content=True):
+    items = []
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return hash_values([split_filename(path), stat.st_size, stat.st_mtime])
+    for d, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = os.path.join(d, file_name)
+            relative_path = os.path.relpath(file_path, path)
+            if content:
+                items.append([relative_path, hash_file(file_path)])
+            else:
+                stat = os.stat(file_path)
+                items.append([relative_path, stat.st_size, stat.st_mtime])
+    return hash_values(items)
+
+
+# -------------------------------------------------------------------------------------------------
+class JobCancelled(Exception):
+    pass
+
+
+# Отмена проверяется перед каждым этапом и во время компиляции
+def check_cancelled():
+    if CANCEL_EVENT.is_set():
+        raise JobCancelled('CANCELLED')
+
+
+# -------------------------------------------------------------------------------------------------
+# Журнал этапов сборки патча. Для каждого завершенного этапа хранятся его входные данные (и их хэш),
+# каталоги с результатами и результат. При повторном запуске этап пропускается, если входные данные
+# не изменились и результаты на месте; иначе его результаты удаляются и этап выполняется заново.
+# Входные данные этапа включают отпечатки результатов предыдущих этапов, поэтому изменения
+# распространяются только на зависящие от них этапы. Этап, результат которого помечен 'incomplete',
+# не пропускается и при тех же входных данных: его доделывает update_function.
+class Journal:
+    VERSION = 1  # увеличивать при изменении состава или смысла этапов
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.stages = {}
+        self.lock = threading.Lock()  # этапы могут выполняться параллельно
+        if os.path.exists(file_name):
+            try:
+                with open(file_name, encoding='utf-8') as f:
+                    journal = json.load(f)
+                if journal.get('version') == self.VERSION:
+                    self.stages = journal['stages']
+            except BaseException as exc:
+                log(f'\tWARNING: journal {file_name} is ignored ({exc})', LOG_WARNING)
+
+    def save(self):
+        make_dirs(os.path.dirname(self.file_name))
+        with open(self.file_name, mode='w', encoding='utf-8') as f:
+            json.dump({'version': self.VERSION, 'stages': self.stages}, f, ensure_ascii=False, indent=2)
+
+    def update(self, stage, entry):
+        with self.lock:
+            if entry is None:
+                self.stages.pop(stage, None)
+            else:
+                self.stages[stage] = entry
+            self.save()
+
+    # update_function(запись журнала) - обновление результата прошлого выполнения этапа на месте вместо
+    # выполнения заново; возвращает None, если обновление невозможно (тогда этап выполняется заново)
+    def run(self, stage, inputs, outputs, function, update_function=None):
+        check_cancelled()
+        inputs_hash = hash_values(inputs)
+        entry = self.stages.get(stage)
+        outputs_exist = entry and all(os.path.exists(path) for path in entry['outputs'])
+        incomplete = entry and entry['result'].get('incomplete')
+        if outputs_exist and entry['inputs_hash'] == inputs_hash and not incomplete:
+            log(f'STAGE "{stage}" SKIPPED: inputs not changed since {entry["finished"]}')
+            return entry['result']
+        self.update(stage, None)
+        result = None
+        if outputs_exist and update_function:
+            log(f'STAGE "{stage}" UPDATE (' + ('incomplete' if entry['inputs_hash'] == inputs_hash else 'inputs changed') +
+                f' since {entry["finished"]})')
+            result = update_function(entry)
+            if result is None:
+                log(f'STAGE "{stage}" can not be updated')
+        if result is None:
+            log(f'STAGE "{stage}" BEGIN' + (' (inputs or outputs changed)' if entry else ''))
+            for path in outputs:
+                if os.path.isfile(path):
+                    os.remove(path)
+                else:
+                    clean(path)
+            result = function()
+        # неуспешный этап в журнал не попадает и будет выполнен при следующем запуске
+        if result is not None:
+            self.update(stage, {'inputs': inputs, 'inputs_hash': inputs_hash,
+                                'outputs': [path for path in outputs if os.path.exists(path)],
+                                'result': result, 'finished': current_time_as_string()})
+        return result
+
+
+# -------------------------------------------------------------------------------------------------
+# Изменились ли входные данные этапа только в позициях indices (например, только TagAfter)
+def inputs_changed_only(entry, inputs, indices):
+    return len(entry['inputs']) == len(inputs) and \
+        all(previous == current for index, (previous, current) in enumerate(zip(entry['inputs'], inputs))
+            if index not in indices)
+
+
+# -------------------------------------------------------------------------------------------------
+# Параллельное выполнение независимых этапов. Отдельный пул, а не EXECUTOR: этапы сами отдают
+# задачи в EXECUTOR и ждут их, и при малом числе его потоков заняли бы их все.
+def run_stages_concurrently(*functions):
+    with ContextThreadPoolExecutor(max_workers=len(functions), thread_name_prefix='stage') as executor:
+        futures = [executor.submit(function) for function in functions]
+        return [future.result() for future in futures]
+
+
+# -------------------------------------------------------------------------------------------------
+# Параллельная обработка экземпляров (или релизов 32/64 билда), каждый из которых пишет в свои каталоги.
+# Ошибки сообщаются по каждому экземпляру, после завершения всех выбрасывается одно исключение.
+# Результаты возвращаются в порядке items. Отдельный пул по той же причине, что в run_stages_concurrently
+def run_for_instances(function, items):
+    items = list(items)
+    if len(items) < 2:
+        return [function(item) for item in items]
+    with ContextThreadPoolExecutor(max_workers=len(items), thread_name_prefix='instance') as executor:
+        futures = [executor.submit(function, item) for item in items]
+        concurrent.futures.wait(futures)
+    failed = []
+    for item, future in zip(items, futures):
+        if future.exception() is not None:
+            log(f'\tERROR for {item}: {future.exception()}', LOG_ERROR)
+            failed.append(item)
+    if failed:
+        raise RuntimeError(f'FAILED for {", ".join(failed)}')
+    return [future.result() for future in futures]
+
+
+# -------------------------------------------------------------------------------------------------
+def stage_git_download(settings):
+    if not download_from_git(settings):
+        log('DOWNLOAD FAILED', LOG_ERROR)
+        return None
+    return {'commits': [Repo(path).head.commit.hexsha for path in [JOB.DIR_BEFORE, JOB.DIR_AFTER]]}
+
+
+# -------------------------------------------------------------------------------------------------
+# Сдвинулся только TagAfter: DIR_BEFORE остается, а в DIR_AFTER догружается и извлекается новый тег
+def stage_git_update(settings, entry, inputs):
+    if not inputs_changed_only(entry, inputs, [2]):
+        return None
+    log(f'GIT UPDATE "{JOB.DIR_AFTER}" from tag "{entry["inputs"][2]}" to tag "{settings.TagAfter}"')
+    with trace_span(f'git update {settings.TagAfter}'):
+        if not update_repo_from_git(JOB.DIR_AFTER, settings.TagAfter):
+            return None
+    return {'commits': [Repo(path).head.commit.hexsha for path in [JOB.DIR_BEFORE, JOB.DIR_AFTER]]}
+
+
+# -------------------------------------------------------------------------------------------------
+def stage_compare(settings):
+    changed = compare_directories_before_and_after()
+    if changed:
+        if settings.EifDeltas:
+            make_eif_deltas()
+        if settings.CompareBLSTokens or settings.NormalizeText:
+            drop_equivalent_files(settings)
+            changed = has_compared_changes()
+    return {'changed': changed, 'fingerprint': hash_directory(JOB.DIR_COMPARED) if changed else ''}
+
+
+def has_compared_changes():
+    changed = bool(list_files_of_all_subdirectories(JOB.DIR_COMPARED, '*'))
+    if not changed:
+        clean(JOB.DIR_COMPARED)
+        log('\tFINISHED compare directories. NO CHANGES!!!')
+    return changed
+
+
+# -------------------------------------------------------------------------------------------------
+# Обновление результата сравнения только по путям, изменившимся между прежним и новым TagAfter.
+# Пути запоминаются в результате, по ним обновляются компиляция и патч. В cosmetic - пути BLS, которые
+# между прежним и новым TagAfter изменились только в комментариях и пробелах: их BLL не перекомпилируются
+def stage_compare_update(settings, entry, inputs):
+    commits = inputs[0]
+    before_commit, after_commit = entry['inputs'][0]
+    if before_commit != commits[0] or not inputs_changed_only(entry, inputs, [0]):
+        return None
+    paths = [os.path.join(*path.split('/')) for path in
+            Repo(JOB.DIR_AFTER).git.diff('--name-only', '--no-renames', '-z', after_commit, commits[1]).split('\0')
+            # то же, что пропускает filecmp.dircmp при полном сравнении
+            if path and not set(path.split('/')) & set(filecmp.DEFAULT_IGNORES)]
+    log(f'UPDATING compare result for {len(paths)} paths changed from {after_commit[:8]} to {commits[1][:8]}')
+    for path in paths:
+        before_path, after_path, compared_path = [os.path.join(d, path) for d in [JOB.DIR_BEFORE, JOB.DIR_AFTER, JOB.DIR_COMPARED]]
+        if os.path.isfile(after_path) and \
+                not (os.path.isfile(before_path) and filecmp.cmp(before_path, after_path, shallow=False)):
+            log_debug(f'\tcopying {after_path}')
+            make_dirs(os.path.dirname(compared_path))
+            FILES_WRITTEN.add(shutil.copy2(after_path, compared_path))
+        elif os.path.exists(compared_path):
+            log_debug(f'\tremoving {compared_path}')
+            remove_file_and_empty_dirs(compared_path, JOB.DIR_COMPARED)
+    if settings.EifDeltas:
+        make_eif_deltas(paths)
+    cosmetic = []
+    drop_equivalent_files(settings, paths)
+    if settings.CompareBLSTokens:
+        git = Repo(JOB.DIR_AFTER).git
+        for path in paths:
+            after_path = os.path.join(JOB.DIR_AFTER, path)
+            if not path.lower().endswith('.bls') or not os.path.isfile(after_path):
+                continue
+            try:
+                previous = git.cat_file('blob', f'{after_commit}:{"/".join(path.split(os.sep))}',
+                                        stdout_as_string=False, strip_newline_in_stdout=False)
+            except GitCommandError:
+                continue  # новый файл
+            with open(after_path, mode='rb') as f:
+                if bls_same_tokens(previous, f.read()):
+                    cosmetic.append(path)
+    changed = has_compared_changes()
+    return {'changed': changed, 'fingerprint': hash_directory(JOB.DIR_COMPARED) if changed else '',
+            'update': {'from': after_commit, 'paths': paths, 'cosmetic': cosmetic}}
+
+
+# -------------------------------------------------------------------------------------------------
+def get_build_inputs(settings):
+    return [settings.BuildBK, settings.BuildIC, settings.BuildCrypto, settings.BuildAdditionalFolders,
+            [hash_directory(path, content=False) for path in
+            [settings.BuildBK, settings.BuildIC, settings.ReferenceBuild] + settings.BuildAdditionalFolders if path],
+            settings.PlaceBuildIntoPatchBK, settings.PlaceBuildIntoPatchIC, settings.ReferenceBuild]
+
+
 # -------------------------------------------------------------------------------------------------
-def patch():
+# Блокировки записей общих кэшей (каталог билда в кэше) для параллельных заданий пакетного режима
+CACHE_LOCKS = {}
+CACHE_LOCKS_LOCK = threading.Lock()
+
+
+def get_cache_lock(path):
+    with CACHE_LOCKS_LOCK:
+        return CACHE_LOCKS.setdefault(os.path.normcase(os.path.abspath(path)), threading.Lock())
+
+
+# -------------------------------------------------------------------------------------------------
+# cache_key - ключ общего кэша билдов пакетного режима: билд загружается с сетевого ресурса
+# одним заданием, а остальные задания копируют его из кэша
+def stage_build(settings, cache_key=None):
+    cache_path = os.path.join(DIR_CACHE, 'build', cache_key) if cache_key else None
+    if not cache_path:
+        return __stage_build__(settings, None)
+    # задания с тем же билдом ждут, пока первое из них загрузит его в кэш
+    with get_cache_lock(cache_path):
+        return __stage_build__(settings, cache_path)
+
+
+def __stage_build__(settings, cache_path):
+    if cache_path and os.path.exists(os.path.join(cache_path, 'build.json')):
+        log(f'COPYING BUILD from cache "{cache_path}"')
+        with open(os.path.join(cache_path, 'build.json'), encoding='utf-8') as f:
+            result = json.load(f)
+        for build_path, destination_path in [('BK', JOB.DIR_BUILD_BK), ('IC', JOB.DIR_BUILD_IC),
+                                             ('REFERENCE', JOB.DIR_BUILD_REFERENCE)]:
+            if os.path.exists(os.path.join(cache_path, build_path)):
+                copy_tree(os.path.join(cache_path, build_path), destination_path)
+        settings.Is20Version = result['is20']
+    else:
+        # билд загружается одновременно с git, когда еще неизвестно, понадобится ли компиляция,
+        # поэтому загружаем его всегда (для компиляции или для помещения в патч)
+        build_version, build_ic_version, instances = fetch_build(settings)
+        #  если загрузка основного билда успешна
+        if instances:
+            copy_mba_dll()
+        # Если билд не скачивался, то все равно попробуем получить его версию,
+        # чтобы определиться с каталогами для выкладывания ИК
+        if not instances:
+            build_version = get_build_version(settings)
+            settings.Is20Version = is_20_version(build_version)
+        # эталонный билд для дельт загружается так же, как основной, чтобы пути файлов совпадали
+        reference_version = ''
+        if settings.ReferenceBuild and instances:
+            log(f'COPYING REFERENCE BUILD from "{settings.ReferenceBuild}"')
+            reference_version = __copy_build__(settings.ReferenceBuild, settings.BuildCrypto, JOB.DIR_BUILD_REFERENCE)
+        result = {'downloaded': bool(instances), 'build_version': build_version, 'build_ic_version': build_ic_version,
+                'instances': instances, 'is20': settings.Is20Version, 'reference_version': reference_version}
+        if cache_path:
+            clean(cache_path)
+            for build_path, source_path in [('BK', JOB.DIR_BUILD_BK), ('IC', JOB.DIR_BUILD_IC),
+                                            ('REFERENCE', JOB.DIR_BUILD_REFERENCE)]:
+                if os.path.exists(source_path):
+                    copy_tree(source_path, os.path.join(cache_path, build_path))
+            # build.json пишется последним и означает, что билд в кэше полный
+            with open(os.path.join(cache_path, 'build.json'), mode='w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+    result['fingerprint'] = hash_values([result['build_version'], result['build_ic_version'], current_time_as_string(),
+                                        hash_directory(JOB.DIR_BUILD_BK, content=False)])
+    return result
+
+
+# -------------------------------------------------------------------------------------------------
+# cache_key - ключ общего кэша BLL пакетного режима (одинаковые исходники, билд, версия BLL и профиль защиты)
+def stage_compile(settings, cache_key=None):
+    not_compiled = []
+    compile_all(settings.LicenseServer, settings.LicenseProfile, JOB.DIR_BUILD_BK, JOB.DIR_AFTER_BLS, settings.BLLVersion,
+                settings.CompileTimeout, settings.CompileRetries,
+                os.path.join(DIR_CACHE, 'bll', cache_key) if cache_key else None, not_compiled=not_compiled)
+    return get_compile_stage_result(not_compiled)
+
+
+# -------------------------------------------------------------------------------------------------
+# BLL перекомпилированы заново, поэтому патч должен быть собран заново даже при том же отчете.
+# Неоткомпилированные BLS записываются в журнал, при следующем запуске компилируются только они
+def get_compile_stage_result(not_compiled):
+    result = {'fingerprint': hash_values([hash_file(get_filename_compile_report()), current_time_as_string()])}
+    if not_compiled:
+        log(f'\tCOMPILE INCOMPLETE: {len(not_compiled)} BLS not compiled, they will be compiled on the next run',
+            LOG_WARNING)
+        result.update({'incomplete': True, 'not_compiled': not_compiled})
+    return result
+
+
+# -------------------------------------------------------------------------------------------------
+# Перекомпиляция только измененных BLS и зависящих от них, BLL остальных остаются от прошлой компиляции.
+# Если прошлая компиляция не завершена, а входные данные те же, компилируются только неоткомпилированные
+# в прошлый раз (их bls_get_kept_units считает измененными) и зависящие от них
+def stage_compile_update(settings, entry, inputs, compared, cache_key=None):
+    if entry['result'].get('incomplete') and entry['inputs_hash'] == hash_values(inputs):
+        changed = []
+        log(f'\tCOMPILING AGAIN {len(entry["result"]["not_compiled"])} BLS not compiled in previous run')
+    else:
+        update = compared.get('update')
+        if not update or entry['inputs'][0] != update['from'] or not inputs_changed_only(entry, inputs, [0]):
+            return None
+        bls_dir = os.path.relpath(JOB.DIR_AFTER_BLS, JOB.DIR_AFTER) + os.sep
+        changed = [os.path.basename(path) for path in update['paths']
+                if path.lower().startswith(bls_dir.lower()) and path.lower().endswith('.bls') and
+                path not in update.get('cosmetic', [])]
+    not_compiled = []
+    compile_all(settings.LicenseServer, settings.LicenseProfile, JOB.DIR_BUILD_BK, JOB.DIR_AFTER_BLS, settings.BLLVersion,
+                settings.CompileTimeout, settings.CompileRetries,
+                os.path.join(DIR_CACHE, 'bll', cache_key) if cache_key else None, changed, not_compiled)
+    return get_compile_stage_result(not_compiled)
+
+
+# -------------------------------------------------------------------------------------------------
+def stage_assemble(settings, build, commit):
+    get_git_log(settings)  # формирование списка тикетов
+    copy_yaml()
+    copy_xsd()
+    copy_rt_tpl(settings)
+    copy_rtf(settings)
+    copy_CommonLibraries()
+    inventories = get_eif_inventories()
+    read_exports = functools.lru_cache(maxsize=None)(bls_get_exports)  # ua*.bls общие для банка и клиента
+
+    def assemble_instance(instance):
+        copy_table_10_files_for_data_files(instance, inventories[instance])
+        upgrade10_eif(instance, inventories[instance], read_exports)
+
+    run_for_instances(assemble_instance, inventories)
+    copy_bls(True, JOB.DIR_COMPARED_BLS, dir_patch_libfiles_source())
+    if build['downloaded']:
+        copied = place_build_into_patch(settings, build['build_version'], build['build_ic_version'], build['instances'])
+        if settings.BuildDeltas and build.get('reference_version'):
+            make_build_deltas(copied)
+    # после определения версии билда, потому что надо знать версию билда, чтобы выкладывать WWW
+    copy_www(settings)
+    plan = get_compared_plan()
+    plan_patch_files(settings, plan, bls_get_exports, get_eif_delta_tables(inventories))
+    return {'fingerprint': hash_directory(JOB.DIR_PATCH, content=False), 'commit': commit,
+            'files': get_assembled_files(settings, plan)}
+
+
+# -------------------------------------------------------------------------------------------------
+# Разложенные в патч файлы сравнения (пути от DIR_PATCH и источники от DIR_TEMP) и BLL - по ним
+# stage_assemble_update находит, что заменить и что удалить из патча
+def get_assembled_files(settings, plan):
+    return {'copies': {os.path.relpath(destination_path, JOB.DIR_PATCH): os.path.relpath(source_path, JOB.DIR_TEMP)
+                    for destination_path, source_path in plan.copies.items()},
+            'bll': sorted(os.path.relpath(os.path.join(destination_dir, bll_file), JOB.DIR_PATCH)
+                        for destination_dir, bll_files in plan_bll_files(settings, plan).items()
+                        for bll_file in bll_files)}
+
+
+# -------------------------------------------------------------------------------------------------
+# Результат сравнения и используемые сборкой патча файлы TagAfter на диске в виде PatchPlan
+def get_compared_plan():
+    files = {}
+    for path in [JOB.DIR_COMPARED] + [get_dir(instance) for instance in [INSTANCE_BANK, INSTANCE_CLIENT, INSTANCE_CLIENT_MBA]
+                                for get_dir in [dir_after_base_tables, dir_after_base_tabledata_config]]:
+        for file_path in list_files_of_all_subdirectories(path, '*'):
+            files[file_path] = os.path.getsize(file_path)
+    return PatchPlan(files)
+
+
+# -------------------------------------------------------------------------------------------------
+# Обновление патча на месте после stage_compare_update: заменяются файлы, источники которых изменились,
+# удаляются файлы, которых больше нет в сравнении, Upgrade(10).eif и список тикетов формируются заново.
+# Билд в патче не трогается, BLL затем копирует stage_bll
+def stage_assemble_update(settings, entry, inputs, compared, commit):
+    update = compared.get('update')
+    previous = entry['result']
+    if not update or previous.get('commit') != update['from'] or not inputs_changed_only(entry, inputs, [0, 3]):
+        return None
+    log(f'UPDATING PATCH for {len(update["paths"])} changed paths')
+    inventories = get_eif_inventories()
+    for instance, inventory in inventories.items():
+        remove_table_10_files_for_data_files(instance, inventory)
+        copy_table_10_files_for_data_files(instance, inventory)
+    plan = get_compared_plan()
+    upgrade10 = plan_patch_files(settings, plan, bls_get_exports, get_eif_delta_tables(inventories))
+    files = get_assembled_files(settings, plan)
+
+    changed_sources = {os.path.relpath(os.path.join(root, path), JOB.DIR_TEMP)
+                    for root in [JOB.DIR_COMPARED, JOB.DIR_AFTER] for path in update['paths']}
+    for destination in sorted(set(previous['files']['copies']) - set(files['copies'])) + \
+            sorted(set(previous['files']['bll']) - set(files['bll'])):
+        log_debug(f'\tremoving {destination}')
+        remove_file_and_empty_dirs(os.path.join(JOB.DIR_PATCH, destination), JOB.DIR_PATCH)
+    for destination, source in sorted(files['copies'].items()):
+        if previous['files']['copies'].get(destination) != source or source in changed_sources:
+            log_debug(f'\tcopying {source} to {destination}')
+            make_dirs(os.path.dirname(os.path.join(JOB.DIR_PATCH, destination)))
+            FILES_WRITTEN.add(shutil.copy2(os.path.join(JOB.DIR_TEMP, source), os.path.join(JOB.DIR_PATCH, destination)))
+    for instance, text in upgrade10.items():
+        make_dirs(dir_patch_data(instance))  # как в upgrade10_eif, даже если файлов в нем нет
+        with open(get_filename_upgrade10_eif(instance), mode='w') as f:
+            f.write(text)
+        FILES_WRITTEN.add()
+    if os.path.exists(get_filename_jira_tickets()):
+        os.remove(get_filename_jira_tickets())
+    get_git_log(settings)
+    return {'fingerprint': hash_directory(JOB.DIR_PATCH, content=False), 'commit': commit, 'files': files}
+
+
+# -------------------------------------------------------------------------------------------------
+def stage_bll(settings):
+    # копируем готовые BLL в патч
+    if not copy_bll(settings):
+        return None
+    return {'copied': True}
+
+
+# -------------------------------------------------------------------------------------------------
+# Упаковка патча в zip-архив: файлы сжимаются параллельно (zlib отпускает GIL) во временные файлы,
+# а в архив пишутся по порядку по мере готовности, так что в памяти держится только окно из нескольких файлов.
+# Уже сжатые файлы сохраняются без сжатия. Вместе с архивом пишется манифест с размерами и sha256 файлов
+PACKAGE_STORED_EXTENSIONS = ['.zip', '.7z', '.rar', '.cab', '.gz', '.bz2', '.xz', '.jar', '.msi',
+                             '.jpg', '.jpeg', '.png', '.gif', '.docx', '.xlsx']
+PACKAGE_SPOOL_SIZE = 8 * 1024 * 1024  # сжатые данные большего размера сбрасываются из памяти на диск
+PACKAGE_CHUNK_SIZE = 1024 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+
+
+def get_filename_package():
+    return os.path.join(JOB.DIR_TEMP, 'PATCH.zip')
+
+
+def get_filename_package_manifest():
+    return os.path.join(JOB.DIR_TEMP, 'PATCH.manifest.json')
+
+
+def zip_dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+# Сжатие файла архива в отдельном потоке: данные, CRC32 и sha256 за одно чтение файла
+def package_compress_file(file_path, level):
+    stored = os.path.splitext(file_path)[1].lower() in PACKAGE_STORED_EXTENSIONS
+    compressor = None if stored else zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    spool = None if stored else tempfile.SpooledTemporaryFile(max_size=PACKAGE_SPOOL_SIZE)
+    crc, size, sha256 = 0, 0, hashlib.sha256()
+    with open(file_path, mode='rb') as f:
+        while chunk := f.read(PACKAGE_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            sha256.update(chunk)
+            if compressor:
+                spool.write(compressor.compress(chunk))
+    if compressor:
+        spool.write(compressor.flush())
+        # несжимаемый файл сохраняется как есть
+        if spool.tell() >= size:
+            spool.close()
+            spool = None
+    return {'crc': crc, 'size': size, 'sha256': sha256.hexdigest(), 'spool': spool,
+            'compressed_size': spool.tell() if spool else size}
+
+
+class ZipStreamWriter:
+    # Последовательная запись zip-архива из уже сжатых данных (zip64 - только там, где нужен)
+    def __init__(self, f):
+        self.f = f
+        self.entries = []
+
+    def write(self, name, data, crc, size, compressed_size, method, timestamp, is_dir=False):
+        encoded_name = name.encode('utf-8')
+        zip64 = size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 1, 16, size, compressed_size) if zip64 else b''
+        dos_time, dos_date = zip_dos_date_time(timestamp)
+        offset = self.f.tell()
+        self.f.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, 0x0800, method, dos_time, dos_date,
+                                 crc, ZIP64_LIMIT if zip64 else compressed_size, ZIP64_LIMIT if zip64 else size,
+                                 len(encoded_name), len(extra)))
+        self.f.write(encoded_name)
+        self.f.write(extra)
+        if isinstance(data, bytes):
+            self.f.write(data)
+        elif data:
+            data.seek(0)
+            shutil.copyfileobj(data, self.f, PACKAGE_CHUNK_SIZE)
+        self.entries.append((encoded_name, crc, size, compressed_size, method, dos_time, dos_date, offset, is_dir))
+
+    def close(self):
+        directory_offset = self.f.tell()
+        for encoded_name, crc, size, compressed_size, method, dos_time, dos_date, offset, is_dir in self.entries:
+            zip64_values = [value for value in [size, compressed_size, offset] if value >= ZIP64_LIMIT]
+            extra = struct.pack(f'<HH{len(zip64_values)}Q', 1, 8 * len(zip64_values), *zip64_values) \
+                if zip64_values else b''
+            version = 45 if zip64_values else 20
+            self.f.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, 0x0800, method,
+                                     dos_time, dos_date, crc, min(compressed_size, ZIP64_LIMIT),
+                                     min(size, ZIP64_LIMIT), len(encoded_name), len(extra), 0, 0, 0,
+                                     0x10 if is_dir else 0x20, min(offset, ZIP64_LIMIT)))
+            self.f.write(encoded_name)
+            self.f.write(extra)
+        directory_end = self.f.tell()
+        directory_size = directory_end - directory_offset
+        count = len(self.entries)
+        if count >= 0xFFFF or directory_size >= ZIP64_LIMIT or directory_offset >= ZIP64_LIMIT:
+            self.f.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count,
+                                     directory_size, directory_offset))
+            self.f.write(struct.pack('<IIQI', 0x07064b50, 0, directory_end, 1))
+        self.f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                 min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0))
+
+
+# -------------------------------------------------------------------------------------------------
+@traced
+def package_patch(settings):
+    import zipfile
+    archive, manifest_file = get_filename_package(), get_filename_package_manifest()
+    workers = settings.PackageWorkers or os.cpu_count() or 1
+    log(f'PACKAGING {JOB.DIR_PATCH} into {archive} ({workers} workers, level {settings.PackageLevel})')
     begin_time = time.time()
+    items = []  # (имя в архиве, путь) в порядке обхода, имя пустого каталога оканчивается на /
+    for d, dirs, files in os.walk(JOB.DIR_PATCH):
+        dirs.sort()
+        relative_dir = os.path.relpath(d, JOB.DIR_PATCH)
+        prefix = '' if relative_dir == '.' else '/'.join(relative_dir.split(os.sep)) + '/'
+        if prefix and not dirs and not files:
+            items.append((prefix, d))
+        items.extend((prefix + file_name, os.path.join(d, file_name)) for file_name in sorted(files))
+
+    manifest = {'archive': get_last_element_of_path(archive), 'files': [], 'size': 0, 'compressed_size': 0}
+
+    def write(writer, name, file_path, result):
+        stat = os.stat(file_path)
+        if result is None:
+            writer.write(name, b'', 0, 0, 0, zipfile.ZIP_STORED, stat.st_mtime, is_dir=True)
+            return
+        method = zipfile.ZIP_DEFLATED if result['spool'] else zipfile.ZIP_STORED
+        with result['spool'] or open(file_path, mode='rb') as data:
+            writer.write(name, data, result['crc'], result['size'], result['compressed_size'], method,
+                         stat.st_mtime)
+        manifest['files'].append({'path': name, 'size': result['size'], 'compressed_size': result['compressed_size'],
+                                  'method': 'deflate' if result['spool'] else 'store', 'sha256': result['sha256']})
+        manifest['size'] += result['size']
+        manifest['compressed_size'] += result['compressed_size']
+
+    with open(archive + '.tmp', mode='wb') as f, \
+            ContextThreadPoolExecutor(max_workers=workers, thread_name_prefix='package') as pool:
+        writer = ZipStreamWriter(f)
+        pending = collections.deque()
+        for name, file_path in items:
+            check_cancelled()
+            future = pool.submit(package_compress_file, file_path, settings.PackageLevel) \
+                if not name.endswith('/') else None
+            pending.append((name, file_path, future))
+            # окно из нескольких файлов на поток: сжатие идет впереди записи, но не накапливается
+            while len(pending) > 2 * workers or (pending and (pending[0][2] is None or pending[0][2].done())):
+                name_done, path_done, future_done = pending.popleft()
+                write(writer, name_done, path_done, future_done.result() if future_done else None)
+        while pending:
+            name_done, path_done, future_done = pending.popleft()
+            write(writer, name_done, path_done, future_done.result() if future_done else None)
+        manifest_data = json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8')
+        writer.write(get_last_element_of_path(manifest_file), manifest_data, zlib.crc32(manifest_data),
+                     len(manifest_data), len(manifest_data), zipfile.ZIP_STORED, time.time())
+        writer.close()
+    os.replace(archive + '.tmp', FILES_WRITTEN.add(archive))
+    with open(manifest_file, mode='wb') as f:
+        f.write(manifest_data)
+    FILES_WRITTEN.add()
+    log(f'\tPACKAGED {len(manifest["files"])} files ({manifest["size"]} bytes) '
+        f'into {manifest["compressed_size"]} bytes for {datetime.timedelta(seconds = time.time()-begin_time)} minutes')
+    return True
+
+
+def stage_package(settings):
+    if not package_patch(settings):
+        return None
+    return {'archive': get_filename_package(), 'sha256': hash_file(get_filename_package())}
+
+
+# -------------------------------------------------------------------------------------------------
+def patch(restart=False):
+    try:
+        with measure_stage('patch'):
+            __patch__(restart)
+    finally:
+        TRACER.save(get_filename_trace())
+        REPORT.save(get_filename_report())
+
+
+def __patch__(restart):
     log('=' * 120)
     global_settings = GlobalSettings()
     if not global_settings.was_success():
         log('SETTINGS FAILED')
         return
+    setup_logging(global_settings)
+    setup_concurrency(global_settings)
+    setup_profiling(global_settings)
+    import_git()
+    prepare_patch(global_settings, restart)
 
-    continue_compilation = make_decision_compilation_or_restart()
-    if not continue_compilation:
-        if not clean(DIR_TEMP):
+
+# -------------------------------------------------------------------------------------------------
+# Сборка патча в каталоге DIR_TEMP. shared_caches - использовать общие для заданий пакетного режима
+# кэши билдов и BLL. Возвращает True, если патч собран
+def prepare_patch(global_settings, restart, shared_caches=False):
+    begin_time = time.time()
+    if restart:
+        log('RESTART requested, all previous results will be removed')
+        with measure_stage('clean', [JOB.DIR_TEMP]):
+            cleaned = clean(JOB.DIR_TEMP)
+        if not cleaned:
             log('CLEAN FAILED')
-            return
+            return False
+    journal = Journal(get_filename_journal())
+    build_inputs = get_build_inputs(global_settings)
+    build_cache_key = hash_values(build_inputs) if shared_caches else None
+
+    log('PATCH PREPARATION BEGIN')
+
+    def git_and_compare():
+        git_inputs = [global_settings.git_url, global_settings.TagBefore, global_settings.TagAfter]
+        git = journal.run('git_download', git_inputs, [JOB.DIR_BEFORE, JOB.DIR_AFTER],
+                        lambda: stage_git_download(global_settings),
+                        lambda entry: stage_git_update(global_settings, entry, git_inputs))
+        if git is None:
+            return None, None
+        # при сдвиге только TagAfter результат сравнения, BLL и патч обновляются по изменившимся путям
+        compare_inputs = [git['commits'], global_settings.CompareBLSTokens, global_settings.NormalizeText,
+                          global_settings.EifDeltas]
+        return git, journal.run('compare', compare_inputs, [JOB.DIR_COMPARED],
+                                lambda: stage_compare(global_settings),
+                                lambda entry: stage_compare_update(global_settings, entry, compare_inputs))
+
+    # загрузка билда не зависит от git и идет параллельно с загрузкой из git и сравнением
+    (git, compared), build = run_stages_concurrently(
+        git_and_compare,
+        lambda: journal.run('build', build_inputs, [JOB.DIR_BUILD_BK, JOB.DIR_BUILD_IC, JOB.DIR_BUILD_REFERENCE],
+                            lambda: stage_build(global_settings, build_cache_key)))
+    if git is None:
+        return False
+    if not compared['changed']:
+        log('EXIT')
+        return False
+    global_settings.Is20Version = build['is20']
+    need_compile = os.path.exists(JOB.DIR_COMPARED_BLS) and build['downloaded']
+
+    def compile_stage():
+        if not need_compile:
+            return None
+        compile_inputs = [git['commits'][1], build['fingerprint'], global_settings.LicenseServer,
+                        global_settings.LicenseProfile, global_settings.BLLVersion]
+        bll_cache_key = build_cache_key and hash_values([git['commits'][1], build_cache_key,
+                                                        global_settings.BLLVersion, global_settings.LicenseServer,
+                                                        global_settings.LicenseProfile])
+        # запустим компиляцию этой каши
+        return journal.run('compile', compile_inputs, [dir_compile_log()],
+                        lambda: stage_compile(global_settings, bll_cache_key),
+                        lambda entry: stage_compile_update(global_settings, entry, compile_inputs, compared,
+                                                            bll_cache_key))
+
+    def assemble_stage():
+        assemble_inputs = [compared['fingerprint'], build['fingerprint'],
+                        global_settings.TagBefore, global_settings.TagAfter, global_settings.ClientEverythingInEXE,
+                        global_settings.BuildRTSZIP, global_settings.PlaceBuildIntoPatchBK,
+                        global_settings.PlaceBuildIntoPatchIC, global_settings.BuildDeltas]
+        return journal.run('assemble', assemble_inputs, [JOB.DIR_PATCH],
+                        lambda: stage_assemble(global_settings, build, git['commits'][1]),
+                        lambda entry: stage_assemble_update(global_settings, entry, assemble_inputs, compared,
+                                                            git['commits'][1]))
+
+    # сборка патча (кроме BLL) идет параллельно с компиляцией
+    compiled, assembled = run_stages_concurrently(compile_stage, assemble_stage)
+    if compiled and compiled.get('incomplete'):
+        log(f'ERROR: BLS NOT COMPILED {compiled["not_compiled"]}', LOG_ERROR)
+        return False
+    if compiled:
+        if journal.run('bll', [compiled['fingerprint'], assembled['fingerprint'], global_settings.BuildRTSZIP,
+                            global_settings.ClientEverythingInEXE, global_settings.Is20Version], [],
+                    lambda: stage_bll(global_settings)) is None:
+            return False
+    if global_settings.PackageZip:
+        package_inputs = [hash_directory(JOB.DIR_PATCH, content=False), global_settings.PackageLevel]
+        if journal.run('package', package_inputs, [get_filename_package(), get_filename_package_manifest()],
+                       lambda: stage_package(global_settings)) is None:
+            return False
+    log(f'DONE (for {datetime.timedelta(seconds = time.time()-begin_time)} minutes)')
+    return True
 
-    # Если пользователь не выбрал продолжение компиляции, запустим
-    # ЭТАП ЗАГРУЗКИ ПО МЕТКАМ И СРАВНЕНИЯ РЕВИЗИЙ:
-    if not continue_compilation:
-        log('PATCH PREPARATION BEGIN')
-        if not download_from_git(global_settings):
-            log('DOWNLOAD FAILED')
-            return
-        get_git_log(global_settings)  # формирование списка тикетов
 
-        if not compare_directories_before_and_after():
-            log('EXIT')
-            return
+# -------------------------------------------------------------------------------------------------
+# Имя задания - имя его каталога в _BATCH: части из букв, цифр, '_' и '-' через точку.
+# Имена '.', '..' и подобные не допускаются: каталог задания очищается при restart
+JOB_NAME_PATTERN = re.compile(r'[\w\-]+(\.[\w\-]+)*')
 
-        copy_yaml()
-        copy_xsd()
-        copy_rt_tpl(global_settings)
-        copy_rtf(global_settings)
-        copy_CommonLibraries()
-
-        for instance in [INSTANCE_BANK, INSTANCE_CLIENT, INSTANCE_CLIENT_MBA]:
-            copy_table_10_files_for_data_files(instance)
-            upgrade10_eif(instance)
-        continue_compilation = copy_bls(True, DIR_COMPARED_BLS, dir_patch_libfiles_source())
-        need_download_build = continue_compilation or global_settings.PlaceBuildIntoPatchBK or global_settings.PlaceBuildIntoPatchIC
-        build_downloaded = False
-        # если требуется загрузка билда (для компиляции или для помещения в патч)
-        if need_download_build:
-            build_downloaded = download_build(global_settings)
-            #  если требуется загрузка билда и предыдущая загрузка основного билда успешна
-            if build_downloaded:
-                copy_mba_dll()
-
-        # Если билд не скачивался (при этом мы определяемся с версией билда),
-        # то все равно попробуем получить его версию, чтобы определиться с каталогами
-        # для выкладывания ИК
-        if not build_downloaded:
-            build_version = get_build_version(global_settings)
-            global_settings.Is20Version = is_20_version(build_version)
-        continue_compilation = continue_compilation and (build_downloaded or not need_download_build)
-
-        # после определения версии билда, потому что надо знать версию билда, чтобы выкладывать WWW
-        copy_www(global_settings)
-
-    # если ЭТАП ЗАГРУЗКИ завершился успешно,
-    # или пользователь выбрал переход к компиляции
-    # запускаем ЭТАП КОМПИЛЯЦИИ bls-файлов:
-    if continue_compilation:
-        # запустим компиляцию этой каши
-        if compile_all(global_settings.LicenseServer,
-                    global_settings.LicenseProfile,
-                    DIR_BUILD_BK, DIR_AFTER_BLS,
-                    global_settings.BLLVersion):
-            # копируем готовые BLL в патч
-            copy_bll(global_settings)
-    log(f'DONE (for {datetime.timedelta(seconds = time.time()-begin_time)} minutes)')
+
+def get_job_dir(job_name):
+    if not JOB_NAME_PATTERN.fullmatch(job_name):
+        raise ValueError(f'wrong job name "{job_name}"')
+    job_dir = os.path.join(DIR_BATCH, job_name)
+    # каталог задания (в том числе через ссылку) должен быть внутри _BATCH
+    if os.path.dirname(os.path.realpath(job_dir)) != os.path.realpath(DIR_BATCH):
+        raise ValueError(f'job folder "{job_dir}" is outside of "{DIR_BATCH}"')
+    return job_dir
+
+
+# -------------------------------------------------------------------------------------------------
+# Сборка патча задания в его каталоге _BATCH\<задание> с общими кэшами
+def run_batch_job(job_name, job_settings, restart):
+    job_dir = get_job_dir(job_name)
+    temp_dir = JOB.DIR_TEMP
+    set_temp_dir(job_dir)
+    try:
+        log(f'BATCH JOB "{job_name}" BEGIN in {JOB.DIR_TEMP}')
+        with measure_stage('job', [job_name]):
+            return prepare_patch(job_settings, restart, shared_caches=True)
+    finally:
+        set_temp_dir(temp_dir)
+
+
+# -------------------------------------------------------------------------------------------------
+def get_filename_batch():
+    return filename('batch.ini')
+
+
+# -------------------------------------------------------------------------------------------------
+# Пакетный режим: сборка нескольких патчей (заданий) за один запуск. Каждая секция файла заданий -
+# одно задание, ее параметры заменяют одноименные параметры git2patch.ini. Задания собираются
+# параллельно (не больше BatchJobs одновременно), каждое в своем каталоге _BATCH\<задание>, с общими
+# зеркалом git, кэшем билдов и BLL. Компиляторы, сессии сервера защиты и EXECUTOR общие для всех заданий.
+def batch(batch_file_name, restart=False):
+    try:
+        with measure_stage('batch'):
+            __batch__(batch_file_name, restart)
+    finally:
+        TRACER.save(get_filename_trace())
+        REPORT.save(get_filename_report())
+
+
+def __batch__(batch_file_name, restart):
+    begin_time = time.time()
+    log('=' * 120)
+    global_settings = GlobalSettings()
+    if not global_settings.was_success():
+        log('SETTINGS FAILED')
+        return
+    setup_logging(global_settings)
+    setup_concurrency(global_settings)
+    setup_profiling(global_settings)
+    import_git()
+
+    if not os.path.exists(batch_file_name):
+        log(f'ERROR: NOT FOUND {batch_file_name}', LOG_ERROR)
+        return
+    parser = configparser.RawConfigParser()
+    parser.optionxform = str
+    parser.read(batch_file_name, encoding='UTF-8')
+    jobs = {}
+    for job_name in parser.sections():
+        try:
+            get_job_dir(job_name)
+        except ValueError as exc:
+            log(f'ERROR: BATCH JOB "{job_name}" skipped ({exc})', LOG_ERROR)
+            continue
+        log(f'BATCH JOB "{job_name}" settings:')
+        job_settings = GlobalSettings(dict(parser.items(job_name)))
+        if not job_settings.was_success():
+            log(f'ERROR: BATCH JOB "{job_name}" skipped because of wrong settings', LOG_ERROR)
+            continue
+        jobs[job_name] = job_settings
+    log(f'BATCH BEGIN: {len(jobs)} jobs from {batch_file_name}')
+
+    # зеркала всех репозиториев загружаются параллельно до начала заданий
+    git_urls = sorted(set(job_settings.git_url for job_settings in jobs.values()))
+    try:
+        run_stages_concurrently(*[functools.partial(update_git_mirror, git_url) for git_url in git_urls])
+    except BaseException as exc:
+        log(f'ERROR when updating git mirrors: {exc}', LOG_ERROR)
+        return
+
+    def run_job(job_name):
+        try:
+            return run_batch_job(job_name, jobs[job_name], restart)
+        except BaseException as exc:
+            log(f'ERROR: BATCH JOB "{job_name}" failed: {exc}', LOG_ERROR)
+            return False
+
+    results = {}
+    if jobs:
+        # отдельный пул по той же причине, что в run_stages_concurrently
+        with ContextThreadPoolExecutor(max_workers=global_settings.BatchJobs or len(jobs),
+                                       thread_name_prefix='job') as executor:
+            results = dict(zip(jobs, executor.map(run_job, jobs)))
+    for job_name, result in results.items():
+        log(f'\t{job_name}: ' + (f'PATCH in {os.path.join(DIR_BATCH, job_name, "PATCH")}' if result else 'NO PATCH'))
+    log(f'BATCH DONE (for {datetime.timedelta(seconds = time.time()-begin_time)} minutes)')
+
+
+def apply_deltas(patch_dir, installed_dir):
+    try:
+        with measure_stage('apply_deltas'):
+            log('=' * 120)
+            log(f'APPLYING BUILD DELTAS in "{patch_dir}" to files of "{installed_dir}"')
+            if not apply_build_deltas(patch_dir, installed_dir):
+                log('APPLYING DELTAS FAILED')
+    finally:
+        TRACER.save(get_filename_trace())
+        REPORT.save(get_filename_report())
+
+
+def jira_first_tag(ticket):
+    try:
+        with measure_stage('jira_first_tag'):
+            global_settings = GlobalSettings()
+            if not global_settings.was_success():
+                return
+            setup_logging(global_settings)
+            import_git()
+            git = Repo(update_git_mirror(global_settings.git_url)).git
+            tag = JIRA_INDEX.first_tag(git, ticket)
+            log(f'JIRA TICKET {ticket} first shipped in tag "{tag}"' if tag else f'JIRA TICKET {ticket} not found in tags')
+    finally:
+        TRACER.save(get_filename_trace())
+        REPORT.save(get_filename_report())
 
 
 def compile_only():
+    try:
+        with measure_stage('compile_only'):
+            __compile_only__()
+    finally:
+        TRACER.save(get_filename_trace())
+        REPORT.save(get_filename_report())
+
+
+def __compile_only__():
     # пока не реализовано ----------------------------------------------
     log('=' * 120)
     global_settings = GlobalSettings()  # read_config()
     if not global_settings.was_success():
         return
-    if not clean(DIR_TEMP):
+    setup_logging(global_settings)
+    setup_concurrency(global_settings)
+    setup_profiling(global_settings)
+    import_git()
+    if not clean(JOB.DIR_TEMP):
         return
-    if download_build(global_settings):
+    build_version, build_ic_version, instances = fetch_build(global_settings)
+    if instances:
+        copy_mba_dll()
         if download_from_git(global_settings):
             compile_all(global_settings.LicenseServer, global_settings.LicenseProfile,
-                        DIR_BUILD_BK, DIR_AFTER_BLS, global_settings.BLLVersion)
+                        JOB.DIR_BUILD_BK, JOB.DIR_AFTER_BLS, global_settings.BLLVersion,
+                        global_settings.CompileTimeout, global_settings.CompileRetries)
 
 
-if __name__ == "__main__":
-    argument = None
-    if len(sys.argv) > 1:
-        argument = sys.argv[1]
-    if not argument or argument == '/patch' or argument == '-patch':
-        patch()
-    elif argument == '/compile' or argument == '-compile':
+# -------------------------------------------------------------------------------------------------
+# Планирование патча (git2patch.py -plan): что попадет в патч, без загрузки файлов в _TEMP и без компиляции.
+# Результат сравнения строится по метаданным Git (git diff и git ls-tree с размерами файлов в зеркале
+# репозитория), к нему применяются те же правила раскладки, что в copy_*, upgrade10_eif и copy_bll.
+# Файлы хранятся под путями DIR_COMPARED и DIR_AFTER, но на диске эти каталоги не создаются.
+class PatchPlan:
+    def __init__(self, files):
+        self.files = files  # {путь: размер}
+        self.copies = {}  # {путь в патче: путь источника}
+
+    def exists(self, path):
+        prefix = path + os.sep
+        return any(file_path.startswith(prefix) for file_path in self.files)
+
+    def list(self, path, mask, recursive=True):
+        prefix = path + os.sep
+        return sorted(file_path for file_path in self.files
+                    if file_path.startswith(prefix) and (recursive or os.sep not in file_path[len(prefix):])
+                    and fnmatch.fnmatch(os.path.basename(file_path), mask))
+
+    def copy_tree(self, source_dir, destination_dir):
+        for file_path in self.list(source_dir, '*'):
+            self.copies[os.path.join(destination_dir, os.path.relpath(file_path, source_dir))] = file_path
+
+    def copy_files(self, source_dir, destination_dir, wildcards=None, recursive=False):
+        for wildcard in wildcards or ['*.*']:
+            for file_path in self.list(source_dir, wildcard, recursive):
+                self.copies[os.path.join(destination_dir, os.path.basename(file_path))] = file_path
+
+
+# -------------------------------------------------------------------------------------------------
+# Файлы TagAfter под DIR_AFTER и измененные/новые файлы под DIR_COMPARED (как после сравнения каталогов)
+# settings - для сравнения файлов по смыслу, как в drop_equivalent_files
+def get_plan_files(git, tag_before, tag_after, settings=None):
+    files = {}
+    for item in git.ls_tree('-r', '-l', '-z', tag_after).split('\0'):
+        if item:
+            meta, path = item.split('\t', 1)
+            mode, object_type, sha, size = meta.split()
+            if object_type == 'blob':
+                files[os.path.join(JOB.DIR_AFTER, *path.split('/'))] = int(size)
+    items = git.diff('--name-status', '--no-renames', '-z', tag_before, tag_after).split('\0')
+    for status, path in zip(items[0::2], items[1::2]):
+        # удаленные файлы в результат сравнения не попадают
+        if status[:1] in ['A', 'M', 'T']:
+            equivalence = settings and status[:1] != 'A' and \
+                get_file_equivalence(settings, os.path.join(*path.split('/')))
+            if equivalence and equivalence(*[git.cat_file('blob', f'{tag}:{path}', stdout_as_string=False,
+                                                          strip_newline_in_stdout=False)
+                                             for tag in [tag_before, tag_after]]):
+                continue
+            files[os.path.join(JOB.DIR_COMPARED, *path.split('/'))] = files[os.path.join(JOB.DIR_AFTER, *path.split('/'))]
+    return files
+
+
+# -------------------------------------------------------------------------------------------------
+# Версия билда без копирования: каталог билда только просматривается, архив не распаковывается
+def get_build_version_for_plan(build_path):
+    import zipfile
+    if not build_path or not os.path.exists(build_path):
+        return ''
+    if os.path.isdir(build_path):
+        return extract_build_version(build_path)
+    with zipfile.ZipFile(build_path) as z:
+        for version_file in BUILD_VERSION_FILES:
+            for member in z.namelist():
+                if get_last_element_of_path(member).lower() == version_file.lower():
+                    version = __get_version_from_pe_data__(z.read(member))
+                    if version not in [None, '1.0.0.0', '0.0.0.0']:
+                        return version
+    return 'unknown'
+
+
+# -------------------------------------------------------------------------------------------------
+# read_exports(путь к BLS) - экспортируемые функции BLS (из Git при планировании, с диска при обновлении патча),
+# delta_tables - таблицы, выложенные дельтой (eif_delta_tables)
+def plan_upgrade10_eif(plan, instance, read_exports, delta_tables):
+    inventory = EifInventory(plan.list(dir_compared_base(instance), '*.eif'))
+    for source_path, eif10_file in get_table_10_files_for_data_files(instance, inventory):
+        if source_path in plan.files:  # copy_table_10_files_for_data_files
+            plan.files[eif10_file] = plan.files[source_path]
+            inventory.add(eif10_file)
+
+    # upgrade10_eif
+    patch_data_dir = dir_patch_data(instance)
+    plan.copy_files(dir_compared_base(instance), patch_data_dir, ['*.eif'], recursive=True)
+    for source_dir, masks in get_upgrade10_controls_copies(instance, inventory):
+        plan.copy_files(source_dir, patch_data_dir, masks)
+    return get_upgrade10_eif_text(instance, inventory, plan.list(dir_compared_bls(), upgrade10_ua_bls_mask(instance)),
+                                  read_exports, delta_tables, plan.exists(JOB.DIR_COMPARED_WWW_react))
+
+
+# -------------------------------------------------------------------------------------------------
+# Раскладка файлов сравнения по патчу: повторяет stage_assemble (кроме билда и BLL).
+# Возвращает тексты Upgrade(10).eif по экземплярам
+def plan_patch_files(settings, plan, read_exports, delta_tables):
+    plan.copy_files(JOB.DIR_COMPARED_WWW_RT_IC, dir_patch_libfilesreact(), ['*.yaml'])  # copy_yaml
+    plan.copy_tree(JOB.DIR_COMPARED_XSD, dir_patch_libfiles_subsys_xsd(INSTANCE_BANK))  # copy_xsd
+    for destination_dir in get_rt_tpl_destinations(settings):  # copy_rt_tpl
+        plan.copy_tree(JOB.DIR_COMPARED_RT_TPL, destination_dir)
+    for source_dir in [JOB.DIR_COMPARED_RTF, JOB.DIR_COMPARED_RTF_BANK, JOB.DIR_COMPARED_RTF_CLIENT, JOB.DIR_COMPARED_RTF_REPJET]:
+        for destination_dir in get_rtf_destinations(settings, source_dir):  # copy_rtf
+            plan.copy_files(source_dir, destination_dir)
+    plan.copy_tree(JOB.DIR_COMPARED_CommonLibraries, dir_patch_libfiles(INSTANCE_BANK))  # copy_CommonLibraries
+    upgrade10 = {}
+    for instance in [INSTANCE_BANK, INSTANCE_CLIENT, INSTANCE_CLIENT_MBA]:
+        upgrade10[instance] = plan_upgrade10_eif(plan, instance, read_exports, delta_tables[instance])
+    # copy_bls
+    source_dir, destination_dir = JOB.DIR_COMPARED_BLS, dir_patch_libfiles_source()
+    if plan.exists(os.path.join(source_dir, 'SOURCE')):
+        source_dir, destination_dir = os.path.join(source_dir, 'SOURCE'), os.path.join(destination_dir, 'BLS')
+    plan.copy_tree(source_dir, destination_dir)
+    for destination_dir in get_www_destinations(settings):  # copy_www
+        plan.copy_tree(JOB.DIR_COMPARED_WWW, destination_dir)
+    return upgrade10
+
+
+# -------------------------------------------------------------------------------------------------
+# BLL измененных BLS по каталогам патча (copy_bll): {каталог: [имена BLL]}
+def plan_bll_files(settings, plan):
+    def bll_names(path, masks):
+        return [replace_ext(os.path.basename(file_path), '.bll') for mask in masks for file_path in plan.list(path, mask)]
+
+    bll_files = {}
+    for destination_dir, names in get_bll_destinations(settings, bll_names(JOB.DIR_COMPARED_BLS, ['*.bls']),
+                                                    bll_names(JOB.DIR_COMPARED_BLS, BLL_MASKS_ONLY_BANK),
+                                                    bll_names(JOB.DIR_COMPARED_BLS, BLL_MASKS_ONLY_RTS),
+                                                    bll_names(JOB.DIR_COMPARED_BLS_SOURCE_RCK, ['*.bls'])):
+        if names:
+            bll_files.setdefault(destination_dir, []).extend(sorted(names))
+    return bll_files
+
+
+# -------------------------------------------------------------------------------------------------
+# Дельты data-файлов по Git (как make_eif_deltas): размеры дельт заменяют размеры файлов в плане.
+# Возвращает {экземпляр: {имя таблицы: ключевые поля}}
+def get_plan_eif_deltas(git, plan, settings):
+    delta_tables = {instance: {} for instance in [INSTANCE_BANK, INSTANCE_CLIENT, INSTANCE_CLIENT_MBA]}
+    if not settings.EifDeltas:
+        return delta_tables
+    for path in plan.list(os.path.join(JOB.DIR_COMPARED, 'BASE'), '*(data).eif'):
+        parts = os.path.relpath(path, JOB.DIR_COMPARED).split(os.sep)
+        table_name = eif_table_name(path)
+        if parts[1] not in delta_tables or not eif_delta_allowed(table_name):
+            continue
+        try:
+            structure, before, after = [
+                git.cat_file('blob', f'{tag}:{"/".join(git_parts)}', stdout_as_string=False,
+                            strip_newline_in_stdout=False)
+                for tag, git_parts in [(settings.TagAfter, parts[:2] + ['TABLES', f'{table_name}(10).eif']),
+                                    (settings.TagBefore, parts), (settings.TagAfter, parts)]]
+        except BaseException:
+            continue  # нет структуры или таблица новая
+        key_fields = eif_get_key_fields(structure)
+        ranges = eif_make_delta(before, after, key_fields) if key_fields else None
+        if ranges is not None:
+            plan.files[path] = eif_ranges_size(ranges)
+            delta_tables[parts[1]][table_name.lower()] = key_fields
+    return delta_tables
+
+
+def get_eif_delta_tables(inventories):
+    return {instance: eif_delta_tables(instance, inventory) for instance, inventory in inventories.items()}
+
+
+# -------------------------------------------------------------------------------------------------
+def decode_text(data):
+    # те же кодировки, что в open_encoding_aware
+    for encoding in ['windows-1251', 'utf-8']:
+        try:
+            return data.decode(encoding)
+        except ValueError:
+            pass
+    return data.decode('utf-8', errors='replace')
+
+
+# -------------------------------------------------------------------------------------------------
+@traced
+def make_patch_plan(settings):
+    git = Repo(update_git_mirror(settings.git_url)).git
+    commits = {tag: git.rev_parse(f'{tag}^{{commit}}') for tag in [settings.TagBefore, settings.TagAfter]}
+    plan = PatchPlan(get_plan_files(git, settings.TagBefore, settings.TagAfter, settings))
+    build_version = get_build_version_for_plan(settings.BuildBK)
+    build_ic_version = get_build_version_for_plan(settings.BuildIC) if settings.PlaceBuildIntoPatchIC else ''
+    # как в stage_build: версия определяется по последнему экземпляру
+    settings.Is20Version = is_20_version(build_ic_version or build_version)
+
+    def read_exports(file_path):
+        git_path = '/'.join(os.path.relpath(file_path, JOB.DIR_COMPARED).split(os.sep))
+        return bls_get_exports_from_text(decode_text(git.cat_file('blob', f'{settings.TagAfter}:{git_path}',
+                                                                stdout_as_string=False,
+                                                                strip_newline_in_stdout=False)))
+
+    upgrade10 = plan_patch_files(settings, plan, read_exports, get_plan_eif_deltas(git, plan, settings))
+    # компилируются все BLS из TagAfter, в патч попадают BLL измененных (copy_bll)
+    compile_plan = {'needed': False, 'bls': [], 'bll': {}}
+    if plan.exists(JOB.DIR_COMPARED_BLS) and build_version:
+        compile_plan['needed'] = True
+        compile_plan['bls'] = sorted(os.path.basename(file_path) for file_path in plan.list(JOB.DIR_AFTER_BLS, '*.bls'))
+        for destination_dir, bll_files in plan_bll_files(settings, plan).items():
+            compile_plan['bll'][os.path.relpath(destination_dir, JOB.DIR_PATCH)] = bll_files
+
+    files = []
+    directories = {}
+    for destination_path, source_path in sorted(plan.copies.items()):
+        relative_path = os.path.relpath(destination_path, JOB.DIR_PATCH)
+        source_root = JOB.DIR_COMPARED if source_path.startswith(JOB.DIR_COMPARED + os.sep) else JOB.DIR_AFTER
+        files.append({'destination': relative_path, 'source': os.path.relpath(source_path, source_root),
+                    'size': plan.files[source_path]})
+        # итоги по каталогам верхнего уровня патча: BANK\LIBFILES, CLIENT\LIBFILES.BNK и т.д.
+        directory = directories.setdefault(os.sep.join(relative_path.split(os.sep)[:2]), {'files': 0, 'bytes': 0})
+        directory['files'] += 1
+        directory['bytes'] += plan.files[source_path]
+    return {'git': {'url': settings.git_url, 'tag_before': settings.TagBefore, 'tag_after': settings.TagAfter,
+                    'commits': commits},
+            'jira_tickets': get_jira_tickets(git, settings.TagBefore, settings.TagAfter),
+            'changed_files': len([path for path in plan.files if path.startswith(JOB.DIR_COMPARED + os.sep)]),
+            # файлы самого билда не перечисляются: их состав определяется при копировании билда
+            'build': {'path': settings.BuildBK, 'version': build_version, 'is20': settings.Is20Version,
+                    'place_into_patch': settings.PlaceBuildIntoPatchBK,
+                    'ic_path': settings.BuildIC if settings.PlaceBuildIntoPatchIC else '', 'ic_version': build_ic_version},
+            'compile': compile_plan,
+            'upgrade10': upgrade10,
+            'directories': directories,
+            'total_bytes': sum(directory['bytes'] for directory in directories.values()),
+            'files': files}
+
+
+# -------------------------------------------------------------------------------------------------
+def get_filename_plan():
+    return filename('plan.json')
+
+
+def plan():
+    try:
+        with measure_stage('plan'):
+            __plan__()
+    finally:
+        TRACER.save(get_filename_trace())
+        REPORT.save(get_filename_report())
+
+
+def __plan__():
+    begin_time = time.time()
+    log('=' * 120)
+    global_settings = GlobalSettings()
+    if not global_settings.was_success():
+        log('SETTINGS FAILED')
+        return
+    setup_logging(global_settings)
+    setup_concurrency(global_settings)
+    setup_profiling(global_settings)
+    import_git()
+    try:
+        patch_plan = make_patch_plan(global_settings)
+    except BaseException as exc:
+        log(f'ERROR: PLAN FAILED ({exc})', LOG_ERROR)
+        return
+    with open(get_filename_plan(), mode='w', encoding='utf-8') as f:
+        json.dump(patch_plan, f, ensure_ascii=False, indent=2)
+    log_plan(patch_plan)
+    log(f'PLAN saved to {get_filename_plan()} (for {datetime.timedelta(seconds = time.time()-begin_time)} minutes)')
+
+
+def log_plan(patch_plan):
+    log(f'PLAN: {patch_plan["changed_files"]} changed files, {len(patch_plan["files"])} files to patch '
+        f'({patch_plan["total_bytes"]} bytes), build {patch_plan["build"]["version"] or "not set"}')
+    for directory, totals in sorted(patch_plan['directories'].items()):
+        log(f'\t{directory}: {totals["files"]} files, {totals["bytes"]} bytes')
+    if patch_plan['compile']['needed']:
+        log(f'\tCOMPILE {len(patch_plan["compile"]["bls"])} BLS')
+
+
+# Показ сохраненного плана без обращения к Git
+def show_plan():
+    if not os.path.exists(get_filename_plan()):
+        log(f'ERROR: NOT FOUND {get_filename_plan()}, run "git2patch.py plan" first', LOG_ERROR)
+        return
+    with open(get_filename_plan(), encoding='utf-8') as f:
+        patch_plan = json.load(f)
+    log(f'PLAN from {patch_plan["git"]["tag_before"]} to {patch_plan["git"]["tag_after"]} ({get_filename_plan()})')
+    log_plan(patch_plan)
+
+
+# -------------------------------------------------------------------------------------------------
+# Версия билда: из build_path (каталог или архив) или из BuildBK настроек
+def show_build_version(build_path=None):
+    if build_path is None:
+        global_settings = GlobalSettings()
+        if not global_settings.was_success():
+            log('SETTINGS FAILED')
+            return
+        build_path = global_settings.BuildBK
+    if not build_path or not os.path.exists(build_path):
+        log(f'ERROR: NOT FOUND build "{build_path}"', LOG_ERROR)
+        return
+    log(f'BUILD VERSION of "{build_path}" is {get_build_version_for_plan(build_path)}')
+
+
+# -------------------------------------------------------------------------------------------------
+# Общие кэши пакетного режима и службы в DIR_CACHE: размеры или очистка (kinds - подкаталоги, по умолчанию все)
+CACHE_KINDS = ['git', 'build', 'bll', 'jira']
+
+
+def get_cache_path(kind):
+    return get_filename_jira_index() if kind == 'jira' else os.path.join(DIR_CACHE, kind)
+
+
+def show_cache(clear_kinds=None):
+    for kind in CACHE_KINDS:
+        path = get_cache_path(kind)
+        if clear_kinds is not None and (not clear_kinds or kind in clear_kinds):
+            clean(path)
+            continue
+        files = [path] if os.path.isfile(path) else list_files_of_all_subdirectories(path, '*')
+        log(f'CACHE {kind}: {len(files)} files, {sum(os.path.getsize(file) for file in files)} bytes ({path})')
+
+
+# -------------------------------------------------------------------------------------------------
+# Режим службы (git2patch.py -serve [порт]): процесс не завершается, поэтому зеркала Git, кэш билдов,
+# кэш BLL, версии файлов билда и uses исходников BLS остаются "прогретыми" между сборками.
+# Задания на сборку патча принимаются через HTTP API, доступный только с localhost:
+#   GET    /status         - состояние службы и кэшей
+#   GET    /jobs           - список заданий
+#   POST   /jobs           - новое задание {"name": ..., "settings": {параметр: значение}, "restart": false}
+#   GET    /jobs/<id>      - состояние задания
+#   GET    /jobs/<id>/log  - лог задания, передается по мере записи до завершения задания
+#   DELETE /jobs/<id>      - отмена задания
+#   POST   /shutdown       - остановка службы
+# Задания выполняются по очереди, каждое в каталоге _BATCH\<имя задания>, как в пакетном режиме.
+class ServiceJob:
+    def __init__(self, job_id, name, overrides, restart):
+        self.id = job_id
+        self.name = name
+        self.overrides = overrides
+        self.restart = restart
+        self.status = 'queued'  # queued, running, done, failed, cancelled
+        self.cancel_event = threading.Event()
+        self.submitted = current_time_as_string()
+        self.started = None
+        self.finished = None
+        self.log_begin = None  # границы лога задания в git2patch.log
+        self.log_end = None
+
+    def is_finished(self):
+        return self.status in ['done', 'failed', 'cancelled']
+
+    def as_dict(self):
+        return {'id': self.id, 'name': self.name, 'status': self.status, 'settings': self.overrides,
+                'restart': self.restart, 'submitted': self.submitted, 'started': self.started,
+                'finished': self.finished, 'patch': os.path.join(DIR_BATCH, self.name, 'PATCH')}
+
+
+# -------------------------------------------------------------------------------------------------
+class JobConflict(Exception):
+    pass
+
+
+# -------------------------------------------------------------------------------------------------
+def run_service_job(job):
+    job_settings = GlobalSettings(job.overrides)
+    if not job_settings.was_success():
+        return False
+    update_git_mirror(job_settings.git_url)
+    return run_batch_job(job.name, job_settings, job.restart)
+
+
+# -------------------------------------------------------------------------------------------------
+class PatchService:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.started = current_time_as_string()
+        self.thread = threading.Thread(target=self.__work, name='service', daemon=True)
+        self.thread.start()
+
+    # ValueError - неверное имя задания, JobConflict - задание с этим именем (и каталогом) уже в очереди или выполняется
+    def submit(self, name, overrides, restart):
+        with self.lock:
+            job_id = len(self.jobs) + 1
+            job = ServiceJob(job_id, name or f'job{job_id}', overrides, restart)
+            get_job_dir(job.name)
+            active = [other for other in self.jobs.values()
+                      if other.name.lower() == job.name.lower() and not other.is_finished()]
+            if active:
+                raise JobConflict(f'job "{job.name}" is already {active[0].status} (id {active[0].id})')
+            self.jobs[job_id] = job
+        log(f'SERVICE JOB {job.id} "{job.name}" QUEUED')
+        self.queue.put(job)
+        return job
+
+    def cancel(self, job):
+        log(f'SERVICE JOB {job.id} "{job.name}" CANCEL requested')
+        job.cancel_event.set()
+
+    def stop(self):
+        for job in list(self.jobs.values()):
+            job.cancel_event.set()
+        self.queue.put(None)
+        self.thread.join()
+
+    def status(self):
+        def cached(kind):
+            cache_path = os.path.join(DIR_CACHE, kind)
+            return sorted(os.listdir(cache_path)) if os.path.isdir(cache_path) else []
+
+        with self.lock:
+            jobs = collections.Counter(job.status for job in self.jobs.values())
+        return {'started': self.started, 'jobs': dict(jobs), 'git_mirrors': GIT_MIRRORS,
+                'exe_info_cache': __read_exe_file_info__.cache_info()._asdict(),
+                'bls_uses_cache': len(BLS_USES_CACHE),
+                'build_cache': cached('build'), 'bll_cache': cached('bll')}
+
+    def __work(self):
+        global CANCEL_EVENT
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if job.cancel_event.is_set():
+                job.finished = current_time_as_string()
+                job.status = 'cancelled'
+                continue
+            CANCEL_EVENT = job.cancel_event
+            flush_log()
+            job.log_begin = os.path.getsize(get_filename_log())
+            job.started = current_time_as_string()
+            job.status = 'running'
+            status = 'failed'
+            try:
+                log(f'SERVICE JOB {job.id} "{job.name}" BEGIN')
+                if run_service_job(job):
+                    status = 'done'
+            except JobCancelled:
+                status = 'cancelled'
+            except BaseException as exc:
+                log(f'ERROR: SERVICE JOB {job.id} "{job.name}" failed: {exc}', LOG_ERROR)
+            finally:
+                CANCEL_EVENT = threading.Event()
+                job_dir = os.path.join(DIR_BATCH, job.name)
+                make_dirs(job_dir)
+                TRACER.save(os.path.join(job_dir, 'trace.json'), clear=True)
+                REPORT.save(os.path.join(job_dir, 'report.json'), clear=True)
+                log(f'SERVICE JOB {job.id} "{job.name}" FINISHED: {status}')
+                flush_log()
+                job.log_end = os.path.getsize(get_filename_log())
+                job.finished = current_time_as_string()
+                job.status = status
+
+
+# -------------------------------------------------------------------------------------------------
+# Методы обработчика запросов службы; сам класс (с http.server.BaseHTTPRequestHandler) собирается в serve()
+class PatchServiceHandler:
+    service = None
+    LOG_POLL_SECONDS = 0.5
+
+    def log_message(self, format, *args):
+        log_debug(f'SERVICE {self.address_string()} {format % args}')
+
+    def send_json(self, code, value):
+        data = json.dumps(value, ensure_ascii=False, indent=2).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_path_parts(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+
+    def get_job(self, parts):
+        job = self.service.jobs.get(int(parts[1])) if len(parts) > 1 and parts[1].isdigit() else None
+        if job is None:
+            self.send_json(404, {'error': f'job not found: {self.path}'})
+        return job
+
+    def do_GET(self):
+        parts = self.get_path_parts()
+        if parts == ['status']:
+            self.send_json(200, self.service.status())
+        elif parts == ['jobs']:
+            self.send_json(200, [job.as_dict() for job in list(self.service.jobs.values())])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self.get_job(parts)
+            if job:
+                self.send_json(200, job.as_dict())
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'log':
+            job = self.get_job(parts)
+            if job:
+                self.stream_log(job)
+        else:
+            self.send_json(404, {'error': f'unknown path: {self.path}'})
+
+    def do_POST(self):
+        parts = self.get_path_parts()
+        if parts == ['jobs']:
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                name = str(request.get('name') or '')
+                overrides = {str(key): str(value) for key, value in (request.get('settings') or {}).items()}
+                job = self.service.submit(name, overrides, bool(request.get('restart')))
+            except (ValueError, AttributeError) as exc:
+                self.send_json(400, {'error': str(exc)})
+                return
+            except JobConflict as exc:
+                self.send_json(409, {'error': str(exc)})
+                return
+            self.send_json(201, job.as_dict())
+        elif parts == ['shutdown']:
+            self.send_json(202, {'status': 'stopping'})
+            threading.Thread(target=self.server.shutdown, name='service shutdown').start()
+        else:
+            self.send_json(404, {'error': f'unknown path: {self.path}'})
+
+    def do_DELETE(self):
+        parts = self.get_path_parts()
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = self.get_job(parts)
+            if job:
+                self.service.cancel(job)
+                self.send_json(202, job.as_dict())
+        else:
+            self.send_json(404, {'error': f'unknown path: {self.path}'})
+
+    def stream_log(self, job):
+        # лог отдается без Content-Length частями по мере записи, соединение закрывается по завершении задания
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        offset = None
+        try:
+            while True:
+                finished = job.is_finished()
+                if job.log_begin is not None:
+                    offset = job.log_begin if offset is None else offset
+                    end = job.log_end if job.log_end is not None else os.path.getsize(get_filename_log())
+                    if end > offset:
+                        with open(get_filename_log(), mode='rb') as f:
+                            f.seek(offset)
+                            self.wfile.write(f.read(end - offset))
+                        self.wfile.flush()
+                        offset = end
+                if finished:
+                    break
+                time.sleep(self.LOG_POLL_SECONDS)
+        except ConnectionError:
+            pass  # клиент отключился
+        self.close_connection = True
+
+
+# -------------------------------------------------------------------------------------------------
+def serve(port=None):
+    log('=' * 120)
+    global_settings = GlobalSettings()
+    if not global_settings.was_success():
+        log('SETTINGS FAILED')
+        return
+    setup_logging(global_settings)
+    setup_concurrency(global_settings)
+    setup_profiling(global_settings)
+    import_git()
+    server = create_service_server(global_settings.ServicePort if port is None else port)
+    log(f'SERVICE listening on http://127.0.0.1:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.stop()
+        log('SERVICE STOPPED')
+
+
+# HTTP-сервер службы только на localhost (port 0 - любой свободный порт) со своей очередью заданий
+def create_service_server(port):
+    import http.server
+    service = PatchService()
+    handler = type('PatchServiceHandler', (PatchServiceHandler, http.server.BaseHTTPRequestHandler),
+                   {'service': service})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.service = service
+    return server
+
+
+# -------------------------------------------------------------------------------------------------
+# Командная строка: git2patch.py <команда> [параметры], без команды - сборка патча.
+# Прежняя форма ключей (-patch, /compile, -restart и т.д.) тоже принимается.
+# Ключ справки первым параметром (-h, --help, /?) - справка по всем командам, а не по patch
+CLI_COMMANDS = ['patch', 'compile', 'plan', 'version', 'cache', 'serve', 'batch', 'apply-deltas', 'jira-first-tag']
+CLI_HELP = ['h', 'help', '?']
+
+
+def normalize_arguments(arguments):
+    result = []
+    for index, argument in enumerate(arguments):
+        name = argument.lstrip('/-') if argument[:1] in '/-' and not argument.startswith('--') else None
+        if name == 'restart':
+            result.append('--restart')
+        elif index == 0 and name in CLI_COMMANDS:
+            result.append(name)
+        elif index == 0 and name in CLI_HELP:
+            result.append('--help')
+        else:
+            result.append(argument)
+    if not result or (result[0].startswith('--') and result[0] != '--help'):
+        result.insert(0, 'patch')
+    return result
+
+
+def main(arguments=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='git2patch.py', description='Patch builder from git tags')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    command = commands.add_parser('patch', help='build the patch (default)')
+    command.add_argument('--restart', action='store_true', help='rebuild ignoring results of the previous run')
+    commands.add_parser('compile', help='compile BLS of TagAfter only')
+    command = commands.add_parser('plan', help='plan the patch from git without building it')
+    command.add_argument('--show', action='store_true', help='show the saved plan instead of making a new one')
+    command = commands.add_parser('version', help='show the build version')
+    command.add_argument('build', nargs='?', help='build folder or archive (BuildBK by default)')
+    command = commands.add_parser('cache', help='show or clear shared caches')
+    command.add_argument('--clear', nargs='*', choices=CACHE_KINDS, metavar='KIND',
+                         help=f'clear caches ({", ".join(CACHE_KINDS)}; all by default)')
+    command = commands.add_parser('serve', help='run the patch service')
+    command.add_argument('port', nargs='?', type=int, help='port (Port from [SERVICE] by default)')
+    command = commands.add_parser('batch', help='build patches for jobs of a batch file')
+    command.add_argument('batch_file', nargs='?', help='batch file (git2patch.batch.ini by default)')
+    command.add_argument('--restart', action='store_true', help='rebuild ignoring results of the previous run')
+    command = commands.add_parser('apply-deltas', help='restore build files of a patch from deltas')
+    command.add_argument('patch_dir', help='patch folder')
+    command.add_argument('installed_dir', help='installed build folder')
+    command = commands.add_parser('jira-first-tag', help='find the first tag shipping a Jira ticket')
+    command.add_argument('ticket')
+    args = parser.parse_args(normalize_arguments(sys.argv[1:] if arguments is None else arguments))
+
+    if args.command == 'patch':
+        patch(args.restart)
+    elif args.command == 'compile':
         compile_only()
-    else:
-        log(f'UNKNOWN ARGUMENT {argument}')
\ No newline at end of file
+    elif args.command == 'plan':
+        show_plan() if args.show else plan()
+    elif args.command == 'version':
+        show_build_version(args.build)
+    elif args.command == 'cache':
+        show_cache(args.clear)
+    elif args.command == 'serve':
+        serve(args.port)
+    elif args.command == 'batch':
+        batch(args.batch_file or get_filename_batch(), args.restart)
+    elif args.command == 'apply-deltas':
+        apply_deltas(args.patch_dir, args.installed_dir)
+    elif args.command == 'jira-first-tag':
+        jira_first_tag(args.ticket)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
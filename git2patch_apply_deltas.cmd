@@ -0,0 +1,2 @@
+"%PYTHON%" -m git2patch apply-deltas %1 %2
+pause
\ No newline at end of file
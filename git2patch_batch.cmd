@@ -0,0 +1,2 @@
+"%PYTHON%" -m git2patch batch
+pause
\ No newline at end of file
@@ -0,0 +1,2 @@
+"%PYTHON%" git2patch_bench.py run --runs 3
+pause
\ No newline at end of file
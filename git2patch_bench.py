@@ -0,0 +1,308 @@
+import argparse
+import importlib
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+# Бенчмарк git2patch без внутреннего Git-сервера, сетевой папки с билдами и лицензионного bscc.exe:
+#   - синтетический Git-репозиторий с раскладкой как у настоящего (BLS, BASE, WWW, RTF, XSD, RT_TPL)
+#     и двумя метками, между которыми изменено заданное число файлов;
+#   - поддельный билд (каталог или zip) с PE-файлами нужной версии и разрядности;
+#   - заглушка компилятора с настраиваемой задержкой (этот же скрипт с командой stub-compiler).
+# Каждый прогон выполняется в отдельном каталоге с копией git2patch.py и своим git2patch.ini,
+# время этапов берется из отчета git2patch.report.json.
+
+TAG_BEFORE = 'bench.before'
+TAG_AFTER = 'bench.after'
+INSTANCES = ['BANK', 'CLIENT', 'CLIENT_MBA']
+IMAGE_FILE_MACHINE = {'Win32': 0x14c, 'Win64': 0x8664}
+BUILD_FILES = ['cbank.exe', 'bscc.exe', 'CBStart.exe', 'bsiset.exe', 'UpdateIc.exe', 'eif2base.exe', 'CalcCRC.exe',
+               'Setup.exe', 'Install.exe', 'ilKern.dll', 'GetIName.dll', 'ilGroup.dll', 'iliGroup.dll', 'ilProt.dll',
+               'ilCpyDoc.dll', 'LocProt.dll', 'PerfControl.dll', 'bsi.dll', 'rtl.bpl', 'vcl.bpl']
+
+
+# -------------------------------------------------------------------------------------------------
+def log(message_text):
+    print(f'[bench] {message_text}', flush=True)
+
+
+# -------------------------------------------------------------------------------------------------
+def write_file(path, text, encoding='windows-1251'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode='w', encoding=encoding, newline='\r\n') as f:
+        f.write(text)
+
+
+# -------------------------------------------------------------------------------------------------
+def run_git(repo_path, *args):
+    subprocess.run(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', *args],
+                   cwd=repo_path, check=True, stdout=subprocess.DEVNULL)
+
+
+# -------------------------------------------------------------------------------------------------
+# Граф uses: BLS-файлы разложены по уровням (depth), каждый файл использует fanout файлов следующего уровня
+def make_bls_units(count, fanout, depth):
+    levels = [[] for _ in range(max(1, depth))]
+    for number in range(count):
+        prefix = random.choice(['ub', 'uc', 'ua', 'bs', 'rt_', 'ss']) if number % 10 else 'ua'
+        levels[number % len(levels)].append(f'{prefix}unit{number:05}')
+    units = {}
+    for level, names in enumerate(levels):
+        below = levels[level + 1] if level + 1 < len(levels) else []
+        for name in names:
+            units[name] = random.sample(below, min(fanout, len(below)))
+    return units
+
+
+# -------------------------------------------------------------------------------------------------
+def bls_text(name, uses, revision):
+    uses_text = f'uses\n  {", ".join(uses)};\n\n' if uses else ''
+    return f'{{ {name}.bls, revision {revision} }}\nunit {name};\n\n{uses_text}' \
+           f'exports\n  Run{name};\n\n' \
+           f'// revision {revision}\nprocedure Run{name};\nbegin\nend;\n\nend.\n'
+
+
+# -------------------------------------------------------------------------------------------------
+def eif_text(table_name, structure_type, revision, records):
+    lines = ['[SECTION]', f'Name = {table_name} ({structure_type})', 'Type = DSPStructure', 'Version = 100',
+             f'ObjectType = {structure_type}', f'ObjectName = {table_name}', f'TableName = {table_name}', '[DATA]']
+    if structure_type == 10:
+        # первичный ключ по ID: по нему data-файлы выкладываются дельтой
+        lines += [' [TREE]', '  Indexes', '    PKey', '      Fields', '        ID:integer = 0',
+                  '      Unique:boolean = TRUE', '      Primary:boolean = TRUE']
+    lines += [' [FIELDS]', '  ID', '  Name', '  Revision', ' [RECORDS]']
+    # в каждой ревизии меняется каждая десятая запись
+    lines += [f"  <{number}|'{table_name} record {number}'|{revision if number % 10 == 0 else 1}>"
+              for number in range(records)]
+    return '\n'.join(lines + ['[END]', ''])
+
+
+# -------------------------------------------------------------------------------------------------
+def generate_repository(repo_path, options):
+    random.seed(options.seed)
+    if os.path.exists(repo_path):
+        shutil.rmtree(repo_path)
+    os.makedirs(repo_path)
+    run_git(repo_path, 'init', '-q')
+
+    units = make_bls_units(options.bls, options.fanout, options.depth)
+    files = {}
+    for name, uses in units.items():
+        files[os.path.join('BLS', 'SOURCE', name + '.bls')] = lambda revision, n=name, u=uses: bls_text(n, u, revision)
+    for instance in INSTANCES:
+        for number in range(options.eif):
+            table_name = f'TABLE{number:04}'
+            base = os.path.join('BASE', instance)
+            files[os.path.join(base, 'TABLES', f'{table_name}(10).eif')] = \
+                lambda revision, t=table_name: eif_text(t, 10, revision, 0)
+            files[os.path.join(base, 'Table data', 'Config', f'{table_name}(data).eif')] = \
+                lambda revision, t=table_name: eif_text(t, 'data', revision, options.records)
+    for number in range(options.www):
+        files[os.path.join('WWW', 'BSI_SITES', 'RT_IC', f'form{number:04}.yaml')] = \
+            lambda revision, n=number: f'form: {n}\nrevision: {revision}\n'
+    for number in range(options.rtf):
+        folder = ['Bank', 'Client', 'RepJet'][number % 3]
+        files[os.path.join('RTF', folder, f'print{number:04}.rtf')] = \
+            lambda revision, n=number: f'{{\\rtf1\\ansi print form {n} revision {revision}}}'
+        files[os.path.join('XSD', f'schema{number:04}.xsd')] = \
+            lambda revision, n=number: f'<xs:schema revision="{revision}"><!-- {n} --></xs:schema>'
+        files[os.path.join('RT_TPL', f'template{number:04}.tpl')] = \
+            lambda revision, n=number: f'template {n} revision {revision}'
+
+    for path, make_text in files.items():
+        write_file(os.path.join(repo_path, path), make_text(0))
+    run_git(repo_path, 'add', '-A')
+    run_git(repo_path, 'commit', '-q', '-m', 'BENCH-1 initial revision')
+    run_git(repo_path, 'tag', TAG_BEFORE)
+
+    changed = random.sample(sorted(files), min(options.changed, len(files)))
+    for number, path in enumerate(changed):
+        write_file(os.path.join(repo_path, path), files[path](1))
+        if number % 10 == 9:
+            run_git(repo_path, 'add', '-A')
+            run_git(repo_path, 'commit', '-q', '-m', f'BENCH-{number + 2} change {number}')
+    run_git(repo_path, 'add', '-A')
+    run_git(repo_path, 'commit', '-q', '--allow-empty', '-m', 'BENCH-0 last change')
+    run_git(repo_path, 'tag', TAG_AFTER)
+    log(f'GENERATED repository {repo_path}: {len(files)} files, {len(units)} BLS, {len(changed)} changed')
+
+
+# -------------------------------------------------------------------------------------------------
+# Минимальный PE-файл: заголовок MZ, сигнатура PE с типом машины и блок VS_VERSION_INFO с версией
+def fake_pe(platform, version, size):
+    major, minor, build, release = [int(part) for part in version.split('.')]
+    header = bytearray(b'MZ' + b'\0' * 126)
+    struct.pack_into('<L', header, 60, 64)
+    struct.pack_into('<4sH', header, 64, b'PE\0\0', IMAGE_FILE_MACHINE[platform])
+    version_info = struct.pack('32s', 'VS_VERSION_INFO'.encode('utf-16-le')) + \
+        struct.pack('13I', 0, 0, 0, 0, (minor << 16) | build, (release << 16) | major, 0, 0, 0, 0, 0, 0, 0)
+    padding = os.urandom(max(0, size - len(header) - len(version_info)))
+    return bytes(header) + padding + version_info
+
+
+# -------------------------------------------------------------------------------------------------
+def generate_build(build_path, options):
+    if os.path.exists(build_path):
+        shutil.rmtree(build_path)
+    is20 = options.build_version.startswith('20.')
+    releases = ['Win32', 'Win64'] if is20 else ['Win32']
+    for release in releases:
+        release_path = os.path.join(build_path, release, 'Release') if is20 else build_path
+        os.makedirs(release_path, exist_ok=True)
+        for file_name in BUILD_FILES:
+            with open(os.path.join(release_path, file_name), mode='wb') as f:
+                f.write(fake_pe(release, options.build_version, options.build_file_size))
+    if options.build_zip:
+        zip_path = build_path.rstrip('\\/') + '.zip'
+        with zipfile.ZipFile(zip_path, mode='w', compression=zipfile.ZIP_DEFLATED) as z:
+            for d, _, files in os.walk(build_path):
+                for file_name in files:
+                    path = os.path.join(d, file_name)
+                    z.write(path, os.path.relpath(path, build_path))
+        shutil.rmtree(build_path)
+        build_path = zip_path
+    log(f'GENERATED build {options.build_version} in {build_path}')
+    return build_path
+
+
+# -------------------------------------------------------------------------------------------------
+def write_settings(ini_path, repo_path, build_path, options):
+    write_file(ini_path, '\n'.join([
+        '[SPECIAL]', f'Git = {repo_path}', 'ClientEverythingInEXE = False', 'BuildRTSZIP = False',
+        f'LogLevel = {options.log_level}', 'LicenseServer = bench', 'LicenseProfile = bench', '',
+        '[BUILD]', 'ADDITIONAL = ', f'BK = {build_path}', 'IC = ', 'Crypto = ',
+        f'PlaceBuildIntoPatchBK = {options.place_build}', 'PlaceBuildIntoPatchIC = False', 'BLLVersion = 1.0.0', '',
+        '[TAGS]', f'TagBefore = {TAG_BEFORE}', f'TagAfter = {TAG_AFTER}', '',
+        '[CONCURRENCY]', f'CompilerProcesses = {options.compilers}', 'LicenseSessions = 0', 'IOWorkers = 0', '']),
+        encoding='utf-8')
+
+
+# -------------------------------------------------------------------------------------------------
+def run_patch(run_path, options):
+    # git2patch вычисляет рабочие каталоги от текущего каталога при импорте,
+    # а настройки и лог ищет рядом с собой, поэтому запускаем его копию внутри каталога прогона
+    shutil.copy2(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'git2patch.py'), run_path)
+    os.chdir(run_path)
+    sys.path.insert(0, run_path)
+    sys.modules.pop('git2patch', None)
+    git2patch = importlib.import_module('git2patch')
+    git2patch.COMPILER_COMMAND = [sys.executable, os.path.abspath(__file__), 'stub-compiler',
+                                  '--latency', str(options.compiler_latency),
+                                  '--fail-rate', str(options.compiler_fail_rate)]
+    begin = time.perf_counter()
+    # каждый прогон - полная сборка, без учета журнала этапов предыдущего прогона
+    git2patch.patch(restart=True)
+    wall_seconds = time.perf_counter() - begin
+    git2patch.flush_log()
+    sys.path.remove(run_path)
+    with open(git2patch.get_filename_report(), encoding='utf-8') as f:
+        return wall_seconds, json.load(f)['stages']
+
+
+# -------------------------------------------------------------------------------------------------
+def summarize(runs):
+    # время этапа в прогоне - сумма по всем его вызовам (например, upgrade10_eif для каждого экземпляра)
+    summary = {}
+    for run in runs:
+        per_run = {}
+        for stage in run['stages']:
+            calls, wall_seconds = per_run.get(stage['stage'], (0, 0.0))
+            per_run[stage['stage']] = (calls + 1, wall_seconds + stage['wall_seconds'])
+        for name, (calls, wall_seconds) in per_run.items():
+            item = summary.setdefault(name, {'calls': calls, 'wall_seconds': []})
+            item['wall_seconds'].append(round(wall_seconds, 3))
+    for item in summary.values():
+        item['best'] = min(item['wall_seconds'])
+        item['median'] = sorted(item['wall_seconds'])[len(item['wall_seconds']) // 2]
+    return summary
+
+
+# -------------------------------------------------------------------------------------------------
+def benchmark(options):
+    work_path = os.path.abspath(options.work_dir or os.path.join(tempfile.gettempdir(), 'git2patch_bench'))
+    repo_path = os.path.join(work_path, 'repo')
+    generate_repository(repo_path, options)
+    build_path = generate_build(os.path.join(work_path, 'build'), options)
+    runs = []
+    for number in range(options.runs):
+        run_path = os.path.join(work_path, f'run{number + 1}')
+        if os.path.exists(run_path):
+            shutil.rmtree(run_path)
+        os.makedirs(run_path)
+        write_settings(os.path.join(run_path, 'git2patch.ini'), repo_path, build_path, options)
+        log(f'RUN {number + 1} of {options.runs} in {run_path}')
+        wall_seconds, stages = run_patch(run_path, options)
+        runs.append({'wall_seconds': round(wall_seconds, 3), 'stages': stages})
+
+    summary = summarize(runs)
+    log(f'{"stage":<45}{"calls":>6}{"best, s":>12}{"median, s":>12}')
+    for name, item in sorted(summary.items(), key=lambda pair: -pair[1]['median']):
+        log(f'{name:<45}{item["calls"]:>6}{item["best"]:>12.3f}{item["median"]:>12.3f}')
+    log(f'TOTAL wall: {[run["wall_seconds"] for run in runs]}')
+    result_path = os.path.join(work_path, 'bench_result.json')
+    with open(result_path, mode='w', encoding='utf-8') as f:
+        json.dump({'options': vars(options), 'summary': summary, 'runs': runs}, f, ensure_ascii=False, indent=2)
+    log(f'RESULT saved to {result_path}')
+
+
+# -------------------------------------------------------------------------------------------------
+# Заглушка bscc.exe: ждет заданное время, пишет bll рядом с bls и печатает то же, что настоящий компилятор
+def stub_compiler(options):
+    time.sleep(options.latency)
+    if random.random() < options.fail_rate:
+        print(f'{os.path.basename(options.bls_path)}(1): Error: stub compiler failure')
+        return 1
+    with open(os.path.splitext(options.bls_path)[0] + '.bll', mode='wb') as f:
+        f.write(b'BLL')
+    print('Compiled succesfully')
+    return 0
+
+
+# -------------------------------------------------------------------------------------------------
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark of git2patch on synthetic repository and build')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='generate synthetic data and time patch() stages (default)')
+    run.add_argument('--work-dir', help='directory for repository, build and runs (default: temp dir)')
+    run.add_argument('--runs', type=int, default=1)
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--bls', type=int, default=200, help='number of BLS units')
+    run.add_argument('--fanout', type=int, default=3, help='number of units in "uses" of each unit')
+    run.add_argument('--depth', type=int, default=5, help='number of levels in uses graph')
+    run.add_argument('--eif', type=int, default=50, help='number of tables per instance')
+    run.add_argument('--records', type=int, default=100, help='number of records in each (data).eif')
+    run.add_argument('--www', type=int, default=20)
+    run.add_argument('--rtf', type=int, default=30)
+    run.add_argument('--changed', type=int, default=100, help='number of files changed between tags')
+    run.add_argument('--build-version', default='20.3.206.0')
+    run.add_argument('--build-file-size', type=int, default=256 * 1024)
+    run.add_argument('--build-zip', action='store_true', help='pack fake build into zip')
+    run.add_argument('--place-build', action='store_true', help='PlaceBuildIntoPatchBK = True')
+    run.add_argument('--compilers', type=int, default=0, help='CompilerProcesses (0 - by cores)')
+    run.add_argument('--compiler-latency', type=float, default=0.2, help='stub compiler latency, seconds')
+    run.add_argument('--compiler-fail-rate', type=float, default=0.0)
+    run.add_argument('--log-level', default='INFO')
+    stub = commands.add_parser('stub-compiler', help='stub of bscc.exe used by benchmark')
+    stub.add_argument('--latency', type=float, default=0.0)
+    stub.add_argument('--fail-rate', type=float, default=0.0)
+    stub.add_argument('bls_path')
+    stub.add_argument('compiler_options', nargs=argparse.REMAINDER)
+    arguments = sys.argv[1:]
+    if not arguments or arguments[0] not in ['run', 'stub-compiler', '-h', '--help']:
+        arguments = ['run'] + arguments
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    options = parse_arguments()
+    if options.command == 'stub-compiler':
+        sys.exit(stub_compiler(options))
+    else:
+        benchmark(options)
\ No newline at end of file
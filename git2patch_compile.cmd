@@ -1,2 +1,2 @@
-"%PYTHON%" git2patch.py -compile
+"%PYTHON%" -m git2patch compile
 pause
\ No newline at end of file
@@ -1,2 +1,2 @@
-"%PYTHON%" git2patch.py -patch
+"%PYTHON%" -m git2patch patch
 pause
\ No newline at end of file
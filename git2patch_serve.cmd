@@ -0,0 +1,2 @@
+"%PYTHON%" -m git2patch serve
+pause
\ No newline at end of file
@@ -0,0 +1,2 @@
+"%PYTHON%" -m git2patch version
+pause
\ No newline at end of file
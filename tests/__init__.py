@@ -0,0 +1,34 @@
+# Модульные тесты git2patch: python -m unittest discover -s tests -t . (или python -m pytest tests)
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import git2patch  # noqa: E402
+
+# clean() переносит каталоги в DIR_TRASH, а clean_leftovers() удаляет оттуда остатки других процессов git2patch,
+# поэтому тесты не должны трогать _TRASH рабочего каталога: по умолчанию корзина - во временном каталоге
+TESTS_TRASH_ROOT = tempfile.mkdtemp(prefix='git2patch_tests_')
+git2patch.DIR_TRASH = os.path.join(TESTS_TRASH_ROOT, '_TRASH')
+atexit.register(shutil.rmtree, TESTS_TRASH_ROOT, True)
+
+
+def wait_background_clean():
+    for thread in threading.enumerate():
+        if thread.name == 'clean':
+            thread.join()
+
+
+# Своя корзина теста в каталоге root (обычно временном каталоге теста). Фоновое удаление дожидается
+# завершения до удаления root, поэтому use_temp_trash вызывается после регистрации очистки root
+def use_temp_trash(test_case, root):
+    patcher = mock.patch.object(git2patch, 'DIR_TRASH', os.path.join(root, '_TRASH'))
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+    test_case.addCleanup(wait_background_clean)
+    return git2patch.DIR_TRASH
\ No newline at end of file
@@ -0,0 +1,72 @@
+import unittest
+
+import git2patch
+
+SOURCE = '''unit uaTest;
+{$I defines.inc}
+uses uaLib;
+
+// процедура
+procedure Test(a: integer);
+var s: string;
+begin
+  (* многострочный
+     комментарий *)
+  s := 'text { not a comment } (* not *) // not';
+  if a <> 0 then s := s + 'it''s'; { комментарий }
+end;
+
+exports Test;
+end.
+'''
+
+
+def same(before, after):
+    return git2patch.bls_same_tokens(before.encode('windows-1251'), after.encode('windows-1251'))
+
+
+class BlsSameTokensTest(unittest.TestCase):
+    def test_identical(self):
+        self.assertTrue(same(SOURCE, SOURCE))
+
+    def test_comments_and_whitespace(self):
+        for before, after in [("// процедура", "// другой комментарий"),
+                              ("{ комментарий }", "{ другой\r\n  комментарий }"),
+                              ("(* многострочный", "(* измененный"),
+                              ("  s := 'text", "\ts  :=  'text"),
+                              ("end;\n\nexports", "end;\r\n\r\n\r\nexports"),
+                              ("if a <> 0 then", "if a <> 0 { проверка } then"),
+                              ("exports Test;", "exports Test; // экспорт")]:
+            with self.subTest(after=after):
+                self.assertIn(before, SOURCE)
+                self.assertTrue(same(SOURCE, SOURCE.replace(before, after)))
+
+    def test_comment_marks_inside_strings(self):
+        # скобки и // внутри строки - часть строки, а не комментарий
+        for before, after in [("{ not a comment }", "{ changed }"), ("(* not *)", "(* changed *)"),
+                              ("// not'", "// changed'")]:
+            with self.subTest(after=after):
+                self.assertFalse(same(SOURCE, SOURCE.replace(before, after)))
+        self.assertFalse(same("s := '{'; x := 1; // '}'", "s := '{'; x := 2; // '}'"))
+        self.assertFalse(same("s := '(*'; x := 1; s := '*)';", "s := '(*'; x := 2; s := '*)';"))
+        self.assertFalse(same("s := '//'; x := 1;", "s := '//'; x := 2;"))
+
+    def test_directives(self):
+        self.assertFalse(same(SOURCE, SOURCE.replace('{$I defines.inc}', '{$I other.inc}')))
+        self.assertFalse(same(SOURCE, SOURCE.replace('{$I defines.inc}', '')))
+        self.assertFalse(same('(*$R+*) x := 1;', '(*$R-*) x := 1;'))
+        self.assertFalse(same('(*$R+*) x := 1;', '(* R+*) x := 1;'))
+
+    def test_string_changes(self):
+        self.assertFalse(same(SOURCE, SOURCE.replace("'it''s'", "'its'")))
+        self.assertFalse(same(SOURCE, SOURCE.replace("'text {", "'text  {")))
+        self.assertFalse(same("s := 'a b';", "s := 'a  b';"))
+
+    def test_code_changes(self):
+        self.assertFalse(same(SOURCE, SOURCE.replace('a <> 0', 'a <> 1')))
+        self.assertFalse(same(SOURCE, SOURCE.replace('a <> 0', 'a < > 0')))
+        self.assertFalse(same(SOURCE, SOURCE.replace('exports Test;', 'exports Test, Test2;')))
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
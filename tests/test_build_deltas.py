@@ -0,0 +1,95 @@
+import os
+import random
+import tempfile
+import unittest
+
+import git2patch
+
+git2patch.LOGGER.level = git2patch.LOG_ERROR + 1  # тесты не пишут git2patch.log
+
+
+def make_delta(reference, target, max_literal=None):
+    ops = git2patch.make_binary_delta(reference, target, len(target) if max_literal is None else max_literal)
+    return git2patch.build_delta_bytes(reference, target, ops) if ops is not None else None
+
+
+class BinaryDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.reference = random.Random(1).randbytes(300000)
+
+    def assert_round_trip(self, target):
+        delta = make_delta(self.reference, target)
+        self.assertIsNotNone(delta)
+        self.assertEqual(git2patch.apply_binary_delta(self.reference, delta), target)
+        return delta
+
+    def test_same_file(self):
+        delta = self.assert_round_trip(self.reference)
+        self.assertLess(len(delta), 1000)
+
+    def test_changed_file(self):
+        target = bytearray(self.reference)
+        target[1000:1010] = b'x' * 10  # замена
+        target[50000:50000] = b'inserted' * 100  # вставка
+        del target[200000:201000]  # удаление
+        target += b'appended'
+        delta = self.assert_round_trip(bytes(target))
+        self.assertLess(len(delta), len(target) // 10)
+
+    def test_moved_blocks(self):
+        self.assert_round_trip(self.reference[150000:] + self.reference[:150000])
+
+    def test_small_and_empty_files(self):
+        self.reference = b'abc'
+        self.assert_round_trip(b'abcd')
+        self.assert_round_trip(b'')
+        self.reference = b''
+        self.assert_round_trip(b'new file')
+
+    def test_too_many_literals(self):
+        target = random.Random(2).randbytes(10000)
+        self.assertIsNone(make_delta(self.reference, target, max_literal=5000))
+
+    def test_wrong_reference(self):
+        delta = make_delta(self.reference, self.reference[:-1])
+        with self.assertRaises(ValueError):
+            git2patch.apply_binary_delta(self.reference[1:], delta)
+        with self.assertRaises(ValueError):
+            git2patch.apply_binary_delta(self.reference, b'not a delta')
+
+
+class ApplyBuildDeltasTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.patch_dir = os.path.join(temp_dir.name, 'PATCH')
+        self.installed_dir = os.path.join(temp_dir.name, 'INSTALLED')
+        self.reference = random.Random(1).randbytes(100000)
+        self.target = self.reference[:50000] + b'changed' + self.reference[50000:]
+        self.write(os.path.join(self.installed_dir, 'EXE', 'Bank.exe'), self.reference)
+        # файл с тем же именем, но другим содержимым, эталоном не считается
+        self.write(os.path.join(self.installed_dir, 'OLD', 'BANK.EXE'), self.reference[::-1])
+        self.delta_file = os.path.join(self.patch_dir, 'BANK', 'EXE', 'Bank.exe' + git2patch.BUILD_DELTA_EXTENSION)
+        self.write(self.delta_file, make_delta(self.reference, self.target))
+
+    @staticmethod
+    def write(file_path, data):
+        git2patch.make_dirs(os.path.dirname(file_path))
+        with open(file_path, mode='wb') as f:
+            f.write(data)
+
+    def test_applied(self):
+        self.assertTrue(git2patch.apply_build_deltas(self.patch_dir, self.installed_dir))
+        self.assertFalse(os.path.exists(self.delta_file))
+        with open(self.delta_file[:-len(git2patch.BUILD_DELTA_EXTENSION)], mode='rb') as f:
+            self.assertEqual(f.read(), self.target)
+
+    def test_no_reference(self):
+        os.remove(os.path.join(self.installed_dir, 'EXE', 'Bank.exe'))
+        self.assertFalse(git2patch.apply_build_deltas(self.patch_dir, self.installed_dir))
+        self.assertTrue(os.path.exists(self.delta_file))
+        self.assertFalse(os.path.exists(self.delta_file[:-len(git2patch.BUILD_DELTA_EXTENSION)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
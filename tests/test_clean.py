@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import git2patch
+from tests import use_temp_trash, wait_background_clean
+
+git2patch.LOGGER.level = git2patch.LOG_ERROR + 1  # тесты не пишут git2patch.log
+
+
+class CleanTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = temp_dir.name
+        self.trash = use_temp_trash(self, self.root)
+
+    def make_tree(self, path):
+        for sub_dir in ['A', os.path.join('A', 'B')]:
+            git2patch.make_dirs(os.path.join(path, sub_dir))
+            with open(os.path.join(path, sub_dir, 'file.txt'), mode='w') as f:
+                f.write(sub_dir)
+
+    def test_moved_to_trash(self):
+        work_dir = os.path.join(self.root, '_TEMP', 'COMPARED')
+        self.make_tree(work_dir)
+        with mock.patch.object(git2patch, '__remove_tree_in_background__') as remove:
+            self.assertTrue(git2patch.clean(work_dir))
+        self.assertFalse(os.path.exists(work_dir))
+        # рядом с очищенным каталогом ничего не остается, он переносится в корзину
+        self.assertEqual(os.listdir(os.path.dirname(work_dir)), [])
+        aside = remove.call_args[0][0]
+        self.assertEqual(os.path.dirname(aside), self.trash)
+        self.assertTrue(os.path.isfile(os.path.join(aside, 'A', 'B', 'file.txt')))
+
+    def test_removed_in_background(self):
+        work_dir = os.path.join(self.root, '_TEMP')
+        self.make_tree(work_dir)
+        self.assertTrue(git2patch.clean(work_dir))
+        wait_background_clean()
+        self.assertFalse(os.path.exists(work_dir))
+        self.assertEqual(os.listdir(self.trash), [])
+
+    def test_leftovers_removed_once(self):
+        leftover = os.path.join(self.trash, f'_TEMP{git2patch.CLEAN_ASIDE_SUFFIX}1_1')
+        self.make_tree(leftover)
+        own = os.path.join(self.trash, f'_TEMP{git2patch.CLEAN_ASIDE_SUFFIX}{os.getpid()}_1')
+        self.make_tree(own)
+        with mock.patch.object(git2patch, '__remove_tree_in_background__') as remove:
+            git2patch.clean(os.path.join(self.root, 'missing'))
+            git2patch.clean(os.path.join(self.root, 'missing'))
+        # каталоги текущего процесса еще удаляются им самим
+        remove.assert_called_once_with(leftover)
+
+    def test_trash_itself_removed_in_place(self):
+        self.make_tree(self.trash)
+        self.assertTrue(git2patch.clean(self.trash))
+        self.assertFalse(os.path.exists(self.trash))
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+
+import git2patch
+
+
+class NormalizeArgumentsTest(unittest.TestCase):
+    def check(self, arguments, expected):
+        self.assertEqual(git2patch.normalize_arguments(arguments), expected, arguments)
+
+    def test_default_command(self):
+        self.check([], ['patch'])
+        self.check(['--restart'], ['patch', '--restart'])
+        self.check(['-restart'], ['patch', '--restart'])
+        self.check(['/restart'], ['patch', '--restart'])
+
+    def test_legacy_commands(self):
+        self.check(['-patch'], ['patch'])
+        self.check(['/compile'], ['compile'])
+        self.check(['-plan', '--show'], ['plan', '--show'])
+        self.check(['-batch', 'jobs.ini', '-restart'], ['batch', 'jobs.ini', '--restart'])
+        self.check(['/apply-deltas', 'PATCH', 'BUILD'], ['apply-deltas', 'PATCH', 'BUILD'])
+
+    def test_commands_passed_through(self):
+        self.check(['version', 'build.zip'], ['version', 'build.zip'])
+        self.check(['cache', '--clear', 'bll'], ['cache', '--clear', 'bll'])
+        self.check(['serve', '8080'], ['serve', '8080'])
+
+    def test_help(self):
+        for argument in ['-h', '--help', '/?', '-help', '/h']:
+            self.check([argument], ['--help'])
+        # справка по команде остается справкой по команде
+        self.check(['patch', '-h'], ['patch', '-h'])
+        self.check(['batch', '--help'], ['batch', '--help'])
+        self.check(['--restart', '-h'], ['patch', '--restart', '-h'])
+
+    def test_command_names_only_first(self):
+        self.check(['version', '-plan'], ['version', '-plan'])
+
+    def test_main_help(self):
+        with self.assertRaises(SystemExit) as context, \
+                mock.patch('sys.stdout') as stdout:
+            git2patch.main(['--help'])
+        self.assertEqual(context.exception.code, 0)
+        output = ''.join(call.args[0] for call in stdout.write.call_args_list)
+        self.assertIn('jira-first-tag', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
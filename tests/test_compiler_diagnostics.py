@@ -0,0 +1,43 @@
+import unittest
+
+import git2patch
+
+
+class ParseCompilerDiagnosticTest(unittest.TestCase):
+    CASES = [
+        # строка вывода, ожидаемая диагностика (None - не диагностика)
+        ('uaTest.bls(12,5): Error: Undeclared identifier "x"',
+         {'file': 'uatest.bls', 'line': 12, 'column': 5, 'severity': 'error', 'message': 'Undeclared identifier "x"'}),
+        ('uaTest.bls(12) Warning Variable "y" is never used',
+         {'file': 'uatest.bls', 'line': 12, 'column': None, 'severity': 'warning',
+          'message': 'Variable "y" is never used'}),
+        ('Error in line 7: Missing ";"',
+         {'file': 'unit.bls', 'line': 7, 'column': None, 'severity': 'error', 'message': 'Missing ";"'}),
+        ('Fatal: Unit "uaLib" not found',
+         {'file': 'unit.bls', 'line': None, 'column': None, 'severity': 'error', 'message': 'Unit "uaLib" not found'}),
+        ('Hint in line 3: value assigned is never used',
+         {'file': 'unit.bls', 'line': 3, 'column': None, 'severity': 'hint',
+          'message': 'value assigned is never used'}),
+        ('Compiled succesfully', None),
+        ('Borland BLS compiler version 20.1', None),
+        ('', None),
+    ]
+
+    def test_cases(self):
+        for line, expected in self.CASES:
+            with self.subTest(line=line):
+                self.assertEqual(git2patch.parse_compiler_diagnostic(line, 'Unit.bls'), expected)
+
+    def test_windows_path(self):
+        # имя файла - как у непрошедших единиц компиляции, на любой платформе
+        for line in [r'c:\x\ub.bls(12,5): Error: text', r'C:\Work\BLS\SOURCE\UB.BLS(12) Error text',
+                     'c:/x/ub.bls(12): error: text']:
+            with self.subTest(line=line):
+                diagnostic = git2patch.parse_compiler_diagnostic(line, 'other.bls')
+                self.assertEqual(diagnostic['file'], 'ub.bls')
+                self.assertEqual(diagnostic['line'], 12)
+                self.assertEqual(diagnostic['severity'], 'error')
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
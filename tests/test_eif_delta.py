@@ -0,0 +1,124 @@
+import os
+import tempfile
+import unittest
+
+import git2patch
+
+git2patch.LOGGER.level = git2patch.LOG_ERROR + 1  # тесты не пишут git2patch.log
+
+FIELDS = ['ID', 'Name', 'Revision']
+
+
+def record(number, revision=1):
+    return f"<{number}|'record {number}'|{revision}>"
+
+
+def data_file(records, fields=FIELDS, table_name='TABLE0008'):
+    lines = ['[SECTION]', f'Name = {table_name} (data)', 'Type = DSPStructure', 'Version = 100', 'ObjectType = data',
+             f'ObjectName = {table_name}', f'TableName = {table_name}', '[DATA]', ' [FIELDS]'] + \
+        [f'  {field}' for field in fields] + [' [RECORDS]'] + [f'  {text}' for text in records] + ['[END]']
+    return ''.join(line + '\r\n' for line in lines).encode('windows-1251')
+
+
+def structure_file(table_name='TABLE0008'):
+    lines = ['[SECTION]', f'Name = {table_name} (10)', 'Type = DSPStructure', 'Version = 100', 'ObjectType = 10',
+             f'ObjectName = {table_name}', f'TableName = {table_name}', '[DATA]', ' [TREE]', '  Indexes', '    PKey',
+             '      Fields', '        ID:integer = 0', '      Unique:boolean = TRUE', '      Primary:boolean = TRUE',
+             ' [FIELDS]'] + [f'  {field}' for field in FIELDS] + [' [RECORDS]', '[END]']
+    return ''.join(line + '\r\n' for line in lines).encode('windows-1251')
+
+
+def apply_ranges(data, ranges):
+    return b''.join(data[start:end] for start, end in ranges)
+
+
+class EifMakeDeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.records = [record(number) for number in range(10)]
+        self.before = data_file(self.records)
+
+    def test_changed_and_new_records(self):
+        after_records = list(self.records)
+        after_records[3] = record(3, revision=2)
+        after_records.append(record(10))
+        after = data_file(after_records)
+        ranges = git2patch.eif_make_delta(self.before, after, ['ID'])
+        # заголовок и [END] - как в исходном файле, между ними - только измененная и новая записи
+        self.assertEqual(apply_ranges(after, ranges), data_file([record(3, revision=2), record(10)]))
+        self.assertEqual(git2patch.eif_ranges_size(ranges), len(apply_ranges(after, ranges)))
+
+    def test_same_records(self):
+        ranges = git2patch.eif_make_delta(self.before, data_file(self.records), ['ID'])
+        self.assertEqual(apply_ranges(self.before, ranges), data_file([]))
+
+    def test_deleted_record(self):
+        self.assertIsNone(git2patch.eif_make_delta(self.before, data_file(self.records[1:]), ['ID']))
+
+    def test_duplicate_key(self):
+        after = data_file(self.records + [record(4, revision=2)])
+        self.assertIsNone(git2patch.eif_make_delta(self.before, after, ['ID']))
+        self.assertIsNone(git2patch.eif_make_delta(after, self.before, ['ID']))
+
+    def test_different_fields(self):
+        after = data_file([text[:-1] + '|NULL>' for text in self.records], fields=FIELDS + ['Comment'])
+        self.assertIsNone(git2patch.eif_make_delta(self.before, after, ['ID']))
+
+    def test_every_record_changed(self):
+        after = data_file([record(number, revision=2) for number in range(10)])
+        self.assertIsNone(git2patch.eif_make_delta(self.before, after, ['ID']))
+
+    def test_unknown_key_field(self):
+        self.assertIsNone(git2patch.eif_make_delta(self.before, data_file(self.records), ['Code']))
+
+
+class MakeEifDeltasTest(unittest.TestCase):
+    TABLES = ['TABLE0008', 'CONTROLGROUPS', 'CONTROLSETTINGS', 'CONTROLCONSTANTS']
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        temp_dir_before = git2patch.JOB.DIR_TEMP
+        self.addCleanup(git2patch.set_temp_dir, temp_dir_before)
+        git2patch.set_temp_dir(temp_dir.name)
+        records = [record(number) for number in range(10)]
+        self.after = data_file(records[:9] + [record(9, revision=2)])
+        for table_name in self.TABLES:
+            for root, data in [(git2patch.JOB.DIR_BEFORE, data_file(records)), (git2patch.JOB.DIR_AFTER, self.after),
+                               (git2patch.JOB.DIR_COMPARED, self.after)]:
+                self.write(os.path.join(root, 'BASE', git2patch.INSTANCE_BANK, 'TABLEDATA', f'{table_name}(data).eif'),
+                           data)
+            self.write(os.path.join(git2patch.dir_after_base_tables(git2patch.INSTANCE_BANK), f'{table_name}(10).eif'),
+                       structure_file(table_name))
+
+    @staticmethod
+    def write(file_path, data):
+        git2patch.make_dirs(os.path.dirname(file_path))
+        with open(file_path, mode='wb') as f:
+            f.write(data)
+
+    def read_compared(self, table_name):
+        with open(os.path.join(git2patch.dir_compared_base(git2patch.INSTANCE_BANK), 'TABLEDATA',
+                               f'{table_name}(data).eif'), mode='rb') as f:
+            return f.read()
+
+    def test_control_tables_shipped_whole(self):
+        git2patch.make_eif_deltas()
+        self.assertEqual(self.read_compared('TABLE0008'), data_file([record(9, revision=2)]))
+        for table_name in self.TABLES[1:]:
+            self.assertEqual(self.read_compared(table_name), self.after, table_name)
+            self.assertFalse(git2patch.eif_delta_allowed(table_name))
+        delta_tables = git2patch.eif_delta_tables(git2patch.INSTANCE_BANK,
+                                                  git2patch.get_eif_inventory(git2patch.INSTANCE_BANK))
+        self.assertEqual(delta_tables, {'table0008': ['ID']})
+
+    def test_upgrade10_delta_row(self):
+        row = git2patch.make_upgrade10_eif_string_for_tables('TABLE0008', ['ID', 'Name'])
+        self.assertEqual(row, "<{}|{}|'{}'|TRUE|TRUE|TRUE|TRUE|TRUE|TRUE|'ID,Name'|NULL|NULL|NULL|NULL|'Таблицы'>")
+        self.assertEqual(git2patch.make_upgrade10_eif_string_for_tables('TABLE0008'), git2patch.UPGRADE10_TABLE_FULL)
+        line = git2patch.upgrade10_eif_by_file_name(5, 'TABLE0008(10).eif', {'table0008': ['ID']})
+        self.assertIn("<5|10|'TABLE0008'|TRUE|TRUE|TRUE|TRUE|TRUE|TRUE|'ID'|", line)
+        self.assertEqual(git2patch.upgrade10_eif_by_file_name(5, 'TABLE0008(data).eif', {'table0008': ['ID']}), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,31 @@
+import os
+import unittest
+
+import git2patch
+
+
+class EifInventoryTest(unittest.TestCase):
+    def setUp(self):
+        tables = os.path.join('COMPARED', 'BASE', 'BANK', 'TABLES')
+        data = os.path.join('COMPARED', 'BASE', 'BANK', 'TABLEDATA')
+        self.inventory = git2patch.EifInventory([
+            os.path.join(tables, 'beta(10).eif'), os.path.join(tables, 'Alpha(10).eif'),
+            os.path.join(tables, 'GAMMA(10).eif'), os.path.join(data, 'beta(data).eif'),
+            os.path.join(data, 'Alpha(data).eif'), os.path.join(data, 'GAMMA(data).eif')])
+
+    def test_file_names_ignore_case(self):
+        self.assertEqual(self.inventory.file_names(),
+                         ['Alpha(10).eif', 'Alpha(data).eif', 'beta(10).eif', 'beta(data).eif',
+                          'GAMMA(10).eif', 'GAMMA(data).eif'])
+
+    def test_of_type_ignores_case(self):
+        self.assertEqual([os.path.basename(path) for path in self.inventory.of_type('data')],
+                         ['Alpha(data).eif', 'beta(data).eif', 'GAMMA(data).eif'])
+
+    def test_get_ignores_case(self):
+        self.assertEqual(len(self.inventory.get('10', 'alpha')), 1)
+        self.assertEqual(len(self.inventory.get('data', 'Gamma')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+
+import git2patch
+
+
+def eif(lines):
+    return ''.join(line + '\r\n' for line in lines).encode('windows-1251')
+
+
+def data_section(table_name, records):
+    return ['[SECTION]', f'Name = {table_name} (data)', 'ObjectType = data', f'TableName = {table_name}', '[DATA]',
+            ' [FIELDS]', '  ID', '  Name', '  Revision', ' [RECORDS]'] + [f'  {text}' for text in records] + ['[END]']
+
+
+def structure(indexes):
+    lines = ['[SECTION]', 'Name = TABLE0008 (10)', 'ObjectType = 10', '[DATA]', ' [REMARKS]', '  Таблица', ' [TREE]',
+             '  Indexes']
+    for name, fields, unique, primary in indexes:
+        lines += [f'    {name}', '      Fields'] + [f'        {field}:integer = {order}' for field, order in fields] + \
+            [f'      Unique:boolean = {unique}', f'      Primary:boolean = {primary}']
+    return eif(lines + ['  UseTransit', ' [FIELDS]', '  ID', '  Code', '  Name', ' [RECORDS]', '[END]'])
+
+
+class EifSplitRecordTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(git2patch.eif_split_record(b"  <1|NULL|2>\r\n"), [b'1', b'NULL', b'2'])
+
+    def test_separator_inside_string(self):
+        self.assertEqual(git2patch.eif_split_record(b"<1|'a|b|c'|2>"), [b'1', b"'a|b|c'", b'2'])
+
+    def test_doubled_quotes(self):
+        self.assertEqual(git2patch.eif_split_record(b"<1|'it''s'|2>"), [b'1', b"'it''s'", b'2'])
+        self.assertEqual(git2patch.eif_split_record(b"<1|'it''s|x'|''|2>"), [b'1', b"'it''s|x'", b"''", b'2'])
+
+    def test_newline_inside_string(self):
+        self.assertEqual(git2patch.eif_split_record(b"<1|'first\r\nsecond|third'|2>\r\n"),
+                         [b'1', b"'first\r\nsecond|third'", b'2'])
+
+
+class EifIndexTest(unittest.TestCase):
+    def records(self, data, section):
+        return [data[start:end] for start, end in git2patch.eif_record_spans(section)]
+
+    def test_single_section(self):
+        data = eif(data_section('TABLE0008', ["<1|'one'|1>", "<2|'two'|1>"]))
+        section = git2patch.eif_parse_table(data)
+        self.assertEqual(section['header']['TableName'], 'TABLE0008')
+        self.assertEqual(section['fields'], ['ID', 'Name', 'Revision'])
+        self.assertEqual(self.records(data, section), [b"  <1|'one'|1>\r\n", b"  <2|'two'|1>\r\n"])
+        self.assertTrue(data[section['records_end']:].startswith(b'[END]'))
+
+    def test_multiline_records(self):
+        # строка с переводом строки, в том числе со строкой, которая оканчивается на '>' и на '[...]'
+        records = ["<1|'first\r\nsecond'|1>", "<2|'ends with >\r\n[END]\r\n<3|'|1>", "<4|'it''s\r\nx'|1>",
+                   "<5|'five'|1>"]
+        data = eif(data_section('TABLE0008', records))
+        section = git2patch.eif_parse_table(data)
+        self.assertEqual([record.strip() for record in self.records(data, section)],
+                         [text.encode('windows-1251') for text in records])
+        self.assertEqual([len(git2patch.eif_split_record(record)) for record in self.records(data, section)],
+                         [3, 3, 3, 3])
+
+    def test_several_sections(self):
+        data = eif(data_section('TABLE0008', ["<1|'one'|1>"]) + data_section('TABLE0009', ["<1|'a'|1>", "<2|'b'|1>"]))
+        sections = git2patch.eif_index(data)
+        self.assertEqual([section['header']['TableName'] for section in sections], ['TABLE0008', 'TABLE0009'])
+        self.assertEqual([len(section['records']) for section in sections], [1, 2])
+        self.assertEqual(self.records(data, sections[1]), [b"  <1|'a'|1>\r\n", b"  <2|'b'|1>\r\n"])
+        # data-файл дельтой - только с одной секцией
+        self.assertIsNone(git2patch.eif_parse_table(data))
+
+    def test_no_records_block(self):
+        self.assertIsNone(git2patch.eif_parse_table(eif(['[SECTION]', 'Name = TABLE0008 (data)', '[END]'])))
+
+    def test_empty_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'TABLE0008(data).eif')
+            open(file_path, mode='wb').close()
+            with git2patch.eif_open(file_path) as data:
+                self.assertEqual(data, b'')
+                self.assertEqual(git2patch.eif_index(data), [])
+                self.assertIsNone(git2patch.eif_parse_table(data))
+                self.assertEqual(git2patch.eif_get_key_fields(data), [])
+
+    def test_mapped_file(self):
+        data = eif(data_section('TABLE0008', ["<1|'one'|1>", "<2|'two'|1>"]))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'TABLE0008(data).eif')
+            with open(file_path, mode='wb') as f:
+                f.write(data)
+            with git2patch.eif_open(file_path) as mapped:
+                section = git2patch.eif_parse_table(mapped)
+                self.assertEqual(self.records(mapped, section), self.records(data, git2patch.eif_parse_table(data)))
+
+
+class EifGetKeyFieldsTest(unittest.TestCase):
+    def test_primary_index(self):
+        # первичный индекс важнее уникального, поля - в порядке номеров
+        data = structure([('UKey', [('Code', 0)], 'TRUE', 'FALSE'),
+                          ('PKey', [('Name', 1), ('ID', 0)], 'TRUE', 'TRUE')])
+        self.assertEqual(git2patch.eif_get_key_fields(data), ['ID', 'Name'])
+
+    def test_unique_index_only(self):
+        data = structure([('NameKey', [('Name', 0)], 'FALSE', 'FALSE'), ('UKey', [('Code', 0)], 'TRUE', 'FALSE')])
+        self.assertEqual(git2patch.eif_get_key_fields(data), ['Code'])
+
+    def test_no_key_index(self):
+        self.assertEqual(git2patch.eif_get_key_fields(structure([('NameKey', [('Name', 0)], 'FALSE', 'FALSE')])), [])
+        self.assertEqual(git2patch.eif_get_key_fields(structure([])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
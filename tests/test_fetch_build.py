@@ -0,0 +1,70 @@
+import os
+import tempfile
+import types
+import unittest
+import zipfile
+from unittest import mock
+
+import git2patch
+from tests import use_temp_trash, wait_background_clean
+
+git2patch.LOGGER.level = git2patch.LOG_ERROR + 1  # тесты не пишут git2patch.log
+
+
+class FetchBuildTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.root = temp_dir.name
+        temp_dir = git2patch.JOB.DIR_TEMP
+        self.addCleanup(git2patch.set_temp_dir, temp_dir)
+        git2patch.set_temp_dir(os.path.join(self.root, '_TEMP'))
+        use_temp_trash(self, self.root)
+        # каталоги распаковки создаются здесь, чтобы проверить, что они удалены
+        self.extract_dir = os.path.join(self.root, 'extract')
+        os.makedirs(self.extract_dir)
+        patcher = mock.patch.object(tempfile, 'tempdir', self.extract_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_zip(self, zip_path, files):
+        git2patch.make_dirs(os.path.dirname(zip_path))
+        with zipfile.ZipFile(zip_path, mode='w') as z:
+            for name, data in files.items():
+                z.writestr(name, data)
+        return zip_path
+
+    def test_archives_with_same_name(self):
+        # архивы БК и ИК с одинаковыми именами распаковываются одновременно
+        files_bk = {f'bk{i}.dll': f'BK {i}' for i in range(200)}
+        files_ic = {f'ic{i}.dll': f'IC {i}' for i in range(200)}
+        settings = types.SimpleNamespace(
+            BuildBK=self.make_zip(os.path.join(self.root, 'BK', 'build.zip'), files_bk),
+            BuildIC=self.make_zip(os.path.join(self.root, 'IC', 'build.zip'), files_ic),
+            BuildCrypto=self.make_zip(os.path.join(self.root, 'crypto.zip'), {'CryptLib.dll': 'crypto'}),
+            PlaceBuildIntoPatchIC=True, BuildAdditionalFolders=[], Is20Version=None)
+        self.assertEqual(git2patch.fetch_build(settings)[2], [git2patch.INSTANCE_BANK, git2patch.INSTANCE_CLIENT,
+                                                              git2patch.INSTANCE_CLIENT_MBA, git2patch.INSTANCE_IC])
+        for build_dir, files in [(git2patch.JOB.DIR_BUILD_BK, files_bk), (git2patch.JOB.DIR_BUILD_IC, files_ic)]:
+            self.assertEqual(sorted(os.listdir(build_dir)), sorted(list(files) + ['CryptLib.dll']))
+            for name, data in files.items():
+                with open(os.path.join(build_dir, name)) as f:
+                    self.assertEqual(f.read(), data)
+        wait_background_clean()
+        self.assertEqual(os.listdir(self.extract_dir), [])
+
+    def test_build_directory_not_removed(self):
+        build_dir = os.path.join(self.root, 'BUILD.zip.dir')
+        git2patch.make_dirs(build_dir)
+        with open(os.path.join(build_dir, 'bank.dll'), mode='w') as f:
+            f.write('BK')
+        settings = types.SimpleNamespace(BuildBK=build_dir, BuildIC='', BuildCrypto='', PlaceBuildIntoPatchIC=False,
+                                         BuildAdditionalFolders=[], Is20Version=None)
+        git2patch.fetch_build(settings)
+        wait_background_clean()
+        self.assertTrue(os.path.isfile(os.path.join(build_dir, 'bank.dll')))
+        self.assertTrue(os.path.isfile(os.path.join(git2patch.JOB.DIR_BUILD_BK, 'bank.dll')))
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
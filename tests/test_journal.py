@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+
+import git2patch
+from tests import use_temp_trash
+
+git2patch.LOGGER.level = git2patch.LOG_ERROR + 1  # тесты не пишут git2patch.log
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        use_temp_trash(self, self.temp_dir.name)
+        self.journal_file = os.path.join(self.temp_dir.name, 'journal.json')
+        self.output = os.path.join(self.temp_dir.name, 'output')
+        self.calls = []
+
+    def stage(self, result):
+        def function():
+            self.calls.append('run')
+            git2patch.make_dirs(self.output)
+            with open(os.path.join(self.output, 'file.txt'), mode='w') as f:
+                f.write(str(len(self.calls)))
+            return result
+        return function
+
+    def update(self, result):
+        def function(entry):
+            self.calls.append(('update', entry['result']))
+            return result
+        return function
+
+    def test_skipped_when_inputs_not_changed(self):
+        journal = git2patch.Journal(self.journal_file)
+        self.assertEqual(journal.run('stage', [1], [self.output], self.stage({'value': 1})), {'value': 1})
+        # журнал читается заново, как при следующем запуске
+        journal = git2patch.Journal(self.journal_file)
+        self.assertEqual(journal.run('stage', [1], [self.output], self.stage({'value': 2})), {'value': 1})
+        self.assertEqual(self.calls, ['run'])
+
+    def test_rerun_when_inputs_changed(self):
+        journal = git2patch.Journal(self.journal_file)
+        journal.run('stage', [1], [self.output], self.stage({'value': 1}))
+        with open(os.path.join(self.output, 'stale.txt'), mode='w') as f:
+            f.write('stale')
+        self.assertEqual(journal.run('stage', [2], [self.output], self.stage({'value': 2})), {'value': 2})
+        self.assertEqual(self.calls, ['run', 'run'])
+        # результаты прошлого выполнения удалены перед повторным
+        self.assertFalse(os.path.exists(os.path.join(self.output, 'stale.txt')))
+
+    def test_rerun_when_outputs_missing(self):
+        journal = git2patch.Journal(self.journal_file)
+        journal.run('stage', [1], [self.output], self.stage({'value': 1}))
+        git2patch.clean(self.output)
+        journal.run('stage', [1], [self.output], self.stage({'value': 2}))
+        self.assertEqual(self.calls, ['run', 'run'])
+
+    def test_failed_stage_is_not_recorded(self):
+        journal = git2patch.Journal(self.journal_file)
+        self.assertIsNone(journal.run('stage', [1], [self.output], self.stage(None)))
+        self.assertNotIn('stage', git2patch.Journal(self.journal_file).stages)
+        journal.run('stage', [1], [self.output], self.stage({'value': 2}))
+        self.assertEqual(self.calls, ['run', 'run'])
+
+    def test_update_instead_of_rerun(self):
+        journal = git2patch.Journal(self.journal_file)
+        journal.run('stage', [1], [self.output], self.stage({'value': 1}))
+        result = journal.run('stage', [2], [self.output], self.stage({'value': 2}), self.update({'value': 3}))
+        self.assertEqual(result, {'value': 3})
+        self.assertEqual(self.calls, ['run', ('update', {'value': 1})])
+        # обновленный результат записан в журнал с новыми входными данными
+        journal.run('stage', [2], [self.output], self.stage({'value': 4}))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_incomplete_stage_is_updated_with_same_inputs(self):
+        journal = git2patch.Journal(self.journal_file)
+        journal.run('stage', [1], [self.output], self.stage({'value': 1, 'incomplete': True}))
+        result = journal.run('stage', [1], [self.output], self.stage({'value': 2}), self.update({'value': 3}))
+        self.assertEqual(result, {'value': 3})
+        self.assertEqual(self.calls, ['run', ('update', {'value': 1, 'incomplete': True})])
+        journal.run('stage', [1], [self.output], self.stage({'value': 4}), self.update({'value': 5}))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_journal_of_other_version_is_ignored(self):
+        journal = git2patch.Journal(self.journal_file)
+        journal.run('stage', [1], [self.output], self.stage({'value': 1}))
+        with open(self.journal_file, mode='w', encoding='utf-8') as f:
+            f.write('{"version": 0, "stages": {}}')
+        self.assertEqual(git2patch.Journal(self.journal_file).stages, {})
+
+
+class CompileStageResultTest(unittest.TestCase):
+    def test_not_compiled_units_mark_stage_incomplete(self):
+        temp_dir = git2patch.JOB.DIR_TEMP
+        with tempfile.TemporaryDirectory() as work_dir:
+            git2patch.set_temp_dir(work_dir)
+            try:
+                git2patch.save_compile_report({'a.bls': {'status': 'failed'}})
+                result = git2patch.get_compile_stage_result(['a.bls'])
+                self.assertTrue(result['incomplete'])
+                self.assertEqual(result['not_compiled'], ['a.bls'])
+                self.assertNotIn('incomplete', git2patch.get_compile_stage_result([]))
+            finally:
+                git2patch.set_temp_dir(temp_dir)
+
+    def test_failed_units_are_compiled_again(self):
+        graph = {'a.bls': ('a.bls', []), 'b.bls': ('b.bls', ['a.bls']), 'c.bls': ('c.bls', [])}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name in graph:
+                graph[name] = (os.path.join(temp_dir, name), graph[name][1])
+                open(git2patch.replace_ext(graph[name][0], '.bll'), mode='w').close()
+            previous_report = {'a.bls': {'status': 'failed'}, 'b.bls': {'status': 'blocked'},
+                               'c.bls': {'status': 'compiled'}}
+            self.assertEqual(git2patch.bls_get_kept_units(graph, previous_report, []), {'c.bls'})
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,60 @@
+import codecs
+import os
+import types
+import unittest
+
+import git2patch
+
+
+def equivalence(file_name, normalize_text=True):
+    settings = types.SimpleNamespace(NormalizeText=normalize_text, CompareBLSTokens=False)
+    return git2patch.get_file_equivalence(settings, os.path.join('DATA', file_name))
+
+
+class NormalizeTextTest(unittest.TestCase):
+    TEXT = 'first line\nвторая строка\n\tindented\n'
+
+    def same(self, file_name, before, after):
+        return equivalence(file_name)(before, after)
+
+    def test_line_endings_ignored_for_every_extension(self):
+        for extension in git2patch.TEXT_NORMALIZATION_RULES:
+            with self.subTest(extension=extension):
+                lf = self.TEXT.encode('utf-8')
+                self.assertTrue(self.same('file' + extension, lf, self.TEXT.replace('\n', '\r\n').encode('utf-8')))
+                self.assertTrue(self.same('file' + extension, lf, self.TEXT.replace('\n', '\r').encode('utf-8')))
+                self.assertFalse(self.same('file' + extension, lf, lf.replace(b'first', b'1st')))
+
+    def test_rtf_trailing_whitespace_counts(self):
+        before = b'{\\rtf1 \\b bold\\b0 \r\n text}'
+        self.assertTrue(self.same('form.rtf', before, before.replace(b'\r\n', b'\n')))
+        self.assertFalse(self.same('form.rtf', before, b'{\\rtf1 \\b bold\\b0\r\n text}'))
+        # кодировка в RTF не нормализуется: байты сравниваются как есть
+        self.assertFalse(self.same('form.rtf', 'текст'.encode('windows-1251'), 'текст'.encode('utf-8')))
+
+    def test_xml_encoding(self):
+        utf8 = codecs.BOM_UTF8 + '<?xml version="1.0" encoding="utf-8"?>\n<a>Текст</a>\n'.encode('utf-8')
+        cp1251 = '<?xml version="1.0" encoding="windows-1251"?>\r\n<a>Текст</a>  \r\n'.encode('windows-1251')
+        self.assertTrue(self.same('config.xml', utf8, cp1251))
+        self.assertTrue(self.same('schema.xsd', utf8, cp1251))
+        self.assertFalse(self.same('config.xml', utf8, cp1251.replace('Текст'.encode('windows-1251'), b'Text')))
+        # атрибут encoding вне объявления XML - часть содержимого
+        self.assertFalse(self.same('config.xml', b'<a encoding="utf-8"/>', b'<a encoding="windows-1251"/>'))
+
+    def test_xml_trailing_whitespace_ignored(self):
+        self.assertTrue(self.same('config.xml', b'<a>\n  <b/>\n</a>', b'<a>  \n  <b/>\t\n</a>'))
+        self.assertFalse(self.same('config.xml', b'<a>\n  <b/>\n</a>', b'<a>\n<b/>\n</a>'))
+
+    def test_yaml_trailing_whitespace_counts(self):
+        before = 'key: value\nlist:\n  - item\n'
+        self.assertTrue(self.same('app.yaml', before.encode('utf-8'), codecs.BOM_UTF8 + before.encode('utf-8')))
+        self.assertFalse(self.same('app.yaml', before.encode('utf-8'), before.replace('value', 'value  ').encode('utf-8')))
+        self.assertFalse(self.same('page.tpl', b'<td>x</td>\n', b'<td>x</td> \n'))
+
+    def test_not_normalized(self):
+        self.assertIsNone(equivalence('readme.txt'))
+        self.assertIsNone(equivalence('config.xml', normalize_text=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,85 @@
+import io
+import json
+import os
+import random
+import tempfile
+import types
+import unittest
+import zipfile
+import zlib
+
+import git2patch
+
+git2patch.LOGGER.level = git2patch.LOG_ERROR + 1  # тесты не пишут git2patch.log
+
+
+class PackagePatchTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        temp_dir = git2patch.JOB.DIR_TEMP
+        self.addCleanup(git2patch.set_temp_dir, temp_dir)
+        git2patch.set_temp_dir(self.temp_dir.name)
+        self.settings = types.SimpleNamespace(PackageWorkers=2, PackageLevel=6)
+        self.files = {
+            'BANK/Upgrade(10).eif': 'Upgrade(10)\n'.encode('utf-8') * 1000,
+            'BANK/DATA/Таблица(data).eif': 'запись\n'.encode('utf-8') * 100,
+            'BANK/EXE/random.bin': random.Random(1).randbytes(100000),
+            'BANK/EXE/build.zip': b'PK' * 1000,
+            'CLIENT/empty.txt': b'',
+        }
+        for name, data in self.files.items():
+            file_path = os.path.join(git2patch.JOB.DIR_PATCH, *name.split('/'))
+            git2patch.make_dirs(os.path.dirname(file_path))
+            with open(file_path, mode='wb') as f:
+                f.write(data)
+        git2patch.make_dirs(os.path.join(git2patch.JOB.DIR_PATCH, 'CLIENT', 'EMPTY'))
+
+    def test_archive_round_trip(self):
+        self.assertTrue(git2patch.package_patch(self.settings))
+        with zipfile.ZipFile(git2patch.get_filename_package()) as archive:
+            self.assertIsNone(archive.testzip())
+            for name, data in self.files.items():
+                self.assertEqual(archive.read(name), data, name)
+            self.assertIn('CLIENT/EMPTY/', archive.namelist())
+            self.assertEqual(archive.getinfo('BANK/EXE/build.zip').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.getinfo('BANK/EXE/random.bin').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.getinfo('BANK/Upgrade(10).eif').compress_type, zipfile.ZIP_DEFLATED)
+            manifest_name = git2patch.get_last_element_of_path(git2patch.get_filename_package_manifest())
+            with open(git2patch.get_filename_package_manifest(), encoding='utf-8') as f:
+                self.assertEqual(json.loads(archive.read(manifest_name)), json.load(f))
+
+    def test_manifest(self):
+        git2patch.package_patch(self.settings)
+        with open(git2patch.get_filename_package_manifest(), encoding='utf-8') as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(item['path'] for item in manifest['files']), sorted(self.files))
+        self.assertEqual(manifest['size'], sum(len(data) for data in self.files.values()))
+        for item in manifest['files']:
+            self.assertEqual(item['sha256'], git2patch.hashlib.sha256(self.files[item['path']]).hexdigest())
+            self.assertEqual(item['size'], len(self.files[item['path']]))
+        self.assertFalse(os.path.exists(git2patch.get_filename_package() + '.tmp'))
+
+
+class ZipStreamWriterTest(unittest.TestCase):
+    def test_entries_read_back(self):
+        data = b'compressed data ' * 100
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        f = io.BytesIO()
+        writer = git2patch.ZipStreamWriter(f)
+        writer.write('каталог/', b'', 0, 0, 0, zipfile.ZIP_STORED, 0, is_dir=True)
+        writer.write('каталог/файл.txt', compressed, zlib.crc32(data), len(data), len(compressed),
+                     zipfile.ZIP_DEFLATED, 0)
+        writer.write('stored.bin', io.BytesIO(data), zlib.crc32(data), len(data), len(data), zipfile.ZIP_STORED, 0)
+        writer.close()
+        with zipfile.ZipFile(f) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['каталог/', 'каталог/файл.txt', 'stored.bin'])
+            self.assertTrue(archive.getinfo('каталог/').is_dir())
+            self.assertEqual(archive.read('каталог/файл.txt'), data)
+            self.assertEqual(archive.read('stored.bin'), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file
@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+import git2patch
+
+# поток-писатель лога открывает файл лога один раз, поэтому он один на все тесты модуля
+LOG_DIR = None
+MODULE_PATCHERS = []
+
+
+def setUpModule():
+    global LOG_DIR
+    LOG_DIR = tempfile.mkdtemp()
+    log_file = os.path.join(LOG_DIR, 'git2patch.log')
+    MODULE_PATCHERS.extend([mock.patch.object(git2patch, 'get_filename_log', lambda: log_file),
+                            mock.patch.object(git2patch.LOGGER, 'level', git2patch.LOG_INFO),
+                            mock.patch('builtins.print')])
+    for patcher in MODULE_PATCHERS:
+        patcher.start()
+    git2patch.log('service tests')
+    git2patch.flush_log()
+
+
+def tearDownModule():
+    for patcher in reversed(MODULE_PATCHERS):
+        patcher.stop()
+    shutil.rmtree(LOG_DIR, ignore_errors=True)
+
+
+class JobNameTest(unittest.TestCase):
+    def test_job_dir_is_inside_batch_dir(self):
+        for name in ['job1', '20.1.721-730', 'job_a-b']:
+            self.assertEqual(git2patch.get_job_dir(name), os.path.join(git2patch.DIR_BATCH, name))
+
+    def test_wrong_names_are_rejected(self):
+        for name in ['', '.', '..', '...', 'a/b', 'a\\b', '../a', 'a..b', '.a', 'a.']:
+            with self.assertRaises(ValueError, msg=name):
+                git2patch.get_job_dir(name)
+
+
+# Служба на localhost со сборкой задания, замененной на run_job теста
+class ServiceTest(unittest.TestCase):
+    TIMEOUT = 10
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        for patcher in [mock.patch.object(git2patch, 'DIR_BATCH', os.path.join(self.temp_dir, '_BATCH')),
+                        mock.patch.object(git2patch, 'run_service_job', self.run_job)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.blocked = threading.Event()  # задания ждут его (или отмены), прежде чем завершиться
+        self.server = git2patch.create_service_server(0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.stop_server)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def stop_server(self):
+        self.blocked.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.service.stop()
+
+    def run_job(self, job):
+        git2patch.log(f'building {job.name}')
+        while not self.blocked.wait(0.05):
+            git2patch.check_cancelled()
+        return job.overrides.get('result') != 'failed'
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.TIMEOUT) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read()
+
+    def request_json(self, method, path, body=None):
+        code, data = self.request(method, path, body)
+        return code, json.loads(data)
+
+    def wait_status(self, job_id, statuses):
+        deadline = time.time() + self.TIMEOUT
+        while time.time() < deadline:
+            job = self.request_json('GET', f'/jobs/{job_id}')[1]
+            if job['status'] in statuses:
+                return job
+            time.sleep(0.05)
+        self.fail(f'job {job_id} is still {job["status"]}')
+
+    def test_submit_and_status(self):
+        code, job = self.request_json('POST', '/jobs', {'name': 'a', 'settings': {'TagAfter': 't2'}})
+        self.assertEqual(code, 201)
+        self.assertEqual((job['id'], job['name'], job['settings']), (1, 'a', {'TagAfter': 't2'}))
+        self.wait_status(1, ['running'])
+        self.assertEqual(self.request_json('GET', '/status')[1]['jobs'], {'running': 1})
+        self.blocked.set()
+        self.assertEqual(self.wait_status(1, ['done', 'failed', 'cancelled'])['status'], 'done')
+        self.request_json('POST', '/jobs', {'name': 'b', 'settings': {'result': 'failed'}})
+        self.assertEqual(self.wait_status(2, ['done', 'failed', 'cancelled'])['status'], 'failed')
+        self.assertEqual([job['name'] for job in self.request_json('GET', '/jobs')[1]], ['a', 'b'])
+        self.assertEqual(self.request_json('GET', '/jobs/3')[0], 404)
+
+    def test_wrong_names_are_rejected(self):
+        for name in ['.', '..', '../x', 'a/b']:
+            code, answer = self.request_json('POST', '/jobs', {'name': name, 'restart': True})
+            self.assertEqual(code, 400, name)
+        self.assertEqual(self.request_json('GET', '/jobs')[1], [])
+
+    def test_active_name_is_refused(self):
+        self.assertEqual(self.request_json('POST', '/jobs', {'name': 'a'})[0], 201)
+        self.assertEqual(self.request_json('POST', '/jobs', {'name': 'b'})[0], 201)
+        self.assertEqual(self.request_json('POST', '/jobs', {'name': 'a'})[0], 409)  # выполняется
+        self.assertEqual(self.request_json('POST', '/jobs', {'name': 'B'})[0], 409)  # в очереди
+        self.blocked.set()
+        self.wait_status(2, ['done'])
+        self.assertEqual(self.request_json('POST', '/jobs', {'name': 'a'})[0], 201)
+
+    def test_log_streaming(self):
+        self.request_json('POST', '/jobs', {'name': 'a'})
+        self.wait_status(1, ['running'])
+        threading.Timer(0.3, self.blocked.set).start()
+        code, data = self.request('GET', '/jobs/1/log')  # отдается до завершения задания
+        self.assertEqual(code, 200)
+        text = data.decode()
+        self.assertIn('SERVICE JOB 1 "a" BEGIN', text)
+        self.assertIn('building a', text)
+        self.assertIn('SERVICE JOB 1 "a" FINISHED: done', text)
+        # в лог задания не попадает лог других заданий
+        self.request_json('POST', '/jobs', {'name': 'b'})
+        self.wait_status(2, ['done'])
+        self.assertNotIn('building b', self.request('GET', '/jobs/1/log')[1].decode())
+        self.assertIn('building b', self.request('GET', '/jobs/2/log')[1].decode())
+
+    def test_cancel(self):
+        self.request_json('POST', '/jobs', {'name': 'a'})
+        self.request_json('POST', '/jobs', {'name': 'b'})
+        self.wait_status(1, ['running'])
+        self.assertEqual(self.request_json('DELETE', '/jobs/2')[0], 202)  # в очереди
+        self.assertEqual(self.request_json('DELETE', '/jobs/1')[0], 202)  # выполняется
+        self.assertEqual(self.wait_status(1, ['done', 'failed', 'cancelled'])['status'], 'cancelled')
+        self.assertEqual(self.wait_status(2, ['done', 'failed', 'cancelled'])['status'], 'cancelled')
+        self.assertEqual(self.request_json('DELETE', '/jobs/7')[0], 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file